@@ -0,0 +1,131 @@
+#!python3
+"""
+Measures the speed-up of the trigram-indexed category search over brute force,
+against the recall it gives up, for a range of candidate pool sizes
+(predict_candidates in the config).
+
+The training set and the queries are synthetic transaction names from
+fakeplaid.FakePlaidData, the queries from a different item than the training
+rows and with --noise random character edits each, so that they rarely match a
+training name exactly. The training set is searched the way predict_categories
+does, through a CategoryIndex of its prototypes. For each pool size:
+
+    recall      share of the neighbours found that are no further from the query
+                than its exact K-th nearest name
+    agreement   share of queries given the same category as by brute force
+
+    $ python benchmarks/categorizer_recall.py --train 200000 --queries 1000 --candidates 50,100,200,400
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import datetime
+import platform
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import categorizer
+import fakeplaid
+from categoryindex import CategoryIndex
+from pipeline import git_revision
+
+
+def synthetic_names(item: int, n: int, seed: int) -> pd.DataFrame:
+    data = fakeplaid.FakePlaidData(items=item + 1, transactions_per_item=n, seed=seed)
+    txns = [data.transaction(item, i) for i in range(n)]
+    return pd.DataFrame({
+        'txn_id': [t['transaction_id'] for t in txns],
+        'txn_name': [t['name'] for t in txns],
+        'txn_cat': [t['personal_finance_category']['primary'] for t in txns],
+    })
+
+
+def add_noise(name: str, edits: int, rng: random.Random) -> str:
+    for _ in range(edits):
+        i = rng.randrange(len(name) + 1)
+        c = rng.choice(string.ascii_uppercase + string.digits + ' ')
+        name = rng.choice([name[:i] + c + name[i + 1:], name[:i] + c + name[i:], name[:i] + name[i + 1:]])
+    return name
+
+
+def neighbour_distances(index: CategoryIndex, queries, nearest: np.ndarray) -> np.ndarray:
+    return np.array([categorizer.name_distances(q, [index.names[i] for i in row]) for q, row in zip(queries, nearest)])
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Benchmark trigram-indexed category search against brute force")
+    parser.add_argument("--train",      dest="train",      type=int, default=50000, help="Training transactions (cat_data rows).")
+    parser.add_argument("--queries",    dest="queries",    type=int, default=1000,  help="Uncategorized transactions to predict.")
+    parser.add_argument("--candidates", dest="candidates", default="25,50,100,200,400,800", help="Comma-separated candidate pool sizes.")
+    parser.add_argument("--noise",      dest="noise",      type=int, default=2,     help="Random character edits made to each query.")
+    parser.add_argument("--seed",       dest="seed",       type=int, default=0,     help="Seed of the synthetic data.")
+    parser.add_argument("--output",     dest="output",                              help="JSON file to write, defaults to benchmarks/results/categorizer_recall-<commit>.json.")
+    args = parser.parse_args()
+    args.candidates = [int(c) for c in args.candidates.split(',')]
+    return args
+
+
+def main():
+    args = parse_options()
+    cat_data = synthetic_names(0, args.train, args.seed)
+    uncat = synthetic_names(1, args.queries, args.seed)
+    rng = random.Random(args.seed)
+    uncat['txn_name'] = [add_noise(n, args.noise, rng) for n in uncat['txn_name']]
+    index = CategoryIndex(None)
+    index.reset(categorizer.build_prototypes(cat_data))
+    queries = uncat['txn_name'].map(categorizer.normalize_name).values
+    print("%d training transactions (%d distinct names), %d queries" % (cat_data.shape[0], len(index), len(queries)))
+
+    start = time.perf_counter()
+    exact = index.neighbours(queries)
+    exact_seconds = time.perf_counter() - start
+    kth_distance = neighbour_distances(index, queries, exact).max(axis=1)
+    exact_cats = index.predict(uncat)['txn_cat_new'].values
+    print("%12s %9.3fs" % ('brute force', exact_seconds))
+
+    results = []
+    for candidates in args.candidates:
+        start = time.perf_counter()
+        nearest = index.neighbours(queries, candidates=candidates)
+        seconds = time.perf_counter() - start
+        recall = (neighbour_distances(index, queries, nearest) <= kth_distance[:, None]).mean()
+        cats = index.predict(uncat, candidates=candidates)['txn_cat_new'].values
+        result = {
+            'candidates': candidates,
+            'seconds': round(seconds, 4),
+            'speedup': round(exact_seconds / seconds, 2),
+            'recall': round(float(recall), 4),
+            'agreement': round(float((cats == exact_cats).mean()), 4),
+        }
+        results.append(result)
+        print("%12d %9.3fs %7.1fx  recall %.4f  agreement %.4f" % (
+            candidates, seconds, result['speedup'], result['recall'], result['agreement']))
+
+    revision = git_revision()
+    report = {
+        'benchmark': 'categorizer_recall',
+        'git': revision,
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'options': {'train': args.train, 'queries': args.queries, 'noise': args.noise, 'seed': args.seed, 'k': categorizer.K},
+        'brute_force_seconds': round(exact_seconds, 4),
+        'results': results,
+    }
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         'categorizer_recall-%s.json' % (revision['commit'][:10] or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote %s" % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!python3
+"""
+Offline evaluation of the predict_categories engines on categorized history.
+
+The categorized transactions (cat_data) of a database are split into a training
+set and a test set, by default the most recent --test-fraction of them by
+txn_date, as if they had just arrived. A CategoryIndex is built from the
+prototypes of the training set, and each engine predicts the test set:
+
+    levenshtein     edit distance to every training name (--candidates 0), or
+                    to a trigram candidate pool of that size
+    tfidf           cosine similarity of TF-IDF trigram vectors (needs scipy)
+
+For each, accuracy against the categories actually given, overall and on the
+novel transactions (whose normalized name is not in the training set, so are
+searched rather than looked up), and the latency per transaction are reported.
+The database is only read. Without --db, a synthetic history from
+fakeplaid.FakePlaidData is used, the test names with --noise random edits each.
+
+    $ python benchmarks/evaluate_categorizers.py --db /data/transactions --candidates 0,200
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import platform
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fakeplaid
+import tfidfsearch
+from categorizer import build_prototypes, normalize_name
+from categoryindex import CategoryIndex
+from categorizer_recall import add_noise
+from pipeline import git_revision
+
+
+def read_cat_data(folder: str, backend: str) -> pd.DataFrame:
+    if backend == 'sqlite':
+        conn = sqlite3.connect('file:%s/transactions.db?mode=ro' % folder, uri=True)
+        try:
+            cat_data = pd.read_sql_query("SELECT * FROM cat_data", conn)
+        finally:
+            conn.close()
+    else:
+        cat_data = pd.read_parquet(folder + '/cat_data.parquet')
+    if 'txn_date' not in cat_data.columns:
+        cat_data['txn_date'] = pd.NaT
+    cat_data['txn_date'] = pd.to_datetime(cat_data['txn_date'])
+    cat_data['txn_cat'] = cat_data['txn_cat'].astype(object)
+    return cat_data[cat_data['txn_cat'].notnull()].reset_index(drop=True)
+
+
+def synthetic_cat_data(rows: int, seed: int) -> pd.DataFrame:
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=rows, seed=seed)
+    txns = [data.transaction(0, i) for i in range(rows)]
+    return pd.DataFrame({
+        'txn_id': [t['transaction_id'] for t in txns],
+        'txn_name': [t['name'] for t in txns],
+        'txn_cat': [t['personal_finance_category']['primary'] for t in txns],
+        'txn_date': pd.to_datetime([t['date'] for t in txns]),
+    })
+
+
+def split(cat_data: pd.DataFrame, test_fraction: float, by: str, seed: int):
+    """
+    Returns the training and test rows of cat_data: the latest test_fraction of
+    them by txn_date, or a random test_fraction with by='random' or when some
+    rows have no txn_date.
+    """
+    n_test = max(1, int(round(cat_data.shape[0] * test_fraction)))
+    if by == 'time' and cat_data['txn_date'].notnull().all():
+        order = np.argsort(cat_data['txn_date'].values, kind='stable')
+    else:
+        order = np.random.default_rng(seed).permutation(cat_data.shape[0])
+    return cat_data.iloc[order[:-n_test]], cat_data.iloc[order[-n_test:]]
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Evaluate the category prediction engines on categorized history")
+    parser.add_argument("--db",            dest="db",                                help="Database folder to read cat_data from, synthetic data if not given.")
+    parser.add_argument("--backend",       dest="backend",  default="parquet", choices=['parquet', 'sqlite'], help="Backend of --db.")
+    parser.add_argument("--synthetic",     dest="synthetic", type=int,   default=50000, help="Rows of synthetic history without --db.")
+    parser.add_argument("--noise",         dest="noise",    type=int,   default=2,     help="Random character edits made to each synthetic test name.")
+    parser.add_argument("--test-fraction", dest="test",     type=float, default=0.2,   help="Share of cat_data held out for testing.")
+    parser.add_argument("--split",         dest="split",    default="time", choices=['time', 'random'], help="Hold out the latest transactions, or random ones.")
+    parser.add_argument("--engines",       dest="engines",  default="levenshtein,tfidf", help="Comma-separated engines to evaluate.")
+    parser.add_argument("--candidates",    dest="candidates", default="0",             help="Comma-separated candidate pools for levenshtein, 0 for exact.")
+    parser.add_argument("--half-life",     dest="half_life", type=float, default=0,    help="predict_half_life to vote with.")
+    parser.add_argument("--seed",          dest="seed",     type=int,   default=0,     help="Seed of the random split and synthetic data.")
+    parser.add_argument("--output",        dest="output",                              help="JSON file to write, defaults to benchmarks/results/evaluate_categorizers-<commit>.json.")
+    args = parser.parse_args()
+    args.engines = args.engines.split(',')
+    args.candidates = [int(c) for c in args.candidates.split(',')]
+    unknown = set(args.engines) - {'levenshtein', 'tfidf'}
+    if unknown:
+        parser.error("Unknown engines %s, expected levenshtein or tfidf" % sorted(unknown))
+    return args
+
+
+def main():
+    args = parse_options()
+    if args.db:
+        cat_data = read_cat_data(args.db, args.backend)
+        source = '%s (%s)' % (args.db, args.backend)
+    else:
+        cat_data = synthetic_cat_data(args.synthetic, args.seed)
+        source = 'synthetic'
+    train, test = split(cat_data, args.test, args.split, args.seed)
+    if not args.db:
+        rng = random.Random(args.seed)
+        test = test.assign(txn_name=[add_noise(name, args.noise, rng) for name in test['txn_name']])
+
+    start = time.perf_counter()
+    index = CategoryIndex(None)
+    index.reset(build_prototypes(train))
+    fit_seconds = time.perf_counter() - start
+    test = test.drop_duplicates(subset=['txn_id']).sort_values('txn_id')
+    novel = index.lookup(test['txn_name'].map(normalize_name).values) < 0
+    print("%s: %d training transactions (%d distinct names), %d test transactions (%.1f%% novel names)" % (
+        source, train.shape[0], len(index), test.shape[0], 100 * novel.mean()))
+
+    runs = [('levenshtein', c) for c in args.candidates if 'levenshtein' in args.engines]
+    if 'tfidf' in args.engines:
+        if tfidfsearch.sparse is None:
+            print("scipy is not installed, skipping the tfidf engine")
+        else:
+            runs.append(('tfidf', 0))
+    print("%-30s %9s %9s %9s %12s %12s" % ('engine', 'accuracy', 'novel', 'none', 'ms/txn', 'ms/novel'))
+
+    results = []
+    for engine, candidates in runs:
+        start = time.perf_counter()
+        predicted = index.predict(test, candidates=candidates, half_life_days=args.half_life, engine=engine)
+        seconds = time.perf_counter() - start
+        correct = predicted['txn_cat_new'].values == test['txn_cat'].values
+        result = {
+            'engine': engine,
+            'candidates': candidates,
+            'accuracy': round(float(correct.mean()), 4),
+            'novel_accuracy': round(float(correct[novel].mean()), 4) if novel.any() else None,
+            'uncategorized': round(float(predicted['txn_cat_new'].isnull().mean()), 4),
+            'seconds': round(seconds, 4),
+            'ms_per_txn': round(1000 * seconds / test.shape[0], 4),
+            'ms_per_novel_txn': round(1000 * seconds / novel.sum(), 4) if novel.any() else None,
+        }
+        results.append(result)
+        name = engine if not candidates else '%s (%d candidates)' % (engine, candidates)
+        print("%-30s %9.4f %9s %9.4f %12.3f %12s" % (
+            name, result['accuracy'], '%.4f' % result['novel_accuracy'] if novel.any() else '-', result['uncategorized'],
+            result['ms_per_txn'], '%.3f' % result['ms_per_novel_txn'] if novel.any() else '-'))
+
+    revision = git_revision()
+    report = {
+        'benchmark': 'evaluate_categorizers',
+        'git': revision,
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'source': source,
+        'options': {'test_fraction': args.test, 'split': args.split, 'half_life': args.half_life, 'seed': args.seed,
+                    'synthetic': None if args.db else args.synthetic, 'noise': None if args.db else args.noise},
+        'train_rows': int(train.shape[0]),
+        'test_rows': int(test.shape[0]),
+        'distinct_names': len(index),
+        'novel_share': round(float(novel.mean()), 4),
+        'fit_seconds': round(fit_seconds, 4),
+        'results': results,
+    }
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         'evaluate_categorizers-%s.json' % (revision['commit'][:10] or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote %s" % output)
+
+
+if __name__ == '__main__':
+    main()
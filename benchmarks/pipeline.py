@@ -0,0 +1,220 @@
+#!python3
+"""
+Times and memory-profiles each TransactionsDB stage main() runs, on synthetic
+databases of increasing size, and saves the results as JSON so runs on
+different commits can be compared.
+
+Transactions come from fakeplaid.FakePlaidData. Every size starts from an
+empty database in a temporary folder: transactions are saved one item at a
+time, processed, and labeled_fraction of them come back from a fake Google
+Sheet with a category (derived from the Plaid category) and Complete=True,
+the rest being left for predict_categories.
+
+Time is wall-clock (perf_counter); peak_mb is the tracemalloc peak of Python
+and numpy allocations during the stage, arrow_mb the memory held by Arrow
+once it finishes. tracemalloc slows Python-heavy stages down, --no-memory
+times them without it.
+
+Stages known not to scale are skipped above a row limit (see STAGE_LIMITS,
+--limit) and recorded as skipped, so a 1M run still finishes.
+
+    $ python benchmarks/pipeline.py --sizes 10000,100000 --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fakeplaid
+import sqlitedb
+import transactionsdb
+from plaidapi import AccountBalance, AccountInfo, TransactionColumns
+
+STAGES = [
+    'save_transactions',
+    'process_transactions',
+    'update_gsheet_txns',
+    'sync_categories',
+    'update_training_data',
+    'predict_categories',
+    'process_balances',
+    'checkpoint',
+]
+# Largest number of transactions each stage is run at by default
+STAGE_LIMITS = {
+    'predict_categories': 100000,
+}
+
+
+def git_revision() -> dict:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    def git(*args):
+        try:
+            return subprocess.run(['git'] + list(args), cwd=root, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return ''
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': git('status', '--porcelain', '--untracked-files=no') != ''}
+
+
+def gsheet_frame(processed_txns: pd.DataFrame, categories: dict, labeled_fraction: float, seed: int) -> pd.DataFrame:
+    """
+    Builds the frame GSheetSynchronizer.update_gsheet_txns would pull, with a
+    category for labeled_fraction of the processed transactions.
+    """
+    rng = np.random.default_rng(seed)
+    txns = processed_txns[rng.random(processed_txns.shape[0]) < labeled_fraction]
+    return pd.DataFrame({
+        'Date': (txns['txn_date'] - pd.Timestamp('1899-12-30')).dt.days.values,
+        'Description': txns['txn_name'].values,
+        'Amount': txns['txn_amount'].values,
+        'Category': txns['txn_id'].map(categories).values,
+        'Account': txns['account_name_parent'].astype(object).values,
+        'Complete': 'True',
+        'Key': txns['txn_id'].values,
+    })
+
+
+class StageTimer():
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.results = []
+
+    def run(self, rows: int, stage: str, fn, *args):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        fn(*args)
+        seconds = time.perf_counter() - start
+        result = {'rows': rows, 'stage': stage, 'seconds': round(seconds, 4)}
+        if self.memory:
+            result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            tracemalloc.stop()
+        result['arrow_mb'] = round(pa.total_allocated_bytes() / 2**20, 1)
+        self.results.append(result)
+        print("%9d  %-22s %9.3fs %s" % (rows, stage, seconds,
+                                          '%8.1f MB' % result['peak_mb'] if self.memory else ''))
+
+    def skip(self, rows: int, stage: str, reason: str):
+        self.results.append({'rows': rows, 'stage': stage, 'skipped': reason})
+        print("%9d  %-22s   skipped (%s)" % (rows, stage, reason))
+
+
+def run_size(timer: StageTimer, rows: int, args, limits: dict):
+    data = fakeplaid.FakePlaidData(items=args.items, accounts_per_item=2,
+                                   transactions_per_item=max(1, rows // args.items), days=args.days, seed=args.seed)
+    folder = tempfile.mkdtemp(prefix='plaid-sync-bench-')
+    try:
+        db = sqlitedb.SQLiteTransactionsDB(folder) if args.backend == 'sqlite' else transactionsdb.TransactionsDB(folder)
+
+        # Accounts and balances are set up untimed; they are not what scales
+        accounts = [a for item in range(data.items) for a in data.accounts(item)]
+        db.save_account_info([AccountInfo(a, 'Fake%04d' % (i // 2)) for i, a in enumerate(accounts)])
+        db.save_balances([AccountBalance(a) for a in accounts])
+
+        categories = {}
+        def save_transactions():
+            for item in range(data.items):
+                txns = [data.transaction(item, i) for i in range(data.transactions_per_item)]
+                for t in txns:
+                    categories[t['transaction_id']] = t['personal_finance_category']['primary'].replace('_', ' ').title()
+                db.save_transactions(TransactionColumns.from_json(txns))
+
+        stages = {
+            'save_transactions': save_transactions,
+            'process_transactions': db.process_transactions,
+            'sync_categories': db.sync_categories,
+            'update_training_data': db.update_training_data,
+            'predict_categories': db.predict_categories,
+            'process_balances': lambda: db.process_balances(data.anchor_date - datetime.timedelta(days=data.days)),
+            'checkpoint': db.checkpoint,
+        }
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            if rows > limits.get(stage, rows):
+                timer.skip(rows, stage, 'over the %d row limit' % limits[stage])
+                continue
+            if stage == 'update_gsheet_txns':
+                gs = gsheet_frame(db.get_processed_transactions(), categories, args.labeled, args.seed)
+                timer.run(rows, stage, db.update_gsheet_txns, gs)
+                del gs
+            else:
+                timer.run(rows, stage, stages[stage])
+    finally:
+        if args.keep:
+            print("Kept database in %s" % folder)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Benchmark the TransactionsDB pipeline stages on synthetic data")
+    parser.add_argument("--sizes",     dest="sizes",    default="10000,100000,1000000", help="Comma-separated numbers of transactions to run at.")
+    parser.add_argument("--backend",   dest="backend",  default="parquet", choices=['parquet', 'sqlite'], help="Database backend.")
+    parser.add_argument("--stages",    dest="stages",   default=",".join(STAGES),      help="Comma-separated stages to time, all by default.")
+    parser.add_argument("--limit",     dest="limits",   action='append', default=[],    metavar="STAGE=ROWS",
+                        help="Largest size to run a stage at, e.g. predict_categories=100000 (0 for no limit).")
+    parser.add_argument("--items",     dest="items",    type=int,   default=10,    help="Plaid items the transactions are spread over.")
+    parser.add_argument("--days",      dest="days",     type=int,   default=730,   help="Days of history the transactions are spread over.")
+    parser.add_argument("--labeled",   dest="labeled",  type=float, default=0.9,   help="Fraction of transactions categorized in the fake Google Sheet.")
+    parser.add_argument("--seed",      dest="seed",     type=int,   default=0,     help="Seed of the synthetic data.")
+    parser.add_argument("--no-memory", dest="memory",   action='store_false',      help="Time stages without tracemalloc.")
+    parser.add_argument("--keep",      dest="keep",     action='store_true',       help="Keep the databases built instead of deleting them.")
+    parser.add_argument("--output",    dest="output",                              help="JSON file to write, defaults to benchmarks/results/pipeline-<commit>.json.")
+    args = parser.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(',')]
+    args.stages = args.stages.split(',')
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error("Unknown stages %s, expected some of %s" % (sorted(unknown), STAGES))
+    return args
+
+
+def main():
+    args = parse_options()
+    limits = dict(STAGE_LIMITS)
+    for limit in args.limits:
+        stage, rows = limit.split('=')
+        limits[stage] = int(rows) or float('inf')
+
+    revision = git_revision()
+    timer = StageTimer(memory=args.memory)
+    for rows in args.sizes:
+        run_size(timer, rows, args, limits)
+
+    report = {
+        'benchmark': 'pipeline',
+        'git': revision,
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+        'backend': args.backend,
+        'memory_profiled': args.memory,
+        'options': {'items': args.items, 'days': args.days, 'labeled': args.labeled, 'seed': args.seed},
+        'results': timer.results,
+    }
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         'pipeline-%s.json' % (revision['commit'][:10] or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote %s" % output)
+
+
+if __name__ == '__main__':
+    main()
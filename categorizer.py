@@ -0,0 +1,284 @@
+#!python3
+"""
+Building blocks of category prediction for uncategorized transactions.
+
+Training data (cat_data) is compacted into prototypes (see build_prototypes):
+one per normalized name (normalize_name) and category, holding the number of
+training transactions and the date the pair was last seen.
+predict_categories searches them through a categoryindex.CategoryIndex, saved
+with the database, which votes each transaction's category from its own
+name's prototypes, or from those of the K distinct names nearest it.
+
+Nearest is by Levenshtein distance, computed in native code by rapidfuzz's
+cdist, on all cores, over chunks of the queries sized so the distance matrix of
+a chunk stays within CHUNK_CELLS cells (see nearest_neighbours). The K nearest
+are picked from each chunk with argpartition, so the full N x M matrix is never
+held. Without rapidfuzz the distances fall back to one Levenshtein.distance call
+per pair.
+
+As the distinct names grow, scoring every pair stops scaling. With candidates
+set, a TrigramIndex over the names instead picks, per query, the candidates
+names sharing the most character trigrams with it (by Jaccard similarity), and
+only those are scored. This is approximate: a larger pool gives a higher recall
+of the exact neighbours, and a pool at least as large as the number of names
+gives the exact answer. benchmarks/categorizer_recall.py measures the trade-off.
+"""
+
+import copy
+import numpy as np
+import pandas as pd
+from typing import Dict, Optional
+from Levenshtein import distance
+
+try:
+    from rapidfuzz.process import cdist
+    from rapidfuzz.distance import Levenshtein as RapidLevenshtein
+except ImportError:
+    cdist = None
+    RapidLevenshtein = None
+
+K = 10
+TRIGRAM_ARRAYS = ['gram_keys', 'gram_offsets', 'postings', 'name_grams']
+# The (key, name) pairs of the names added since the postings were merged, by key
+TRIGRAM_DELTA_ARRAYS = ['delta_gram_keys', 'delta_postings']
+# Distance matrix cells computed at once, 4 bytes each plus an 8 byte sort key
+CHUNK_CELLS = 2**22
+
+
+def distance_matrix(queries, choices, workers: int = -1) -> np.ndarray:
+    """
+    Returns the Levenshtein distance from each query to each choice, as an int32
+    array of shape (len(queries), len(choices)). workers=-1 uses every core.
+    """
+    if cdist is not None:
+        return cdist(queries, choices, scorer=RapidLevenshtein.distance, dtype=np.int32, workers=workers)
+    return np.array([[distance(q, c) for c in choices] for q in queries], dtype=np.int32).reshape(len(queries), len(choices))
+
+
+def nearest_neighbours(queries, choices, k: int = K, workers: int = -1, chunk_cells: int = CHUNK_CELLS) -> np.ndarray:
+    """
+    Returns the positions in choices of the k nearest choices to each query,
+    nearest first, as an array of shape (len(queries), min(k, len(choices))).
+    Choices at the same distance are ordered by position.
+    """
+    queries, choices = list(queries), list(choices)
+    n, m = len(queries), len(choices)
+    k = min(k, m)
+    nearest = np.empty((n, k), dtype=np.int64)
+    if n == 0 or k == 0:
+        return nearest
+    positions = np.arange(m, dtype=np.int64)
+    rows = max(1, chunk_cells // m)
+    for start in range(0, n, rows):
+        # Distance and position in one key, so equal distances keep choice order
+        keys = distance_matrix(queries[start:start + rows], choices, workers).astype(np.int64) * m + positions
+        if k < m:
+            top = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(positions, keys.shape)
+        order = np.argsort(np.take_along_axis(keys, top, axis=1), axis=1)
+        nearest[start:start + rows] = np.take_along_axis(top, order, axis=1)
+    return nearest
+
+
+def trigram_keys(names):
+    """
+    Returns the distinct character trigrams of each of names, as uint64 keys of
+    three 21-bit code points, and for each key the position of its name. Names
+    are padded with two spaces in front and one behind.
+    """
+    padded = ['  %s ' % name for name in names]
+    lengths = np.array([len(p) for p in padded], dtype=np.int64)
+    codes = np.frombuffer(''.join(padded).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    name_ids = np.repeat(np.arange(len(padded), dtype=np.int64), lengths)[:-2]
+    keys = (codes[:-2] << np.uint64(42)) | (codes[1:-1] << np.uint64(21)) | codes[2:]
+    # Drop the trigrams running over into the next name, then the repeats within a name
+    within = np.arange(keys.shape[0]) + 2 < np.cumsum(lengths)[name_ids]
+    keys, name_ids = keys[within], name_ids[within]
+    order = np.lexsort((keys, name_ids))
+    keys, name_ids = keys[order], name_ids[order]
+    first = np.ones(keys.shape[0], dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (name_ids[1:] != name_ids[:-1])
+    return keys[first], name_ids[first]
+
+
+def name_distances(query: str, names) -> np.ndarray:
+    if RapidLevenshtein is not None:
+        return cdist([query], names, scorer=RapidLevenshtein.distance, dtype=np.int32, workers=1)[0]
+    return np.array([distance(query, n) for n in names], dtype=np.int32)
+
+
+class TrigramIndex():
+    """
+    Inverted index from character trigrams to a list of distinct names (e.g. the
+    txn_names of cat_data), used to find the names nearest a query without
+    scoring all of them. Trigrams are keyed by their packed code points (see
+    trigram_keys), so the whole index is the arrays in TRIGRAM_ARRAYS, which can
+    be saved and memory-mapped (see categoryindex.CategoryIndex).
+
+    Names added later go to a small delta of (key, name) pairs, searched along
+    with the postings, so adding names costs in proportion to them until the
+    owner of the index folds the delta in with merge_delta().
+    """
+    def __init__(self, names=(), arrays: Optional[Dict[str, np.ndarray]] = None):
+        self.delta_gram_keys = np.empty(0, dtype=np.uint64)
+        self.delta_postings = np.empty(0, dtype=np.int64)
+        self.merged_index = None
+        if arrays is not None:
+            # names may be any sequence with an extend(), e.g. a categoryindex.NameList
+            self.names = names
+            self.gram_keys, self.gram_offsets, self.postings, self.name_grams = [arrays[a] for a in TRIGRAM_ARRAYS]
+            self.base_names = self.name_grams.shape[0]
+            if 'delta_postings' in arrays:
+                self.delta_gram_keys, self.delta_postings = [arrays[a] for a in TRIGRAM_DELTA_ARRAYS]
+                self.name_grams = np.concatenate([self.name_grams, np.bincount(
+                    self.delta_postings - self.base_names, minlength=len(names) - self.base_names)])
+            return
+        self.names = []
+        self.gram_keys = np.empty(0, dtype=np.uint64)
+        self.gram_offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int64)
+        self.name_grams = np.empty(0, dtype=np.int64)
+        self.base_names = 0
+        self.add(names)
+        self.merge_delta()
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return dict({a: getattr(self, a) for a in TRIGRAM_ARRAYS}, name_grams=self.name_grams[:self.base_names])
+
+    def delta_arrays(self) -> Dict[str, np.ndarray]:
+        return {a: getattr(self, a) for a in TRIGRAM_DELTA_ARRAYS}
+
+    def add(self, names):
+        """
+        Adds names, none of which may already be in the index, after the existing
+        ones.
+        """
+        names = list(names)
+        if not names:
+            return
+        first = len(self.names)
+        new_keys, name_ids = trigram_keys(names)
+        name_ids += first
+        keys = np.concatenate([self.delta_gram_keys, new_keys])
+        order = np.argsort(keys, kind='stable')
+        self.delta_gram_keys = keys[order]
+        self.delta_postings = np.concatenate([self.delta_postings, name_ids])[order]
+        self.name_grams = np.concatenate([self.name_grams, np.bincount(name_ids - first, minlength=len(names))])
+        self.names.extend(names)
+        self.merged_index = None
+
+    def merge_delta(self):
+        # Postings: the name ids holding each trigram, one slice per trigram key, in
+        # key order. The existing postings are expanded back to (key, name) pairs
+        # and merged with the delta
+        keys = np.concatenate([np.repeat(self.gram_keys, np.diff(self.gram_offsets)), self.delta_gram_keys])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.postings = np.concatenate([self.postings, self.delta_postings])[order]
+        self.gram_keys, starts = np.unique(keys, return_index=True)
+        self.gram_offsets = np.append(starts, keys.shape[0]).astype(np.int64)
+        self.delta_gram_keys = np.empty(0, dtype=np.uint64)
+        self.delta_postings = np.empty(0, dtype=np.int64)
+        self.base_names = len(self.names)
+        self.merged_index = None
+
+    def merged(self) -> 'TrigramIndex':
+        """
+        Returns the index with its delta merged in (itself if it has none), for
+        searches that need every posting of a trigram in one slice, like
+        tfidfsearch's.
+        """
+        if self.delta_postings.shape[0] == 0:
+            return self
+        if self.merged_index is None:
+            self.merged_index = copy.copy(self)
+            self.merged_index.merge_delta()
+        return self.merged_index
+
+    def candidates(self, query: str, n: int) -> np.ndarray:
+        """
+        Returns the ids of the (up to) n names most similar to query by Jaccard
+        similarity of their trigram sets.
+        """
+        query_keys = trigram_keys([query])[0]
+        hits = []
+        if self.gram_keys.shape[0] > 0:
+            pos = np.minimum(np.searchsorted(self.gram_keys, query_keys), self.gram_keys.shape[0] - 1)
+            hits += [self.postings[self.gram_offsets[i]:self.gram_offsets[i + 1]] for i in pos[self.gram_keys[pos] == query_keys]]
+        starts = np.searchsorted(self.delta_gram_keys, query_keys, side='left')
+        ends = np.searchsorted(self.delta_gram_keys, query_keys, side='right')
+        hits += [self.delta_postings[start:end] for start, end in zip(starts, ends) if end > start]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        hits = np.concatenate(hits)
+        shared = np.bincount(hits, minlength=len(self.names))
+        names = np.flatnonzero(shared)
+        if names.shape[0] <= n:
+            return names
+        shared = shared[names]
+        similarity = shared / (query_keys.shape[0] + self.name_grams[names] - shared)
+        return names[np.argpartition(-similarity, n - 1)[:n]]
+
+    def nearest(self, query: str, candidates: int, k: int = K, name_rows: Optional[np.ndarray] = None,
+                size: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the k nearest rows to query among those of its candidate names,
+        ordered like nearest_neighbours(). name_rows maps each name to its rows,
+        padded with -1, out of size rows; by default each name is a row of its
+        own. Every name is scored if there are no more than candidates of them,
+        or if the candidates hold fewer than k rows.
+        """
+        all_names = np.arange(len(self.names))
+        size = len(self.names) if size is None else size
+        names = self.candidates(query, candidates) if candidates < len(self.names) else all_names
+        rows = names[:, None] if name_rows is None else name_rows[names]
+        if (rows >= 0).sum() < min(k, size):
+            names = all_names
+            rows = names[:, None] if name_rows is None else name_rows
+        dists = name_distances(query, [self.names[i] for i in names])
+        keys = (dists.astype(np.int64)[:, None] * size + rows)[rows >= 0]
+        k = min(k, keys.shape[0])
+        top = np.partition(keys, k - 1)[:k] if k < keys.shape[0] else keys
+        return np.sort(top) % size
+
+
+def normalize_name(name) -> str:
+    """
+    Returns name upper-cased with runs of whitespace collapsed to single spaces.
+    """
+    return ' '.join(str(name).upper().split())
+
+
+def build_prototypes(cat_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compacts cat_data into one prototype per normalized txn_name and category,
+    with the number of training transactions (txn_count) and the latest txn_date
+    (last_seen) among them. Rows with no category are left out, and rows with no
+    txn_date do not count towards last_seen.
+    """
+    cat_data = cat_data[cat_data['txn_cat'].notnull()]
+    dates = cat_data['txn_date'] if 'txn_date' in cat_data.columns else pd.Series(pd.NaT, index=cat_data.index)
+    return (
+        pd.DataFrame({'txn_name_norm': cat_data['txn_name'].map(normalize_name).values,
+                      'txn_cat': cat_data['txn_cat'].astype(object).values,
+                      'txn_date': pd.to_datetime(dates).values})
+        .groupby(['txn_name_norm', 'txn_cat'], sort=False)
+        .agg(txn_count=('txn_date', 'size'), last_seen=('txn_date', 'max'))
+        .reset_index()
+    )
+
+
+def merge_prototypes(prototypes: Optional[pd.DataFrame], new_prototypes: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds new_prototypes (from build_prototypes) to prototypes, summing the counts
+    and keeping the latest last_seen of prototypes they share.
+    """
+    if prototypes is None or prototypes.shape[0] == 0:
+        return new_prototypes
+    merged = pd.concat([prototypes.assign(txn_cat=prototypes['txn_cat'].astype(object)), new_prototypes], ignore_index=True)
+    return (
+        merged.groupby(['txn_name_norm', 'txn_cat'], sort=False)
+        .agg(txn_count=('txn_count', 'sum'), last_seen=('last_seen', 'max'))
+        .reset_index()
+    )
@@ -0,0 +1,442 @@
+#!python3
+"""
+Persistent category index for predict_categories.
+
+A CategoryIndex holds the prototypes of cat_data (see
+categorizer.build_prototypes) the way predict_categories searches them: the
+distinct normalized names, a TrigramIndex over them, and per name and category
+the number of training transactions and the day the pair was last seen. It is
+saved as .npy arrays that are memory-mapped on load, so a run starts predicting
+without reading or re-indexing cat_data, and the prototypes of the rows
+update_training_data appends are added to it in place.
+
+Each transaction takes the votes of its own normalized name's prototypes if it
+has any, without a distance search, and otherwise those of the K distinct names
+nearest it, optionally decayed by age (see votes()). The category with the most
+votes wins, the first in sort order on a tie. Names at the same distance are
+taken in sort order, so the result does not depend on the order names were
+added in.
+
+Nearest is by one of ENGINES: 'levenshtein', the edit distance between names
+(exact, or over a trigram candidate pool), or 'tfidf', the cosine similarity of
+their TF-IDF trigram vectors (see tfidfsearch).
+
+predict() also returns the radius of each transaction, how far its farthest
+neighbour is (0 for a name looked up). Only a name within that radius can join
+or re-vote among its neighbours, so after update_training_data only the
+transactions with one of the names it added rows for within their radius need
+predicting again (see outdated()). This is exact for levenshtein. For tfidf,
+new names also shift the IDF weights of every trigram a little, which
+RADIUS_TOLERANCE allows for. With a half-life, a newer last_seen re-weights
+every vote, which alone re-predicts nothing.
+
+Layout, inside the index folder: a base, then a delta of what was added since,
+folded into the base once it outgrows merge_ratio of it (as in a
+keyindex.KeyIndex), so most saves only rewrite the delta:
+
+    names.npy           the distinct names end to end, as UTF-32 code points
+    name_offsets.npy    where each name starts in names.npy, and where the last ends
+    name_hashes.npy     the 64-bit hash of each name (keyindex.hash_keys), sorted
+    name_hash_ids.npy   the id of the name of each of name_hashes
+    name_order.npy      the name ids in name order
+    counts.npy          training transactions per name (row) and category (column)
+    last_seen.npy       the day each name was last seen with each category
+    gram_keys.npy ...   the TrigramIndex arrays (categorizer.TRIGRAM_ARRAYS)
+
+    delta_names.npy     the names added since, like names.npy, ids following on
+    delta_name_offsets.npy
+    delta_rows.npy      the prototypes added since, as name id, category (its
+    delta_cats.npy      position in the categories of meta.json), count and
+    delta_counts.npy    day last seen
+    delta_last_seen.npy
+    delta_gram_keys.npy ...
+                        the TrigramIndex delta (categorizer.TRIGRAM_DELTA_ARRAYS)
+    meta.json           format version and categories, those of the base counts
+                        (base_categories), plus what the index covers, set by
+                        the owner of the prototypes
+
+Names are looked up by hash with a binary search, and only decoded as they are
+needed (see NameList), so loading the index reads little more than its header.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List, Optional
+from Levenshtein import distance
+import tfidfsearch
+from categorizer import (K, CHUNK_CELLS, TRIGRAM_ARRAYS, TRIGRAM_DELTA_ARRAYS, TrigramIndex, distance_matrix,
+                         nearest_neighbours, normalize_name)
+from journal import atomic_write, write_json
+from keyindex import EMPTY, hash_keys, lookup, merge, write_array
+
+# Bump when the layout changes, saved indexes of other versions are rebuilt
+VERSION = 2
+ARRAYS = ['names', 'name_offsets', 'name_hashes', 'name_hash_ids', 'name_order', 'counts', 'last_seen'] + TRIGRAM_ARRAYS
+DELTA_ARRAYS = (['delta_names', 'delta_name_offsets', 'delta_rows', 'delta_cats', 'delta_counts', 'delta_last_seen']
+                + TRIGRAM_DELTA_ARRAYS)
+# last_seen of a name and category never seen with a date (NaT as days)
+NO_DATE = np.iinfo(np.int64).min
+ENGINES = ['levenshtein', 'tfidf']
+# Slack on tfidf radii, for float32 similarities and the IDF shift of new names
+RADIUS_TOLERANCE = 0.01
+
+
+def encode_names(names):
+    """
+    Returns names end to end as UTF-32 code points, and where each starts (and
+    the last ends) among them.
+    """
+    codes = np.frombuffer(''.join(names).encode('utf-32-le'), dtype=np.uint32)
+    return codes, np.concatenate([[0], np.cumsum([len(name) for name in names], dtype=np.int64)]).astype(np.int64)
+
+
+class NameList():
+    """
+    The names of a CategoryIndex by id: those saved in the base, decoded from
+    their code points one at a time as they are asked for, then those added
+    since.
+    """
+    def __init__(self, codes: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        self.codes = np.empty(0, dtype=np.uint32) if codes is None else codes
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self.saved = self.offsets.shape[0] - 1
+        self.added: List[str] = []
+
+    def __len__(self) -> int:
+        return self.saved + len(self.added)
+
+    def __getitem__(self, i) -> str:
+        i = int(i)
+        if i < self.saved:
+            return self.codes[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-32-le')
+        return self.added[i - self.saved]
+
+    def __iter__(self):
+        text = np.asarray(self.codes).tobytes().decode('utf-32-le')
+        offsets = np.asarray(self.offsets).tolist()
+        yield from (text[start:end] for start, end in zip(offsets[:-1], offsets[1:]))
+        yield from self.added
+
+    def extend(self, names):
+        self.added.extend(names)
+
+    def merge_delta(self):
+        codes, offsets = encode_names(self.added)
+        self.codes = np.concatenate([self.codes, codes])
+        self.offsets = np.concatenate([self.offsets, offsets[1:] + self.offsets[-1]])
+        self.saved = len(self)
+        self.added = []
+
+
+class CategoryIndex():
+    def __init__(self, folder: str, merge_ratio: float = 0.25):
+        self.folder = folder
+        self.merge_ratio = merge_ratio
+        self.paths = {a: '%s/%s.npy' % (folder, a) for a in ARRAYS + DELTA_ARRAYS}
+        self.paths['meta'] = '%s/meta.json' % folder
+        self.meta: Dict = {}
+        self.changed = set()
+        self.clear()
+
+    def clear(self):
+        self.categories = []
+        self.base_categories = []
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+        self.last_seen = np.zeros((0, 0), dtype=np.int64)
+        self.name_order = np.empty(0, dtype=np.int64)
+        self.name_hashes = EMPTY
+        self.name_hash_ids = np.empty(0, dtype=np.int64)
+        self.trigrams = TrigramIndex(NameList(), TrigramIndex().arrays())
+        self.clear_delta()
+
+    def clear_delta(self):
+        self.delta_hashes = EMPTY
+        self.delta_hash_ids = np.empty(0, dtype=np.int64)
+        self.delta_rows = np.empty(0, dtype=np.int64)
+        self.delta_cats = np.empty(0, dtype=np.int64)
+        self.delta_counts = np.empty(0, dtype=np.int64)
+        self.delta_last_seen = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.trigrams.names)
+
+    @property
+    def names(self):
+        return self.trigrams.names
+
+    def load(self) -> bool:
+        """
+        Memory-maps the saved base and reads the delta. Returns False, leaving the
+        index empty, if it has not been saved, or was saved by another VERSION.
+        """
+        if not all(os.path.exists(p) for p in self.paths.values()):
+            return False
+        with open(self.paths['meta']) as f:
+            meta = json.load(f)
+        if meta.get('version') != VERSION:
+            return False
+        arrays = dict({a: np.load(self.paths[a], mmap_mode='r') for a in ARRAYS},
+                      **{a: np.load(self.paths[a]) for a in DELTA_ARRAYS})
+        names = NameList(arrays['names'], arrays['name_offsets'])
+        added = list(NameList(arrays['delta_names'], arrays['delta_name_offsets']))
+        names.extend(added)
+        self.trigrams = TrigramIndex(names, arrays)
+        for a in ['name_hashes', 'name_hash_ids', 'name_order', 'counts', 'last_seen',
+                  'delta_rows', 'delta_cats', 'delta_counts', 'delta_last_seen']:
+            setattr(self, a, arrays[a])
+        self.delta_hashes, self.delta_hash_ids = merge(EMPTY, np.empty(0, dtype=np.int64), hash_keys(added),
+                                                       np.arange(names.saved, len(names), dtype=np.int64))
+        self.categories = meta['categories']
+        self.base_categories = meta['base_categories']
+        self.meta = meta
+        self.changed = set()
+        return True
+
+    def reset(self, prototypes: Optional[pd.DataFrame]):
+        """
+        Rebuilds the index from the full prototypes table, or empties it for None.
+        """
+        self.clear()
+        if prototypes is not None:
+            self.add(prototypes)
+        # Everything goes to the base
+        self.merge_delta()
+
+    def lookup(self, names) -> np.ndarray:
+        """
+        Returns the id of each of names (normalized), or -1 if it is not indexed.
+        """
+        names = np.asarray(names, dtype=object)
+        hashes = hash_keys(names)
+        ids = np.full(hashes.shape[0], -1, dtype=np.int64)
+        for sorted_hashes, sorted_ids in [(self.name_hashes, self.name_hash_ids), (self.delta_hashes, self.delta_hash_ids)]:
+            pos, found = lookup(sorted_hashes, hashes)
+            ids[found] = sorted_ids[pos[found]]
+        # Should two names share a hash, the one looked up is the one indexed
+        hits = np.flatnonzero(ids >= 0)
+        ids[hits[np.array([self.names[ids[i]] != names[i] for i in hits], dtype=bool)]] = -1
+        return ids
+
+    def add(self, prototypes: pd.DataFrame):
+        """
+        Adds prototypes (e.g. those of the rows appended to cat_data), summing the
+        counts and keeping the latest last_seen of those already indexed. They go
+        to the delta, folded into the base once it outgrows merge_ratio of it.
+        """
+        if prototypes.shape[0] == 0:
+            return
+        names = prototypes['txn_name_norm'].astype(object).values
+        cats = prototypes['txn_cat'].astype(object).values
+
+        # New categories are inserted in sort order, new names appended
+        categories = sorted(set(self.categories).union(cats))
+        self.delta_cats = pd.Index(categories).get_indexer(self.categories)[self.delta_cats].astype(np.int64)
+        self.categories = categories
+        new_names = list(pd.unique(names[self.lookup(names) < 0]))
+        if new_names:
+            new_ids = np.arange(len(self), len(self) + len(new_names), dtype=np.int64)
+            self.trigrams.add(new_names)
+            self.delta_hashes, self.delta_hash_ids = merge(self.delta_hashes, self.delta_hash_ids, hash_keys(new_names), new_ids)
+
+        days = pd.to_datetime(prototypes['last_seen']).values.astype('datetime64[D]').astype(np.int64)
+        self.delta_rows = np.concatenate([self.delta_rows, self.lookup(names)])
+        self.delta_cats = np.concatenate([self.delta_cats, pd.Index(categories).get_indexer(cats)]).astype(np.int64)
+        self.delta_counts = np.concatenate([self.delta_counts, prototypes['txn_count'].to_numpy(dtype=np.int64)])
+        self.delta_last_seen = np.concatenate([self.delta_last_seen, days])
+        self.changed.add('delta')
+        if self.delta_rows.shape[0] > self.merge_ratio * self.counts.shape[0]:
+            self.merge_delta()
+
+    def merged_counts(self):
+        """
+        Returns the training transactions and the day last seen of every name (row)
+        and category (column), those of the base with the delta applied.
+        """
+        shape = (len(self), len(self.categories))
+        counts = np.zeros(shape, dtype=np.int64)
+        last_seen = np.full(shape, NO_DATE, dtype=np.int64)
+        columns = pd.Index(self.categories).get_indexer(self.base_categories)
+        counts[:self.counts.shape[0], columns] = self.counts
+        last_seen[:self.last_seen.shape[0], columns] = self.last_seen
+        np.add.at(counts, (self.delta_rows, self.delta_cats), self.delta_counts)
+        np.maximum.at(last_seen, (self.delta_rows, self.delta_cats), self.delta_last_seen)
+        return counts, last_seen
+
+    def merge_delta(self):
+        self.counts, self.last_seen = self.merged_counts()
+        self.base_categories = self.categories
+        self.name_order = self.order()
+        self.name_hashes, self.name_hash_ids = merge(self.name_hashes, self.name_hash_ids, self.delta_hashes, self.delta_hash_ids)
+        self.trigrams.merge_delta()
+        self.names.merge_delta()
+        self.clear_delta()
+        self.changed.update(['base', 'delta'])
+
+    def order(self) -> np.ndarray:
+        """
+        Returns the name ids in name order: the saved name_order, with the names
+        added since inserted where a binary search of it puts them.
+        """
+        added = np.arange(self.name_order.shape[0], len(self), dtype=np.int64)
+        if added.shape[0] == 0:
+            return np.asarray(self.name_order)
+        added = added[np.argsort(np.array([self.names[i] for i in added], dtype=object), kind='stable')]
+        return np.insert(np.asarray(self.name_order), [self.name_rank(self.names[i]) for i in added], added)
+
+    def name_rank(self, name: str) -> int:
+        # Only the names the search visits are decoded
+        lo, hi = 0, self.name_order.shape[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.names[self.name_order[mid]] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def votes(self, half_life_days: float = 0) -> np.ndarray:
+        """
+        Returns the votes of each name for each category: its count, halved for
+        every half_life_days its last_seen is older than the newest last_seen in
+        the index. half_life_days=0 turns decay off; counts never seen with a date
+        are not decayed.
+        """
+        counts, last_seen = self.merged_counts()
+        dated = (last_seen != NO_DATE) & (counts > 0)
+        counts = counts.astype(np.float64)
+        if not half_life_days or not dated.any():
+            return counts
+        age = np.where(dated, last_seen[dated].max() - last_seen, 0)
+        return counts * 0.5 ** (age / half_life_days)
+
+    def neighbours(self, queries, k: int = K, workers: int = -1, candidates: Optional[int] = None,
+                   engine: str = 'levenshtein') -> np.ndarray:
+        """
+        Returns the ids of the k names nearest each of queries (normalized) by
+        engine, nearest first, padded with -1 where an engine finds fewer.
+        candidates, for the levenshtein engine only, scores just that many names
+        per query, picked by a categorizer.TrigramIndex.
+        """
+        # Neighbours are found by position in name order (rank), then mapped back to ids
+        order = self.order()
+        rank = np.empty(len(self), dtype=np.int64)
+        rank[order] = np.arange(len(self))
+        if engine == 'tfidf':
+            return tfidfsearch.tfidf_neighbours(self.trigrams.merged(), queries, rank, k=k)
+        if candidates:
+            nearest = np.array([self.trigrams.nearest(q, candidates, k=k, name_rows=rank[:, None])
+                                for q in queries]).reshape(-1, min(k, len(self)))
+        else:
+            names = list(self.names)
+            nearest = nearest_neighbours(queries, [names[i] for i in order], k=k, workers=workers)
+        return order[nearest]
+
+    def radius(self, queries, nearest: np.ndarray, k: int = K, engine: str = 'levenshtein') -> np.ndarray:
+        """
+        Returns the distance from each of queries (normalized) to the last of its
+        nearest names (see neighbours()): the edit distance for levenshtein, one
+        minus the cosine similarity for tfidf. A query with fewer than k
+        neighbours, which any new name would join, gets inf for levenshtein and 1
+        for tfidf, whose neighbours share a trigram with the query.
+        """
+        last = nearest[:, -1] if nearest.shape[1] == k else np.full(len(queries), -1)
+        full = last >= 0
+        radius = np.full(len(queries), np.inf if engine == 'levenshtein' else 1.0)
+        if full.any():
+            if engine == 'tfidf':
+                radius[full] = 1 - tfidfsearch.pair_similarities(self.trigrams.merged(), queries[full], last[full])
+            else:
+                radius[full] = [distance(q, self.names[i]) for q, i in zip(queries[full], last[full])]
+        return radius
+
+    def outdated(self, txns: pd.DataFrame, names, workers: int = -1, engine: str = 'levenshtein',
+                 chunk_cells: int = CHUNK_CELLS) -> np.ndarray:
+        """
+        Returns which of the predicted transactions txns, with the txn_cat_radius
+        predict() gave them, have one of names (normalized, e.g. those given
+        training rows since) within their radius by engine, so may be predicted
+        differently now. Those without a radius are, as soon as any name is given.
+        """
+        if engine == 'tfidf' and tfidfsearch.sparse is None:
+            engine = 'levenshtein'
+        ids = self.lookup(names)
+        ids = ids[ids >= 0]
+        radius = txns['txn_cat_radius'].astype(np.float64).fillna(np.inf).values
+        if ids.shape[0] == 0 or txns.shape[0] == 0:
+            return np.zeros(txns.shape[0], dtype=bool)
+        queries = txns['txn_name'].map(normalize_name).values
+        outdated = ~np.isfinite(radius)
+        rows = max(1, chunk_cells // ids.shape[0])
+        for start in range(0, len(queries), rows):
+            chunk = slice(start, start + rows)
+            if engine == 'tfidf':
+                similarity = tfidfsearch.similarities(self.trigrams.merged(), queries[chunk], ids)
+                near = (similarity > 0) & (1 - similarity <= radius[chunk, None] + RADIUS_TOLERANCE)
+            else:
+                near = distance_matrix(queries[chunk], [self.names[i] for i in ids], workers=workers) <= radius[chunk, None]
+            outdated[chunk] |= near.any(axis=1)
+        return outdated
+
+    def predict(self, uncat_txns: pd.DataFrame, k: int = K, workers: int = -1, candidates: Optional[int] = None,
+                half_life_days: float = 0, engine: str = 'levenshtein') -> pd.DataFrame:
+        """
+        Picks a category for each uncategorized transaction (see the module
+        docstring), searching with engine for the neighbours of those whose name
+        is not indexed. Returns txn_id, txn_name, txn_cat_new and txn_cat_radius
+        (see radius()), sorted by txn_id.
+        """
+        if engine == 'tfidf' and tfidfsearch.sparse is None:
+            print("scipy is not installed, predicting categories with the levenshtein engine")
+            engine = 'levenshtein'
+        uncat_txns = uncat_txns.drop_duplicates(subset=['txn_id']).sort_values('txn_id')
+        if len(self) == 0:
+            return pd.DataFrame({'txn_id': [], 'txn_name': [], 'txn_cat_new': [], 'txn_cat_radius': []})
+
+        name_votes = self.votes(half_life_days)
+        queries = uncat_txns['txn_name'].map(normalize_name).values
+        exact = self.lookup(queries)
+        hit = exact >= 0
+        votes = np.zeros((len(queries), len(self.categories)))
+        votes[hit] = name_votes[exact[hit]]
+        radius = np.zeros(len(queries))
+        if not hit.all():
+            nearest = self.neighbours(queries[~hit], k=k, workers=workers, candidates=candidates, engine=engine)
+            votes[~hit] = (name_votes[nearest] * (nearest >= 0)[:, :, None]).sum(axis=1)
+            radius[~hit] = self.radius(queries[~hit], nearest, k=k, engine=engine)
+
+        winners = votes.argmax(axis=1)
+        winners[votes.max(axis=1) <= 0] = -1
+        return pd.DataFrame({
+            'txn_id': uncat_txns['txn_id'].values,
+            'txn_name': uncat_txns['txn_name'].values,
+            'txn_cat_new': np.append(np.asarray(self.categories, dtype=object), None)[winners],
+            'txn_cat_radius': radius,
+        })
+
+    def save(self, stage: Optional[Callable[[str], str]] = None):
+        """
+        Writes the parts of the index changed since it was loaded (usually only
+        the delta), and its metadata. With stage (e.g. Journal.stage) each file is
+        written to the path it returns and committed by the caller; otherwise each
+        file is replaced atomically.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        self.meta.update({'version': VERSION, 'categories': self.categories, 'base_categories': self.base_categories})
+        arrays = {}
+        if 'base' in self.changed or not all(os.path.exists(self.paths[a]) for a in ARRAYS):
+            arrays.update(self.trigrams.arrays(), names=self.names.codes, name_offsets=self.names.offsets)
+            arrays.update({a: getattr(self, a) for a in ['name_hashes', 'name_hash_ids', 'name_order', 'counts', 'last_seen']})
+        if 'delta' in self.changed or not all(os.path.exists(self.paths[a]) for a in DELTA_ARRAYS):
+            delta_names, delta_name_offsets = encode_names(self.names.added)
+            arrays.update(self.trigrams.delta_arrays(), delta_names=delta_names, delta_name_offsets=delta_name_offsets)
+            arrays.update({a: getattr(self, a) for a in ['delta_rows', 'delta_cats', 'delta_counts', 'delta_last_seen']})
+        writes = [(self.paths[a], lambda p, arr=arr: write_array(p, np.asarray(arr))) for a, arr in arrays.items()]
+        writes.append((self.paths['meta'], lambda p: write_json(p, self.meta)))
+        for path, write in writes:
+            if stage is not None:
+                write(stage(path))
+            else:
+                atomic_write(path, write)
+        self.changed = set()
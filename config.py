@@ -9,13 +9,37 @@ secret = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
 public_key = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
 environment = development
 suppress_warnings=true
+; optional, overrides the environment's URL (e.g. a local fake Plaid server)
+; host = http://127.0.0.1:8090
+; optional, transaction pages requested at once per account (default 4)
+; page_concurrency = 4
+; optional, retries of rate-limited or transient failures per read request (default 5);
+; link and token exchange requests are never retried
+; max_retries = 5
+; optional, requests per minute per endpoint, on top of DEFAULT_RATE_LIMITS
+; rate_limits = transactions_get:120, accounts_balance_get:60
 
 [plaid-sync]
 dbfile = /data/transactions
+backend = parquet
+snapshot_retention = 10
+sync_mode = get
+sync_workers = 4
+; optional, candidate names scored per transaction when predicting categories,
+; 0 (the default) scores every training transaction
+predict_candidates = 0
+; optional, days after which the votes of a merchant's category count half when
+; predicting categories, 0 (the default) never decays them
+predict_half_life = 0
+; optional, how the nearest merchants are found when predicting categories:
+; levenshtein (the default) or tfidf, which needs scipy
+predict_engine = levenshtein
 
 [Account1]
 access_token = access-development-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
 account = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
+; optional, false reads balances from the cheaper cached /accounts/get
+realtime_balance = true
 
 [Account2]
 ....
@@ -24,6 +48,17 @@ import configparser
 import time
 import shutil
 
+# Requests per minute allowed to each Plaid endpoint, across all items. Endpoints
+# not listed are not throttled. Rates back off on RATE_LIMIT_EXCEEDED and recover
+# while requests succeed (see plaidapi.RequestScheduler), so these only need to be
+# in the right range.
+DEFAULT_RATE_LIMITS = {
+    'transactions_get': 120,
+    'transactions_sync': 120,
+    'accounts_balance_get': 60,
+    'accounts_get': 120,
+}
+
 
 class Config:
     def __init__(self, config_file: str):
@@ -37,8 +72,24 @@ class Config:
             'secret': self.config['PLAID']['secret'],
             'environment': self.config['PLAID'].get('environment', 'sandbox'),
             'suppress_warnings': self.config['PLAID'].get('suppress_warnings', True),
+            'host': self.config['PLAID'].get('host'),
+            'page_concurrency': self.config['PLAID'].getint('page_concurrency', 4),
+            'max_retries': self.config['PLAID'].getint('max_retries', 5),
+            'rate_limits': self.get_rate_limits(),
         }
 
+    def get_rate_limits(self) -> dict:
+        """
+        Requests per minute allowed per Plaid endpoint: DEFAULT_RATE_LIMITS,
+        overridden by the comma-separated endpoint:rate pairs of rate_limits.
+        """
+        limits = dict(DEFAULT_RATE_LIMITS)
+        for pair in self.config['PLAID'].get('rate_limits', '').split(','):
+            if pair.strip():
+                endpoint, rate = pair.split(':')
+                limits[endpoint.strip()] = float(rate)
+        return limits
+
     @property
     def environment(self):
         return self.config['PLAID']['environment']
@@ -46,6 +97,66 @@ class Config:
     def get_dbfiles(self) -> str:
         return self.config['plaid-sync']['dbfile_win'], self.config['plaid-sync']['dbfile_mac']
 
+    def get_db_backend(self) -> str:
+        """
+        Storage backend used for the transactions database, either 'parquet'
+        (the default, one parquet file per table) or 'sqlite'.
+        """
+        backend = self.config['plaid-sync'].get('backend', 'parquet')
+        if backend not in ('parquet', 'sqlite'):
+            raise ValueError("Unknown backend [%s] in [plaid-sync], expected parquet or sqlite" % backend)
+        return backend
+
+    def get_snapshot_retention(self) -> int:
+        """
+        Number of snapshot versions kept of each table. 0 keeps every version.
+        """
+        return self.config['plaid-sync'].getint('snapshot_retention', 10)
+
+    def get_sync_mode(self) -> str:
+        """
+        How transactions are fetched from Plaid: 'get' (the default) re-reads the
+        start_date..end_date window with /transactions/get, 'sync' pulls only the
+        changes since the last run with /transactions/sync.
+        """
+        mode = self.config['plaid-sync'].get('sync_mode', 'get')
+        if mode not in ('get', 'sync'):
+            raise ValueError("Unknown sync_mode [%s] in [plaid-sync], expected get or sync" % mode)
+        return mode
+
+    def get_sync_workers(self) -> int:
+        """
+        Number of accounts fetched from Plaid at the same time.
+        """
+        return max(1, self.config['plaid-sync'].getint('sync_workers', 4))
+
+    def get_predict_candidates(self) -> int:
+        """
+        Number of candidate training names, picked by a trigram index, scored per
+        transaction when predicting categories. 0 (the default) scores all of them,
+        which is exact but grows with the training data.
+        """
+        return max(0, self.config['plaid-sync'].getint('predict_candidates', 0))
+
+    def get_predict_half_life(self) -> float:
+        """
+        Half-life in days of the category votes of training transactions, counted
+        from the last time a merchant was seen with a category. 0 (the default)
+        turns decay off.
+        """
+        return max(0.0, self.config['plaid-sync'].getfloat('predict_half_life', 0))
+
+    def get_predict_engine(self) -> str:
+        """
+        How the merchants nearest an uncategorized transaction are found, either
+        'levenshtein' (the default, edit distance) or 'tfidf' (cosine similarity
+        of character trigram TF-IDF vectors).
+        """
+        engine = self.config['plaid-sync'].get('predict_engine', 'levenshtein')
+        if engine not in ('levenshtein', 'tfidf'):
+            raise ValueError("Unknown predict_engine [%s] in [plaid-sync], expected levenshtein or tfidf" % engine)
+        return engine
+
     def get_all_config_sections(self) -> str:
         """
         Returns all defined configuration sections, not just accounts
@@ -72,6 +183,14 @@ class Config:
     def get_account_access_token(self, account_name: str) -> str:
         return self.config[account_name]['access_token']
 
+    def get_account_realtime_balance(self, account_name: str) -> bool:
+        """
+        Whether balances for this account are fetched in real time from
+        /accounts/balance/get (the default), or taken from Plaid's cache with
+        /accounts/get.
+        """
+        return self.config[account_name].getboolean('realtime_balance', True)
+
     def add_account(self, account_name: str, access_token: str):
         """
         Saves an account and its credentials to the configuration file.
@@ -0,0 +1,417 @@
+#!python3
+"""
+A local stand-in for the Plaid API endpoints plaid-sync uses, serving
+deterministic synthetic data, so syncs can be run and timed without Plaid
+credentials.
+
+Items are numbered 0..items-1 and linked with the access token
+access-fake-<item>. Each has accounts_per_item accounts and
+transactions_per_item transactions spread evenly over the days before
+anchor_date, newest first like Plaid. Transactions are generated from their
+index when a page is requested, never held in memory, so 50 items of 100k
+transactions cost nothing to serve until they are asked for.
+
+/transactions/sync first sends every transaction as added. Each later call,
+from the cursor it ended on, reports a seeded round of changes: modified_per_sync
+transactions with a new amount and name, and removed_per_sync removed ones
+(never the same transaction twice, nor one removed earlier), so the modified
+and removed paths of a sync can be run against the fake.
+
+Latency (per request, or per endpoint) and error injection (a fraction of
+requests failing with the given Plaid errors) are configurable.
+
+Run it and point a config at it with the [PLAID] host setting, which
+--write-config does for every item:
+
+    $ ./fakeplaid.py --items 50 --transactions 100000 --latency 0.2 --write-config config/fake
+
+or start it in-process with start(FakePlaid(FakePlaidData(...))).
+"""
+
+import argparse
+import configparser
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+MERCHANTS = [
+    ('STARBUCKS', 'FOOD_AND_DRINK', 'FOOD_AND_DRINK_COFFEE'),
+    ('CHIPOTLE', 'FOOD_AND_DRINK', 'FOOD_AND_DRINK_FAST_FOOD'),
+    ('KROGER', 'FOOD_AND_DRINK', 'FOOD_AND_DRINK_GROCERIES'),
+    ('WHOLE FOODS MARKET', 'FOOD_AND_DRINK', 'FOOD_AND_DRINK_GROCERIES'),
+    ('SHELL OIL', 'TRANSPORTATION', 'TRANSPORTATION_GAS'),
+    ('UBER TRIP', 'TRANSPORTATION', 'TRANSPORTATION_TAXIS_AND_RIDE_SHARES'),
+    ('AMAZON MKTPL', 'GENERAL_MERCHANDISE', 'GENERAL_MERCHANDISE_ONLINE_MARKETPLACES'),
+    ('TARGET', 'GENERAL_MERCHANDISE', 'GENERAL_MERCHANDISE_SUPERSTORES'),
+    ('NETFLIX.COM', 'ENTERTAINMENT', 'ENTERTAINMENT_TV_AND_MOVIES'),
+    ('SPOTIFY USA', 'ENTERTAINMENT', 'ENTERTAINMENT_MUSIC_AND_AUDIO'),
+    ('COMCAST CABLE', 'RENT_AND_UTILITIES', 'RENT_AND_UTILITIES_INTERNET_AND_CABLE'),
+    ('DUKE ENERGY', 'RENT_AND_UTILITIES', 'RENT_AND_UTILITIES_GAS_AND_ELECTRICITY'),
+    ('CVS PHARMACY', 'MEDICAL', 'MEDICAL_PHARMACIES_AND_SUPPLEMENTS'),
+    ('DELTA AIR LINES', 'TRAVEL', 'TRAVEL_FLIGHTS'),
+    ('MARRIOTT HOTEL', 'TRAVEL', 'TRAVEL_LODGING'),
+    ('VENMO PAYMENT', 'TRANSFER_OUT', 'TRANSFER_OUT_ACCOUNT_TRANSFER'),
+]
+CITIES = ['ATLANTA GA', 'AUSTIN TX', 'DENVER CO', 'SEATTLE WA', 'CHICAGO IL', 'BOSTON MA']
+
+
+class FakePlaidData():
+    def __init__(self, items: int = 5, accounts_per_item: int = 2, transactions_per_item: int = 1000,
+                 days: int = 730, seed: int = 0, anchor_date: Optional[datetime.date] = None,
+                 modified_per_sync: int = 5, removed_per_sync: int = 2):
+        self.items = items
+        self.modified_per_sync = modified_per_sync
+        self.removed_per_sync = removed_per_sync
+        self.accounts_per_item = accounts_per_item
+        self.transactions_per_item = transactions_per_item
+        self.days = days
+        self.seed = seed
+        self.anchor_date = anchor_date or datetime.date.today()
+
+    def rng(self, *key) -> random.Random:
+        n = self.seed
+        for k in key:
+            n = n * 1000003 + k
+        return random.Random(n)
+
+    def item_of(self, access_token: str) -> Optional[int]:
+        try:
+            item = int(access_token.rsplit('-', 1)[1])
+        except (AttributeError, IndexError, ValueError):
+            return None
+        return item if 0 <= item < self.items else None
+
+    def account_id(self, item: int, account: int) -> str:
+        return 'fake%04dacct%02d' % (item, account)
+
+    def account(self, item: int, account: int) -> Dict:
+        rng = self.rng(item, account, 1)
+        credit = account % 2 == 1
+        current = round(rng.uniform(100, 5000), 2)
+        return {
+            'account_id': self.account_id(item, account),
+            'balances': {
+                'available': None if credit else current,
+                'current': current,
+                'limit': 10000.0 if credit else None,
+                'iso_currency_code': 'USD',
+                'unofficial_currency_code': None,
+            },
+            'mask': '%04d' % rng.randrange(10000),
+            'name': '%s %d' % ('Credit Card' if credit else 'Checking', item),
+            'official_name': 'Fake Bank %s %d' % ('Rewards Card' if credit else 'Checking', item),
+            'type': 'credit' if credit else 'depository',
+            'subtype': 'credit card' if credit else 'checking',
+        }
+
+    def accounts(self, item: int) -> List[Dict]:
+        return [self.account(item, a) for a in range(self.accounts_per_item)]
+
+    def day_offset(self, i: int) -> int:
+        return i * self.days // self.transactions_per_item
+
+    def index_range(self, start_date: datetime.date, end_date: datetime.date) -> Tuple[int, int]:
+        """
+        Indexes [lo, hi) of the transactions dated start_date..end_date. Dates only
+        move back as the index grows, so the range is worked out, not searched for.
+        """
+        n, days = self.transactions_per_item, self.days
+        d_lo = max(0, (self.anchor_date - end_date).days)
+        d_hi = (self.anchor_date - start_date).days
+        if d_hi < d_lo:
+            return 0, 0
+        lo = min(n, -(-d_lo * n // days))
+        hi = min(n, -(-(d_hi + 1) * n // days))
+        return lo, hi
+
+    def transaction(self, item: int, i: int) -> Dict:
+        rng = self.rng(item, i, 2)
+        merchant, primary, detailed = MERCHANTS[rng.randrange(len(MERCHANTS))]
+        day = self.day_offset(i)
+        date = (self.anchor_date - datetime.timedelta(days=day)).isoformat()
+        return {
+            'account_id': self.account_id(item, rng.randrange(self.accounts_per_item)),
+            'amount': round(rng.lognormvariate(3, 1), 2),
+            'iso_currency_code': 'USD',
+            'unofficial_currency_code': None,
+            'category': None,
+            'category_id': None,
+            'date': date,
+            'location': {'address': None, 'city': None, 'region': None, 'postal_code': None,
+                         'country': None, 'lat': None, 'lon': None, 'store_number': None},
+            'name': '%s #%d %s' % (merchant, rng.randrange(1, 300), rng.choice(CITIES)),
+            'payment_meta': {'reference_number': None, 'ppd_id': None, 'payee': None, 'by_order_of': None,
+                             'payer': None, 'payment_method': None, 'payment_processor': None, 'reason': None},
+            'pending': day < 3 and rng.random() < 0.3,
+            'pending_transaction_id': None,
+            'account_owner': None,
+            'transaction_id': 'fake%04dtxn%09d' % (item, i),
+            'authorized_date': date,
+            'authorized_datetime': None,
+            'datetime': None,
+            'payment_channel': 'in store',
+            'transaction_code': None,
+            'merchant_name': merchant.title(),
+            'transaction_type': 'place',
+            'personal_finance_category': {'primary': primary, 'detailed': detailed},
+        }
+
+    def changes(self, item: int, rounds: int) -> Tuple[List[int], List[int]]:
+        """
+        Indexes of the transactions modified and removed in round rounds - 1 of
+        changes after the initial sync. Earlier rounds are replayed so a
+        transaction is removed at most once and never modified after.
+        """
+        removed_before = set()
+        modified, removed = [], []
+        for r in range(rounds):
+            rng = self.rng(item, r, 3)
+            live = self.transactions_per_item - len(removed_before)
+            picks = []
+            while len(picks) < min(self.modified_per_sync + self.removed_per_sync, live):
+                i = rng.randrange(self.transactions_per_item)
+                if i not in removed_before and i not in picks:
+                    picks.append(i)
+            modified, removed = picks[:self.modified_per_sync], picks[self.modified_per_sync:]
+            removed_before.update(removed)
+        return modified, removed
+
+    def modified_transaction(self, item: int, i: int, rounds: int) -> Dict:
+        txn = self.transaction(item, i)
+        rng = self.rng(item, i, rounds, 4)
+        txn['amount'] = round(txn['amount'] + rng.uniform(-5, 5), 2)
+        txn['name'] = '%s ADJ%d' % (txn['name'], rounds)
+        txn['pending'] = False
+        return txn
+
+    def item(self, item: int) -> Dict:
+        return {
+            'item_id': 'fakeitem%04d' % item,
+            'webhook': None,
+            'error': None,
+            'available_products': ['balance'],
+            'billed_products': ['transactions'],
+            'consent_expiration_time': None,
+            'update_type': 'background',
+        }
+
+
+class FakePlaidError(Exception):
+    def __init__(self, status: int, error_type: str, error_code: str):
+        super().__init__(error_code)
+        self.status = status
+        self.error_type = error_type
+        self.error_code = error_code
+
+
+# error_code: (HTTP status, error_type) of the errors that can be injected
+ERRORS = {
+    'RATE_LIMIT_EXCEEDED': (429, 'RATE_LIMIT_EXCEEDED'),
+    'PRODUCT_NOT_READY': (400, 'ITEM_ERROR'),
+    'INSTITUTION_DOWN': (400, 'INSTITUTION_ERROR'),
+    'INTERNAL_SERVER_ERROR': (500, 'API_ERROR'),
+    'ITEM_LOGIN_REQUIRED': (400, 'ITEM_ERROR'),
+}
+
+
+class FakePlaid():
+    """
+    Handles the Plaid endpoints against a FakePlaidData. latency is seconds per
+    request, or a dict of seconds per endpoint path ('*' for the rest).
+    error_rate of the requests fail with one of errors, picked by a seeded random
+    generator so runs are repeatable.
+    """
+    def __init__(self, data: FakePlaidData, latency=0.0, error_rate: float = 0.0,
+                 errors: Optional[List[str]] = None, seed: int = 0):
+        self.data = data
+        self.latency = latency if isinstance(latency, dict) else {'*': latency}
+        self.error_rate = error_rate
+        self.errors = errors or ['RATE_LIMIT_EXCEEDED']
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.routes = {
+            '/link/token/create': self.link_token_create,
+            '/item/public_token/exchange': self.item_public_token_exchange,
+            '/accounts/balance/get': self.accounts_get,
+            '/accounts/get': self.accounts_get,
+            '/transactions/get': self.transactions_get,
+            '/transactions/sync': self.transactions_sync,
+        }
+
+    def handle(self, path: str, body: Dict) -> Dict:
+        if path not in self.routes:
+            raise FakePlaidError(404, 'INVALID_REQUEST', 'UNKNOWN_ENDPOINT')
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            error_code = self.random.choice(self.errors) if fail else None
+        time.sleep(self.latency.get(path, self.latency.get('*', 0.0)))
+        if error_code:
+            raise FakePlaidError(*ERRORS[error_code], error_code)
+        response = self.routes[path](body)
+        response['request_id'] = uuid.uuid4().hex[:15]
+        return response
+
+    def item_for(self, body: Dict) -> int:
+        item = self.data.item_of(body.get('access_token'))
+        if item is None:
+            raise FakePlaidError(400, 'INVALID_INPUT', 'INVALID_ACCESS_TOKEN')
+        return item
+
+    def link_token_create(self, body: Dict) -> Dict:
+        return {'link_token': 'link-fake-%s' % uuid.uuid4().hex, 'expiration': '2099-01-01T00:00:00Z'}
+
+    def item_public_token_exchange(self, body: Dict) -> Dict:
+        # public-fake-<item> exchanges for that item, anything else links item 0
+        item = self.data.item_of(body.get('public_token')) or 0
+        return {'access_token': 'access-fake-%d' % item, 'item_id': 'fakeitem%04d' % item}
+
+    def accounts_get(self, body: Dict) -> Dict:
+        item = self.item_for(body)
+        return {'accounts': self.data.accounts(item), 'item': self.data.item(item)}
+
+    def transactions_get(self, body: Dict) -> Dict:
+        item = self.item_for(body)
+        options = body.get('options') or {}
+        count = min(500, options.get('count', 100))
+        offset = options.get('offset', 0)
+        lo, hi = self.data.index_range(datetime.date.fromisoformat(body['start_date']),
+                                       datetime.date.fromisoformat(body['end_date']))
+        return {
+            'accounts': self.data.accounts(item),
+            'transactions': [self.data.transaction(item, i) for i in range(lo + offset, min(hi, lo + offset + count))],
+            'total_transactions': hi - lo,
+            'item': self.data.item(item),
+        }
+
+    def transactions_sync(self, body: Dict) -> Dict:
+        # The cursor is the number of transactions already sent, oldest first, then
+        # <sent>:<rounds> once they all are, counting the rounds of changes sent since
+        item = self.item_for(body)
+        n = self.data.transactions_per_item
+        sent, _, rounds = (body.get('cursor') or '0').partition(':')
+        sent, rounds = int(sent), int(rounds or 0)
+        if sent >= n:
+            modified, removed = self.data.changes(item, rounds + 1)
+            return {
+                'added': [],
+                'modified': [self.data.modified_transaction(item, i, rounds + 1) for i in modified],
+                'removed': [{'transaction_id': self.data.transaction(item, i)['transaction_id']} for i in removed],
+                'next_cursor': '%d:%d' % (sent, rounds + 1),
+                'has_more': False,
+            }
+        count = min(500, body.get('count', 100))
+        added = [self.data.transaction(item, n - 1 - i) for i in range(sent, min(n, sent + count))]
+        sent += len(added)
+        return {'added': added, 'modified': [], 'removed': [], 'next_cursor': str(sent), 'has_more': sent < n}
+
+
+class FakePlaidHandler(BaseHTTPRequestHandler):
+    def __init__(self, fake: FakePlaid, *args, **kwargs):
+        self.fake = fake
+        super().__init__(*args, **kwargs)
+
+    def log_request(self, code=None, size=None) -> None:
+        pass
+
+    def send_json(self, status: int, obj: Dict):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        cl = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(cl) or b'{}')
+        try:
+            self.send_json(200, self.fake.handle(self.path.split("?")[0], body))
+        except FakePlaidError as ex:
+            self.send_json(ex.status, {
+                'error_type': ex.error_type,
+                'error_code': ex.error_code,
+                'error_message': 'injected by fakeplaid',
+                'display_message': None,
+                'request_id': uuid.uuid4().hex[:15],
+            })
+
+
+def start(fake: FakePlaid, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serves fake on a background thread and returns the server; its URL is
+    http://<host>:<server.server_address[1]>. Stop it with server.shutdown().
+    """
+    def make_handler(*args, **kwargs):
+        return FakePlaidHandler(fake, *args, **kwargs)
+
+    httpd = ThreadingHTTPServer((host, port), make_handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def write_config(path: str, url: str, items: int, dbfolder: str):
+    """
+    Writes a plaid-sync config with every fake item linked, talking to url.
+    """
+    cfg = configparser.ConfigParser()
+    cfg['PLAID'] = {'client_id': 'fake', 'secret': 'fake', 'environment': 'sandbox', 'host': url}
+    cfg['plaid-sync'] = {'dbfile_win': dbfolder, 'dbfile_mac': dbfolder}
+    for item in range(items):
+        cfg['Fake%04d' % item] = {'access_token': 'access-fake-%d' % item}
+    with open(path, 'w') as f:
+        cfg.write(f)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Serve fake Plaid endpoints with synthetic data")
+    parser.add_argument("--port",             dest="port",          type=int,   default=8090,  help="Port to listen on, defaults to 8090.")
+    parser.add_argument("--items",            dest="items",         type=int,   default=5,     help="Number of linked items.")
+    parser.add_argument("--accounts",         dest="accounts",      type=int,   default=2,     help="Accounts per item.")
+    parser.add_argument("--transactions",     dest="transactions",  type=int,   default=1000,  help="Transactions per item.")
+    parser.add_argument("--days",             dest="days",          type=int,   default=730,   help="Days of history the transactions are spread over.")
+    parser.add_argument("--seed",             dest="seed",          type=int,   default=0,     help="Seed of the synthetic data and error injection.")
+    parser.add_argument("--modified",         dest="modified",      type=int,   default=5,     help="Transactions modified per /transactions/sync after the initial one.")
+    parser.add_argument("--removed",          dest="removed",       type=int,   default=2,     help="Transactions removed per /transactions/sync after the initial one.")
+    parser.add_argument("--latency",          dest="latency",       type=float, default=0.0,   help="Seconds added to every request.")
+    parser.add_argument("--balance-latency",  dest="balance_latency", type=float,              help="Seconds added to /accounts/balance/get instead.")
+    parser.add_argument("--error-rate",       dest="error_rate",    type=float, default=0.0,   help="Fraction of requests that fail.")
+    parser.add_argument("--errors",           dest="errors",        default="RATE_LIMIT_EXCEEDED",
+                        help="Comma-separated error codes to inject, from: %s" % ", ".join(ERRORS))
+    parser.add_argument("--write-config",     dest="write_config",                             help="Write a plaid-sync config linking every item to this path.")
+    parser.add_argument("--dbfolder",         dest="dbfolder",      default="/tmp/fakeplaid-db", help="Database folder for --write-config.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_options()
+    latency = {'*': args.latency}
+    if args.balance_latency is not None:
+        latency['/accounts/balance/get'] = args.balance_latency
+    fake = FakePlaid(
+        FakePlaidData(items=args.items, accounts_per_item=args.accounts, transactions_per_item=args.transactions,
+                      days=args.days, seed=args.seed, modified_per_sync=args.modified, removed_per_sync=args.removed),
+        latency=latency,
+        error_rate=args.error_rate,
+        errors=args.errors.split(','),
+        seed=args.seed,
+    )
+    httpd = start(fake, port=args.port)
+    url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    if args.write_config:
+        write_config(args.write_config, url, args.items, args.dbfolder)
+        print("Wrote config for %d items to %s" % (args.items, args.write_config))
+    print("Fake Plaid listening on %s" % url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received, exiting.")
+        httpd.shutdown()
@@ -92,7 +92,7 @@ class GSheetSynchronizer():
         self.db.update_gsheet_txns(gsheet_txns)
     
     def push_gsheet_txns(self):
-        processed_txns = pd.read_parquet(self.db.paths['processed_txns'])
+        processed_txns = self.db.get_processed_transactions()
         account_ref = pd.read_excel(self.db.paths['account_ref'])
         updated_txns = (
             processed_txns
@@ -0,0 +1,120 @@
+#!python3
+"""
+Crash-safe file writes for the parquet database folder.
+
+A single file is replaced atomically by writing it to a hidden staging file
+next to it, flushing it to disk and renaming it over the original, so readers
+(and a sync client like Google Drive) only ever see the old or the new file.
+
+A Journal groups the replacement of several files into one commit:
+
+    1. every new file is written to a staging path in the .staging folder
+    2. journal.json, listing each staging path and its destination, is written
+       atomically; this is the commit point
+    3. each staging file is renamed over its destination, then the journal is
+       removed
+
+On startup, recover() finishes the renames of a committed journal, or removes
+the staging files of a commit that never reached step 2, so the tables are
+always either all old or all new. Only the .staging folder is looked in, never
+the rest of the database folder. A single atomic_write() cut short by a crash
+may leave its hidden staging file behind, which readers ignore.
+"""
+
+import os
+import json
+import uuid
+from typing import Callable, List, Tuple
+
+
+def staging_path(path: str, tag: str) -> str:
+    # Leading dot keeps staging files out of pyarrow dataset discovery
+    folder, name = os.path.split(path)
+    return os.path.join(folder, '.%s.%s.pending' % (name, tag))
+
+
+def fsync_file(path: str):
+    # Opened for writing because Windows refuses to flush a read-only handle
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+def write_json(path: str, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=1)
+
+
+def atomic_write(path: str, write: Callable[[str], None]):
+    """
+    Calls write() with a staging path, flushes the result to disk and renames it
+    over path.
+    """
+    tmp = staging_path(path, uuid.uuid4().hex[:8])
+    try:
+        write(tmp)
+        fsync_file(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Journal():
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = folder + '/journal.json'
+        self.staging = folder + '/.staging'
+        self.txid = None
+        self.entries: List[Tuple[str, str]] = []
+
+    def begin(self):
+        self.txid = uuid.uuid4().hex[:8]
+        self.entries = []
+
+    def stage(self, path: str) -> str:
+        """
+        Returns the staging path the new contents of path should be written to.
+        """
+        os.makedirs(self.staging, exist_ok=True)
+        # Numbered, as files in different folders may share a name
+        tmp = '%s/%s.%d.%s.pending' % (self.staging, self.txid, len(self.entries), os.path.basename(path))
+        self.entries.append((tmp, path))
+        return tmp
+
+    def commit(self):
+        if not self.entries:
+            return
+        for tmp, _ in self.entries:
+            fsync_file(tmp)
+
+        record = {'txid': self.txid, 'entries': self.entries}
+        atomic_write(self.path, lambda p: write_json(p, record))
+
+        self.apply(self.entries)
+        os.remove(self.path)
+        self.entries = []
+
+    def apply(self, entries):
+        for tmp, path in entries:
+            if os.path.exists(tmp):
+                os.replace(tmp, path)
+
+    def recover(self) -> bool:
+        """
+        Completes a commit interrupted after its journal was written, and deletes
+        staging files left by commits that never got that far. Returns True if a
+        commit was rolled forward.
+        """
+        rolled_forward = False
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                record = json.load(f)
+            print("Recovering interrupted write of %d tables from %s" % (len(record['entries']), self.path))
+            self.apply(record['entries'])
+            os.remove(self.path)
+            rolled_forward = True
+
+        if os.path.isdir(self.staging):
+            for f in os.listdir(self.staging):
+                os.remove(os.path.join(self.staging, f))
+        return rolled_forward
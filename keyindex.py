@@ -0,0 +1,236 @@
+#!python3
+"""
+Persistent key indexes for the TransactionsDB tables.
+
+A KeyIndex holds a 64-bit hash of every key in a table (txn_id, or
+account_id|bal_date for balances), so a batch of incoming rows is checked for
+membership by binary search, in time proportional to the batch rather than to
+the table. With 64-bit hashes the chance of two distinct keys colliding is
+about n^2/2^65, under one in ten million for a million keys.
+
+The hashes are kept as a large sorted base array plus a small sorted delta of
+the keys added since the base was last written. The delta is folded into the
+base once it outgrows merge_ratio of it, so most writes only rewrite the delta.
+
+An index created with_values also maps each key to a non-negative int64 value
+(e.g. where the row is stored), kept in arrays aligned with the hashes. Adding a
+key again with another value records it in the delta, which takes precedence
+over the base. Removing a key records it in the delta with the value -1, a
+tombstone dropped when the delta is folded into the base.
+
+Layout, inside the index folder:
+
+    <table>.base.npy
+    <table>.delta.npy
+    <table>.base_values.npy     with_values only
+    <table>.delta_values.npy    with_values only
+    <table>.json                what the index covers, set by the owner of the table
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, Optional
+from journal import atomic_write, write_json
+
+EMPTY = np.empty(0, dtype=np.uint64)
+
+
+def hash_keys(keys) -> np.ndarray:
+    keys = np.asarray(keys, dtype=object)
+    if keys.shape[0] == 0:
+        return EMPTY
+    return pd.util.hash_array(keys.astype(str).astype(object))
+
+
+def search(sorted_hashes: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    if sorted_hashes.shape[0] == 0:
+        return np.zeros(hashes.shape[0], dtype=bool)
+    pos = np.searchsorted(sorted_hashes, hashes)
+    pos[pos == sorted_hashes.shape[0]] = 0
+    return sorted_hashes[pos] == hashes
+
+
+def lookup(sorted_hashes: np.ndarray, hashes: np.ndarray):
+    """
+    Returns the position of each of hashes in sorted_hashes, and whether it was found.
+    """
+    if sorted_hashes.shape[0] == 0:
+        return np.zeros(hashes.shape[0], dtype=np.int64), np.zeros(hashes.shape[0], dtype=bool)
+    pos = np.searchsorted(sorted_hashes, hashes)
+    pos[pos == sorted_hashes.shape[0]] = 0
+    return pos, sorted_hashes[pos] == hashes
+
+
+def merge(hashes: np.ndarray, values: np.ndarray, new_hashes: np.ndarray, new_values: np.ndarray):
+    """
+    Returns the sorted union of two hash arrays and their aligned values, taking
+    the value from new_values for hashes in both.
+    """
+    hashes = np.concatenate([hashes, new_hashes])
+    values = np.concatenate([values, new_values])
+    if hashes.shape[0] == 0:
+        return hashes, values
+    order = np.argsort(hashes, kind='stable')
+    hashes, values = hashes[order], values[order]
+    last = np.append(hashes[1:] != hashes[:-1], True)
+    return hashes[last], values[last]
+
+
+def write_array(path: str, arr: np.ndarray):
+    # np.save would append .npy to a staging path
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+
+class KeyIndex():
+    def __init__(self, folder: str, table: str, merge_ratio: float = 0.25, with_values: bool = False):
+        self.folder = folder
+        self.table = table
+        self.merge_ratio = merge_ratio
+        self.parts = ['base', 'delta'] + (['base_values', 'delta_values'] if with_values else [])
+        self.paths = {part: '%s/%s.%s.npy' % (folder, table, part) for part in self.parts}
+        self.paths['meta'] = '%s/%s.json' % (folder, table)
+        self.base = EMPTY
+        self.delta = EMPTY
+        self.base_values = None if not with_values else np.empty(0, dtype=np.int64)
+        self.delta_values = None if not with_values else np.empty(0, dtype=np.int64)
+        self.meta: Dict = {}
+        self.changed = set()
+
+    def __len__(self) -> int:
+        return self.base.shape[0] + self.delta.shape[0]
+
+    def load(self) -> bool:
+        """
+        Reads the index from disk. Returns False, leaving the index empty, if it
+        has not been saved yet.
+        """
+        if not all(os.path.exists(p) for p in self.paths.values()):
+            return False
+        with open(self.paths['meta']) as f:
+            self.meta = json.load(f)
+        for part in self.parts:
+            setattr(self, part, np.load(self.paths[part]))
+        self.changed = set()
+        return True
+
+    def reset(self, keys, values=None):
+        """
+        Rebuilds the index from the full set of keys of the table, and for an
+        index with_values, their values.
+        """
+        self.base = EMPTY
+        self.delta = EMPTY
+        if self.base_values is not None:
+            self.base_values = self.delta_values = np.empty(0, dtype=np.int64)
+        self.changed = {'base', 'delta'}
+        self.add(keys, values)
+        # Everything goes to the base
+        if self.delta.shape[0] > 0:
+            self.merge_delta()
+
+    def contains(self, keys) -> np.ndarray:
+        """
+        Returns a boolean array, True for each key already in the index.
+        """
+        if self.base_values is not None:
+            return self.lookup(keys) >= 0
+        hashes = hash_keys(keys)
+        return search(self.base, hashes) | search(self.delta, hashes)
+
+    def lookup(self, keys) -> np.ndarray:
+        """
+        Returns the value of each key in an index with_values, -1 for keys it does
+        not hold.
+        """
+        return self.hash_values(hash_keys(keys))
+
+    def add(self, keys, values=None):
+        """
+        Adds keys to the index, and for an index with_values, sets their values
+        (the last one given for a key repeated in keys, 0 if values are not given).
+        """
+        if self.base_values is None:
+            hashes = np.unique(hash_keys(keys))
+            hashes = hashes[~search(self.base, hashes)]
+            if hashes.shape[0] == 0:
+                return
+            self.delta = np.union1d(self.delta, hashes)
+        else:
+            hashes = hash_keys(keys)
+            values = np.zeros(hashes.shape[0], dtype=np.int64) if values is None else np.asarray(values, dtype=np.int64)
+            hashes, values = merge(EMPTY, np.empty(0, dtype=np.int64), hashes, values)
+            # Keys already held with the same value are left out
+            new = self.hash_values(hashes) != values
+            hashes, values = hashes[new], values[new]
+            if hashes.shape[0] == 0:
+                return
+            self.delta, self.delta_values = merge(self.delta, self.delta_values, hashes, values)
+        self.changed.add('delta')
+        if self.delta.shape[0] > self.merge_ratio * self.base.shape[0]:
+            self.merge_delta()
+
+    def remove(self, keys):
+        """
+        Removes keys from the index, so adding them again later is not skipped.
+        An index with_values records a tombstone for each in the delta; otherwise
+        the base is rewritten if it holds any of them.
+        """
+        hashes = np.unique(hash_keys(keys))
+        if self.base_values is None:
+            in_delta = search(hashes, self.delta)
+            if in_delta.any():
+                self.delta = self.delta[~in_delta]
+                self.changed.add('delta')
+            in_base = search(hashes, self.base)
+            if in_base.any():
+                self.base = self.base[~in_base]
+                self.changed.add('base')
+            return
+        hashes = hashes[self.hash_values(hashes) >= 0]
+        if hashes.shape[0] == 0:
+            return
+        self.delta, self.delta_values = merge(self.delta, self.delta_values, hashes, np.full(hashes.shape[0], -1, dtype=np.int64))
+        self.changed.add('delta')
+        if self.delta.shape[0] > self.merge_ratio * self.base.shape[0]:
+            self.merge_delta()
+
+    def hash_values(self, hashes: np.ndarray) -> np.ndarray:
+        values = np.full(hashes.shape[0], -1, dtype=np.int64)
+        for sorted_hashes, sorted_values in [(self.base, self.base_values), (self.delta, self.delta_values)]:
+            pos, found = lookup(sorted_hashes, hashes)
+            values[found] = sorted_values[pos[found]]
+        return values
+
+    def merge_delta(self):
+        if self.base_values is None:
+            self.base = np.union1d(self.base, self.delta)
+        else:
+            self.base, self.base_values = merge(self.base, self.base_values, self.delta, self.delta_values)
+            # Tombstones have done their job
+            held = self.base_values >= 0
+            self.base, self.base_values = self.base[held], self.base_values[held]
+            self.delta_values = np.empty(0, dtype=np.int64)
+        self.delta = EMPTY
+        self.changed.update(['base', 'delta'])
+
+    def save(self, stage: Optional[Callable[[str], str]] = None):
+        """
+        Writes the arrays changed since the index was loaded, and its metadata.
+        With stage (e.g. Journal.stage) each file is written to the path it returns
+        and committed by the caller; otherwise each file is replaced atomically.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        # Values are written with the hashes they are aligned with
+        writes = [(self.paths[part], lambda p, arr=getattr(self, part): write_array(p, arr))
+                  for part in self.parts
+                  if part.split('_')[0] in self.changed or not os.path.exists(self.paths[part])]
+        writes.append((self.paths['meta'], lambda p: write_json(p, self.meta)))
+        for path, write in writes:
+            if stage is not None:
+                write(stage(path))
+            else:
+                atomic_write(path, write)
+        self.changed = set()
@@ -1,5 +1,6 @@
 from plaidsync import *
 import os
+import sqlitedb
 from gsheet import *
 
 def main():
@@ -32,10 +33,27 @@ def main():
         config_file = default_config_mac+'/budget_config'
     cfg = config.Config(config_file)
     dbfile_win, dbfile_mac = cfg.get_dbfiles()
-    if os.path.exists(dbfile_win):
-        db = transactionsdb.TransactionsDB(dbfile_win)
+    dbfolder = dbfile_win if os.path.exists(dbfile_win) else dbfile_mac
+    if cfg.get_db_backend() == 'sqlite':
+        db = sqlitedb.SQLiteTransactionsDB(dbfolder, snapshot_retention=cfg.get_snapshot_retention(),
+                                           predict_candidates=cfg.get_predict_candidates(),
+                                           predict_half_life=cfg.get_predict_half_life(),
+                                           predict_engine=cfg.get_predict_engine())
     else:
-        db = transactionsdb.TransactionsDB(dbfile_mac)
+        db = transactionsdb.TransactionsDB(dbfolder, snapshot_retention=cfg.get_snapshot_retention(),
+                                           predict_candidates=cfg.get_predict_candidates(),
+                                           predict_half_life=cfg.get_predict_half_life(),
+                                           predict_engine=cfg.get_predict_engine())
+
+    # Inspect or roll back table snapshots instead of syncing
+    if args.list_snapshots:
+        print(db.list_snapshots().to_string(index=False))
+        return
+    if args.restore_table:
+        db.restore_table(args.restore_table, args.restore_version)
+        print("Restored %s to snapshot version %d" % (args.restore_table, args.restore_version))
+        return
+
     papi = plaidapi.PlaidAPI(**cfg.get_plaid_client_config())
 
     # Sync plaid data with raw_* tables
@@ -75,6 +93,9 @@ def main():
 
     # Backfill balances in processed_balances using transactions
     db.process_balances(args.start_date)
+
+    # Write every table changed during the run back to the database folder
+    db.checkpoint()
     
     # TODO - create environment on PC to match Mac
 
@@ -86,8 +107,6 @@ def main():
 
     # TODO - add printouts / verbose language throughout
 
-    # TODO - Specify dtypes in transactionsdb.py
-    
     # TODO - test each function fully, adding/removing try/except statements as needed
 
     # TODO - test end-to-end (from blank, then adding transactions & pulling down updated transactions)
@@ -0,0 +1,59 @@
+#!python3
+"""
+Sidecar store for the raw Plaid payloads kept alongside transactions and balances.
+
+Nothing in the pipeline reads Transaction.raw_data or AccountBalance.raw_data, so
+they are kept out of the hot tables. Each kind of payload ('transactions',
+'balances') is a folder of append-only parquet fragments with two columns: key
+(the txn_id, or account_id|bal_date for balances) and payload (the JSON text),
+zstd-compressed. get() loads payloads lazily, only for the keys asked for.
+"""
+
+import os
+import json
+import time
+import uuid
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from typing import Dict, List
+from journal import atomic_write
+
+PAYLOAD_SCHEMA = pa.schema([
+    ('key', pa.string()),
+    ('payload', pa.string()),
+])
+
+
+class PayloadStore():
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def append(self, kind: str, keys: List[str], payloads: List[str]):
+        """
+        Writes one new fragment holding the JSON payloads of the given keys. Keys
+        without a payload are skipped.
+        """
+        rows = [(k, p) for k, p in zip(keys, payloads) if p is not None]
+        if not rows:
+            return
+        table = pa.Table.from_arrays(
+            [pa.array([k for k, _ in rows], pa.string()), pa.array([p for _, p in rows], pa.string())],
+            schema=PAYLOAD_SCHEMA
+        )
+        kind_dir = '%s/%s' % (self.folder, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        path = '%s/part-%d-%s.parquet' % (kind_dir, time.time_ns(), uuid.uuid4().hex[:8])
+        atomic_write(path, lambda p: pq.write_table(table, p, compression='zstd'))
+
+    def get(self, kind: str, keys: List[str]) -> Dict[str, dict]:
+        """
+        Returns {key: payload} for the keys that have a stored payload. When a key
+        was stored more than once the latest payload wins.
+        """
+        kind_dir = '%s/%s' % (self.folder, kind)
+        if not keys or not os.path.isdir(kind_dir):
+            return {}
+        table = ds.dataset(kind_dir, schema=PAYLOAD_SCHEMA, format='parquet').to_table(
+            filter=ds.field('key').isin(list(keys)))
+        return {k: json.loads(p) for k, p in zip(table['key'].to_pylist(), table['payload'].to_pylist())}
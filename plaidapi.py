@@ -1,7 +1,14 @@
 #!/python3
 
 import re
+import sys
+import time
+import random
 import datetime
+import itertools
+import threading
+import collections
+import concurrent.futures
 
 import plaid
 import json
@@ -11,15 +18,22 @@ from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUse
 from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
 from plaid.model.sandbox_item_reset_login_request import SandboxItemResetLoginRequest
 from plaid.model.accounts_balance_get_request import AccountsBalanceGetRequest
+from plaid.model.accounts_get_request import AccountsGetRequest
 from plaid.model.item_get_request import ItemGetRequest
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+from plaid.model.transactions_sync_request_options import TransactionsSyncRequestOptions
 from plaid.model.products import Products
 from plaid.model.country_code import CountryCode
-from typing import Optional, List
+from typing import Callable, Dict, Iterator, Optional, List, Tuple
+from config import DEFAULT_RATE_LIMITS
 
 
 class AccountBalance:
+    __slots__ = ['account_id', 'account_name', 'bal_date', 'bal_current', 'bal_available', 'bal_limit',
+                 'bal_currency_code', 'raw_data']
+
     def __init__(self, data):
         # account_id | bal_amount | bal_date
         self.account_id = data['account_id']
@@ -36,6 +50,9 @@ class AccountBalance:
 
 
 class AccountInfo:
+    __slots__ = ['account_id', 'account_name_parent', 'account_name', 'account_name_ofcl', 'account_type',
+                 'account_subtype', 'account_number']
+
     def __init__(self, data, parent_name):
         # account_id | account_name | account_type | account_subtype | account_number
         self.account_id = data['account_id']
@@ -47,7 +64,15 @@ class AccountInfo:
         self.account_number = data['mask']
 
 
+# Columns of a TransactionColumns batch, in raw_transactions order
+TRANSACTION_COLUMNS = ['account_id', 'txn_id', 'txn_date', 'txn_name', 'txn_name_plaid', 'txn_amount', 'txn_cat_plaid',
+                       'txn_cat_plaid_dtl', 'create_dt', 'pending', 'raw_data']
+
+
 class Transaction:
+    __slots__ = ['raw_data', 'account_id', 'category', 'txn_id', 'txn_date', 'txn_name', 'txn_name_plaid', 'txn_amount',
+                 'txn_cat_plaid', 'txn_cat_plaid_dtl', 'pending', 'create_dt']
+
     def __init__(self, data):
         # account_id | account_name | account_type | account_subtype | category | txn_id | txn_date | txn_name
         # txn_name_plaid | txn_amount | txn_category_plaid | txn_code | pending | created | updated | raw_data
@@ -62,13 +87,90 @@ class Transaction:
         self.txn_name = data['name']
         self.txn_name_plaid = data['merchant_name']
         self.txn_amount = data['amount']
-        self.txn_cat_plaid = data['personal_finance_category']['primary']
-        self.txn_cat_plaid_dtl = data['personal_finance_category']['detailed']
+        # Not sent for every transaction, like TransactionColumns.from_json allows for
+        pfc = data['personal_finance_category'] or {}
+        self.txn_cat_plaid = pfc.get('primary')
+        self.txn_cat_plaid_dtl = pfc.get('detailed')
         self.pending = data['pending']
-        self.create_dt = datetime.date.today()
+        # Full timestamp, so later versions of a modified transaction sort after earlier ones
+        self.create_dt = datetime.datetime.now()
 
     def __str__(self):
-        return "%s %s %s - %4.2f %s" % ( self.date, self.transaction_id, self.merchant_name, self.amount, self.currency_code )
+        return "%s %s %s - %4.2f" % ( self.txn_date, self.txn_id, self.txn_name, self.txn_amount )
+
+
+class TransactionColumns:
+    """
+    A batch of transactions held as one list per column (TRANSACTION_COLUMNS),
+    built in a single pass over the JSON of Plaid responses without an object per
+    transaction. The database turns the columns straight into a DataFrame.
+    Iterating a batch gives Transaction views, for callers that want them.
+    """
+    __slots__ = ['columns']
+
+    def __init__(self, columns: Optional[Dict[str, list]] = None):
+        self.columns = columns if columns is not None else {c: [] for c in TRANSACTION_COLUMNS}
+
+    @classmethod
+    def from_json(cls, txns: List[dict], create_dt: Optional[datetime.datetime] = None) -> 'TransactionColumns':
+        # One create_dt per batch, so later versions of a modified transaction sort after earlier ones
+        create_dt = create_dt or datetime.datetime.now()
+        pfcs = [t.get('personal_finance_category') or {} for t in txns]
+        return cls({
+            'account_id': [t['account_id'] for t in txns],
+            'txn_id': [t['transaction_id'] for t in txns],
+            'txn_date': [t['date'] for t in txns],
+            'txn_name': [t['name'] for t in txns],
+            'txn_name_plaid': [t.get('merchant_name') for t in txns],
+            'txn_amount': [t['amount'] for t in txns],
+            'txn_cat_plaid': [pfc.get('primary') for pfc in pfcs],
+            'txn_cat_plaid_dtl': [pfc.get('detailed') for pfc in pfcs],
+            'create_dt': [create_dt] * len(txns),
+            'pending': [t['pending'] for t in txns],
+            'raw_data': list(txns),
+        })
+
+    @classmethod
+    def of(cls, transactions) -> 'TransactionColumns':
+        """
+        Returns transactions as a batch: a TransactionColumns as is, or a list of
+        Transaction objects converted column by column.
+        """
+        if isinstance(transactions, cls):
+            return transactions
+        return cls({col: [getattr(t, col) for t in transactions] for col in TRANSACTION_COLUMNS})
+
+    @classmethod
+    def concat(cls, batches: List['TransactionColumns']) -> 'TransactionColumns':
+        batches = [cls.of(b) for b in batches]
+        return cls({col: [v for b in batches for v in b.columns[col]] for col in TRANSACTION_COLUMNS})
+
+    def __len__(self) -> int:
+        return len(self.columns['txn_id'])
+
+    def __iter__(self):
+        for raw_data, create_dt in zip(self.columns['raw_data'], self.columns['create_dt']):
+            t = Transaction(raw_data)
+            t.create_dt = create_dt
+            yield t
+
+    def take(self, rows: List[int]) -> 'TransactionColumns':
+        return TransactionColumns({col: [vals[i] for i in rows] for col, vals in self.columns.items()})
+
+    def select(self, txn_ids) -> 'TransactionColumns':
+        """
+        Returns the transactions whose txn_id is in txn_ids (a set).
+        """
+        return self.take([i for i, tid in enumerate(self.columns['txn_id']) if tid in txn_ids])
+
+
+class TransactionsDelta:
+    def __init__(self, added: TransactionColumns, modified: TransactionColumns, removed: List[str], next_cursor: str):
+        # added | modified | removed (txn_ids) | next_cursor
+        self.added = TransactionColumns.of(added)
+        self.modified = TransactionColumns.of(modified)
+        self.removed = removed
+        self.next_cursor = next_cursor
 
 
 def parse_optional_iso8601_timestamp(ts: Optional[str]) -> datetime.datetime:
@@ -82,9 +184,20 @@ def parse_optional_iso8601_timestamp(ts: Optional[str]) -> datetime.datetime:
     return datetime.datetime.fromisoformat(re.sub(r"[.][0-9]+Z", "+00:00", str(ts)))
 
 
+def plaid_error_fields(ex) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns (error_type, error_code) from the body of a plaid.ApiException, or
+    (None, None) when the body is not a Plaid error (e.g. a proxy's 503 page).
+    """
+    try:
+        response = json.loads(ex.body)
+        return response.get('error_type'), response.get('error_code')
+    except (TypeError, ValueError, AttributeError):
+        return None, None
+
+
 def raise_plaid(ex):
-    response = json.loads(ex.body)
-    code = response['error_code']
+    code = plaid_error_fields(ex)[1]
     if code == 'NO_ACCOUNTS':
         raise PlaidNoApplicableAccounts(ex)
     elif code == 'ITEM_LOGIN_REQUIRED':
@@ -105,10 +218,9 @@ def wrap_plaid_error(f):
 class PlaidError(Exception):
     def __init__(self, plaid_error):
         super().__init__()
-        response = json.loads(plaid_error.body)
-        code = response['error_code']
+        code = plaid_error_fields(plaid_error)[1]
         self.plaid_error = plaid_error
-        self.message = code
+        self.message = code or "HTTP %s" % plaid_error.status
 
     def __str__(self):
         return "%s" % (self.message)
@@ -126,15 +238,134 @@ class PlaidAccountUpdateNeeded(PlaidError):
     pass
 
 
+# Errors that clear up on their own, worth retrying after a pause
+RETRYABLE_ERROR_TYPES = {'RATE_LIMIT_EXCEEDED'}
+RETRYABLE_ERROR_CODES = {
+    'PRODUCT_NOT_READY',
+    'INSTITUTION_DOWN',
+    'INSTITUTION_NOT_RESPONDING',
+    'INSTITUTION_NOT_AVAILABLE',
+    'INTERNAL_SERVER_ERROR',
+    'PLANNED_MAINTENANCE',
+}
+RETRYABLE_HTTP_STATUS = {429, 500, 502, 503, 504}
+
+# Endpoints that only read, so a request that failed after Plaid acted on it can
+# be sent again. Others (e.g. item_public_token_exchange) fail on the first error.
+IDEMPOTENT_ENDPOINTS = {
+    'transactions_get',
+    'transactions_sync',
+    'accounts_balance_get',
+    'accounts_get',
+}
+
+def is_retryable(ex) -> bool:
+    error_type, error_code = plaid_error_fields(ex)
+    if error_type is None and error_code is None:
+        return ex.status in RETRYABLE_HTTP_STATUS
+    return error_type in RETRYABLE_ERROR_TYPES or error_code in RETRYABLE_ERROR_CODES
+
+
+class TokenBucket():
+    """
+    Allows rate requests per minute on average, in bursts of up to burst. acquire()
+    reserves a token and sleeps until it is due, so concurrent callers are spaced
+    out rather than all retrying at once. The rate is halved by slow_down() and
+    creeps back up to the configured rate with each speed_up().
+    """
+    def __init__(self, rate: float, burst: int = 5, sleep: Callable[[float], None] = time.sleep):
+        self.max_rate = rate / 60.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RequestScheduler():
+    """
+    Runs Plaid client calls through a token bucket per endpoint, and retries calls
+    to IDEMPOTENT_ENDPOINTS failing with a transient error (see is_retryable) up to
+    max_retries times, after an exponential backoff with full jitter, or the
+    server's Retry-After.
+    """
+    def __init__(self, rate_limits: Optional[Dict[str, float]] = None, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0, sleep: Callable[[float], None] = time.sleep):
+        self.rate_limits = DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint: str) -> Optional[TokenBucket]:
+        if endpoint not in self.rate_limits:
+            return None
+        with self.lock:
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = TokenBucket(self.rate_limits[endpoint], sleep=self.sleep)
+            return self.buckets[endpoint]
+
+    def backoff(self, attempt: int, ex) -> float:
+        retry_after = ex.headers.get('Retry-After') if getattr(ex, 'headers', None) else None
+        try:
+            return min(self.max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, endpoint: str, fn: Callable, request):
+        bucket = self.bucket(endpoint)
+        attempt = 0
+        while True:
+            if bucket: bucket.acquire()
+            try:
+                response = fn(request)
+            except plaid.ApiException as ex:
+                if attempt >= self.max_retries or endpoint not in IDEMPOTENT_ENDPOINTS or not is_retryable(ex):
+                    raise
+                if bucket and (plaid_error_fields(ex)[0] == 'RATE_LIMIT_EXCEEDED' or ex.status == 429):
+                    bucket.slow_down()
+                delay = self.backoff(attempt, ex)
+                print("Plaid %s failed with %s, retrying in %.1fs" % (endpoint, plaid_error_fields(ex)[1] or ex.status, delay),
+                      file=sys.stderr)
+                self.sleep(delay)
+                attempt += 1
+                continue
+            if bucket: bucket.speed_up()
+            return response
+
+
 class PlaidAPI():
-    def __init__(self, client_id: str, secret: str, environment: str, suppress_warnings=True):
+    def __init__(self, client_id: str, secret: str, environment: str, suppress_warnings=True, host: Optional[str] = None,
+                 page_concurrency: int = 4, max_retries: int = 5, rate_limits: Optional[Dict[str, float]] = None):
         hosts = {
             'sandbox': plaid.Environment.Sandbox,
             'development': plaid.Environment.Development
         }
 
+        # host overrides the environment's URL, e.g. to run against a local fake Plaid server
         configuration = plaid.Configuration(
-            host=hosts[environment],
+            host=host or hosts[environment],
             api_key={
                 'clientId': client_id,
                 'secret': secret,
@@ -144,6 +375,22 @@ class PlaidAPI():
 
         api_client = plaid.ApiClient(configuration)
         self.client = plaid_api.PlaidApi(api_client)
+        self.page_concurrency = max(1, page_concurrency)
+        self.scheduler = RequestScheduler(rate_limits=rate_limits, max_retries=max_retries)
+        # /accounts responses of this run, see get_accounts()
+        self.accounts_cache = {}
+        self.accounts_lock = threading.Lock()
+
+    def call(self, endpoint: str, request, raw: bool = False):
+        """
+        Calls a plaid_api.PlaidApi method by name through the request scheduler.
+        With raw, the response is returned as the decoded JSON rather than parsed
+        into plaid models, which costs more than the request itself on large pages.
+        """
+        fn = getattr(self.client, endpoint)
+        if raw:
+            return self.scheduler.call(endpoint, lambda r: json.loads(fn(r, _preload_content=False).data), request)
+        return self.scheduler.call(endpoint, fn, request)
 
     @wrap_plaid_error
     def get_link_update_token(self, access_token=None) -> str:
@@ -169,7 +416,7 @@ class PlaidAPI():
                     client_user_id='abc_123'
                 )
             )
-        response = self.client.link_token_create(request)           
+        response = self.call('link_token_create', request)
 
         return response['link_token']
 
@@ -197,7 +444,7 @@ class PlaidAPI():
                     client_user_id='abc_123'
                 )
             )
-        response = self.client.link_token_create(request)           
+        response = self.call('link_token_create', request)
 
         return response['link_token']
 
@@ -211,7 +458,7 @@ class PlaidAPI():
         public_token=public_token
         )
 
-        return self.client.item_public_token_exchange(request)
+        return self.call('item_public_token_exchange', request)
 
     @wrap_plaid_error
     def sandbox_reset_login(self, access_token: str) -> str:
@@ -226,55 +473,176 @@ class PlaidAPI():
 
         request = SandboxItemResetLoginRequest(access_token=access_token)
 
-        return self.client.sandbox_item_reset_login(request)
+        return self.call('sandbox_item_reset_login', request)
 
 
     @wrap_plaid_error
-    def get_account_balance(self, access_token:str)->List[AccountBalance]:
+    def get_accounts(self, access_token:str, realtime:bool=True) -> list:
+        """
+        Returns the accounts of an item, requesting them from Plaid at most once per
+        access token for the life of this PlaidAPI. With realtime, balances come from
+        the slow /accounts/balance/get; otherwise from /accounts/get, which returns
+        the balances Plaid last cached, unless a real-time response is already at
+        hand. Concurrent callers for the same token wait on the one request in flight.
+        """
+        with self.accounts_lock:
+            key = (access_token, True)
+            if not realtime and key not in self.accounts_cache:
+                key = (access_token, False)
+            pending = self.accounts_cache.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.accounts_cache[key] = concurrent.futures.Future()
+
+        if owner:
+            try:
+                if key[1]:
+                    resp = self.call('accounts_balance_get', AccountsBalanceGetRequest(access_token=access_token), raw=True)
+                else:
+                    resp = self.call('accounts_get', AccountsGetRequest(access_token=access_token), raw=True)
+                pending.set_result(resp['accounts'])
+            except Exception as ex:
+                # Let a later call try again rather than replaying the error
+                with self.accounts_lock:
+                    del self.accounts_cache[key]
+                pending.set_exception(ex)
+        return pending.result()
+
+    def get_account_balance(self, access_token:str, realtime:bool=True)->List[AccountBalance]:
         """
         Returns the balances of all accounts associated with this particular access_token.
         """
-        request = AccountsBalanceGetRequest(access_token=access_token)
-        resp = self.client.accounts_balance_get(request)
-        return list( map( AccountBalance, resp['accounts'] ) )
+        return list( map( AccountBalance, self.get_accounts(access_token, realtime) ) )
     
 
-    @wrap_plaid_error
-    def get_account_info(self, access_token:str, parent_name:str)->List[AccountBalance]:
+    def get_account_info(self, access_token:str, parent_name:str)->List[AccountInfo]:
         """
-        Returns the account information from balances request
+        Returns the account information, from the balances response if one was already
+        made for this access_token, else from /accounts/get
         """
-        request = AccountsBalanceGetRequest(access_token=access_token)
-        resp = self.client.accounts_balance_get(request)
-        return list( map( AccountInfo, resp['accounts'], [parent_name]*len(resp['accounts']) ) )
+        accounts = self.get_accounts(access_token, realtime=False)
+        return list( map( AccountInfo, accounts, [parent_name]*len(accounts) ) )
 
 
     @wrap_plaid_error
-    def get_transactions(self, access_token:str, start_date:datetime.date, end_date:datetime.date, account_ids:Optional[List[str]]=None, status_callback=None):
-        ret = []
-        total_transactions = None
-        while True:
+    def get_transactions(self, access_token:str, start_date:datetime.date, end_date:datetime.date, account_ids:Optional[List[str]]=None, status_callback=None) -> TransactionColumns:
+        """
+        Returns the posted transactions between start_date and end_date as one batch.
+        See iter_transaction_pages() to handle them a page at a time instead.
+        """
+        return TransactionColumns.concat(list(self.iter_transaction_pages(access_token, start_date, end_date, status_callback)))
+
+    def iter_transaction_pages(self, access_token:str, start_date:datetime.date, end_date:datetime.date, status_callback=None) -> Iterator[TransactionColumns]:
+        """
+        Yields the posted transactions between start_date and end_date, a page at a
+        time in offset order. The first page gives total_transactions, then up to
+        page_concurrency further pages are requested ahead of the one being consumed,
+        so memory is bounded by the page size rather than the length of the history.
+        Offsets count every transaction returned, pending ones included, since that
+        is how Plaid pages them.
+
+        Plaid errors are raised as PlaidError from the generator.
+        """
+        page_size = 500
+        create_dt = datetime.datetime.now()
+
+        def fetch_page(offset):
             request = TransactionsGetRequest(
                         access_token=access_token,
                         start_date=start_date,
                         end_date=end_date,
                         options=TransactionsGetRequestOptions(
                             include_personal_finance_category=True,
-                            count=500,
-                            offset=len(ret)
+                            count=page_size,
+                            offset=offset
                         )
             )
-            response = self.client.transactions_get(request)
-
+            try:
+                return self.call('transactions_get', request, raw=True)
+            except plaid.ApiException as ex:
+                raise_plaid(ex)
+
+        # A page boundary can shift under concurrent inserts, so the same transaction may come back twice
+        seen = set()
+        def posted(txns):
+            page = []
+            for t in txns:
+                if not t['pending'] and t['transaction_id'] not in seen:
+                    seen.add(t['transaction_id'])
+                    page.append(t)
+            return TransactionColumns.from_json(page, create_dt)
+
+        response = fetch_page(0)
+        total_transactions = response['total_transactions']
+        fetched = len(response['transactions'])
+        offset = fetched
+        if status_callback: status_callback(fetched, total_transactions)
+        yield posted(response['transactions'])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.page_concurrency) as pool:
+            offsets = iter(range(page_size, total_transactions, page_size))
+            window = collections.deque((o, pool.submit(fetch_page, o)) for o in itertools.islice(offsets, self.page_concurrency))
+            while window:
+                page_offset, future = window.popleft()
+                response = future.result()
+                for o in itertools.islice(offsets, 1):
+                    window.append((o, pool.submit(fetch_page, o)))
+                fetched += len(response['transactions'])
+                offset = page_offset + len(response['transactions'])
+                total_transactions = max(total_transactions, response['total_transactions'])
+                if status_callback: status_callback(fetched, total_transactions)
+                yield posted(response['transactions'])
+
+        # Transactions that arrived while paging push the total up, pick them up in sequence
+        while offset < total_transactions:
+            response = fetch_page(offset)
+            if not response['transactions']: break
+            fetched += len(response['transactions'])
+            offset += len(response['transactions'])
             total_transactions = response['total_transactions']
+            if status_callback: status_callback(fetched, total_transactions)
+            yield posted(response['transactions'])
+
 
-            ret += [
-                Transaction(t)
-                for t in response['transactions']
-                if not t['pending']
-            ]
+    @wrap_plaid_error
+    def sync_transactions(self, access_token:str, cursor:Optional[str]=None, status_callback=None) -> TransactionsDelta:
+        """
+        Calls /transactions/sync from cursor (from the beginning of the item's history
+        if None) until has_more is false, and returns the added, modified and removed
+        transactions, pending ones included, along with the cursor to resume from next
+        time.
 
-            if status_callback: status_callback(len(ret), total_transactions)
-            if len(ret) >= total_transactions: break
+        If Plaid reports the item changed while paging, the whole delta is fetched
+        again from the original cursor, as the API requires.
 
-        return ret
+        https://plaid.com/docs/api/products/transactions/#transactionssync
+        """
+        while True:
+            added, modified, removed = [], [], []
+            next_cursor = cursor
+            create_dt = datetime.datetime.now()
+            try:
+                while True:
+                    request = TransactionsSyncRequest(
+                        access_token=access_token,
+                        count=500,
+                        options=TransactionsSyncRequestOptions(include_personal_finance_category=True),
+                        **({'cursor': next_cursor} if next_cursor else {})
+                    )
+                    response = self.call('transactions_sync', request, raw=True)
+
+                    added += response['added']
+                    modified += response['modified']
+                    removed += [t['transaction_id'] for t in response['removed']]
+                    next_cursor = response['next_cursor']
+
+                    if status_callback: status_callback(len(added) + len(modified) + len(removed), None)
+                    if not response['has_more']: break
+            except plaid.ApiException as ex:
+                if plaid_error_fields(ex)[1] == 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION':
+                    continue
+                raise
+
+            return TransactionsDelta(TransactionColumns.from_json(added, create_dt),
+                                     TransactionColumns.from_json(modified, create_dt),
+                                     removed, next_cursor)
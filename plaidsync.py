@@ -1,11 +1,14 @@
 #!.env/bin/python
 
 import argparse
+import concurrent.futures
 import datetime
+import queue
 from datetime import tzinfo
 import sys
 from collections import namedtuple
 from argparse import Namespace
+from typing import List, Optional
 
 import config
 import plaidapi
@@ -36,6 +39,9 @@ def parse_options():
     parser.add_argument("--check-txns",       dest="check_txns",     action='store_true',  help="Run with this option to print the head of transactions")
     parser.add_argument("--manual-path-txn",    dest="manual_txn",                         help="Populate this to direct to a CSV for raw_transaction upload")
     parser.add_argument("--manual-path-acct",    dest="manual_acct",                       help="Populate this to direct to a CSV for account_info upload")
+    parser.add_argument("--list-snapshots",   dest="list_snapshots", action='store_true',  help="List the saved snapshot versions of each table and exit.")
+    parser.add_argument("--restore-table",    dest="restore_table",                        help="Roll this table (e.g. processed_txns) back to --restore-version and exit.")
+    parser.add_argument("--restore-version",  dest="restore_version", type=int,            help="Snapshot version to restore with --restore-table, as shown by --list-snapshots.")
 
     args = parser.parse_args()
 
@@ -45,6 +51,9 @@ def parse_options():
     if not args.end_date:
         args.end_date = datetime.datetime.now().date()
 
+    if args.restore_table and args.restore_version is None:
+        parser.error("--restore-table requires --restore-version")
+
     if args.end_date < args.start_date:
         parser.error("End date [%s] cannot be before start date [%s]" % ( args.end_date, args.start_date ) )
         sys.exit(1)
@@ -58,6 +67,8 @@ class SyncCounts(
             "new_pending",
             "total_fetched",
             "accounts",
+            "modified",
+            "removed",
         ])):
     pass
 
@@ -65,82 +76,186 @@ class SyncCounts(
 class PlaidSynchronizer:
     def __init__(self, db: transactionsdb.TransactionsDB,
                  papi: plaidapi.PlaidAPI, account_name: str,
-                 access_token: str):
-        self.transactions = {}
+                 access_token: str, sync_mode: str = 'get', cursor: Optional[str] = None,
+                 realtime_balance: bool = True):
+        self.transactions = plaidapi.TransactionColumns()
         self.db           = db
         self.papi         = papi
         self.account_name = account_name
         self.access_token = access_token
+        self.sync_mode    = sync_mode
+        self.cursor       = cursor
+        self.realtime_balance = realtime_balance
         self.plaid_error  = None
+        self.balances     = None
         self.account_info = None
-        self.counts       = SyncCounts(0,0,0,0)
-
-    def add_transactions(self, transactions):
-        self.transactions.update(
-            dict(map(lambda t: (t.txn_id, t), transactions))
-        )
+        self.delta        = None
+        self.tids_new     = set()
+        self.counts       = SyncCounts(0,0,0,0,0,0)
+        # Set when pages were handed to on_page rather than kept, see write_transaction_page()
+        self.streamed     = False
+        self.tids_fetched = set()
+        self.tids_existing = None
+        self.account_ids  = set()
+
+    def add_transactions(self, transactions: plaidapi.TransactionColumns):
+        self.transactions = plaidapi.TransactionColumns.concat([self.transactions, transactions])
 
     def count_pending(self, tids):
-        return len([tid for tid in tids if self.transactions.get(tid) and self.transactions[tid].pending])
-
-    def sync(self, start_date, end_date, fetch_balances=True, verbose=True):
-        try:
+        cols = self.transactions.columns
+        return len([tid for tid, pending in zip(cols['txn_id'], cols['pending']) if pending and tid in tids])
+
+    def fetch(self, start_date, end_date, fetch_balances=True, verbose=True, on_page=None):
+        """
+        Runs the Plaid requests for this account and keeps the results on the
+        synchronizer. Nothing is read from or written to the database, so accounts
+        can be fetched in parallel; write_sync_results() saves them afterwards.
+
+        In get mode with on_page, each page of transactions is passed to
+        on_page(self, page) as it arrives instead of being kept, so it can be written
+        out straight away and the history is never held in memory at once.
+        """
+        def log(message):
             if verbose:
-                print("\n\nAccount: %s" % self.account_name)
+                print("    [%s] %s" % (self.account_name, message))
 
-            # Fetch balances and save out into raw_balances parquet
-            balances = None
+        try:
             if fetch_balances:
-                if verbose:
-                    print("    Fetching current balances")
-                balances = self.papi.get_account_balance(self.access_token)
-
-                if verbose:
-                    print("    Saving current balances")
-                self.db.save_balances(balances)
-            
-            # Fetch account info and save out into account_info parquet
-            if verbose:
-                print("    Fetching account info")
-            account_info = self.papi.get_account_info(self.access_token, self.account_name)
-
-            self.db.save_account_info(account_info)
-
-            # Fetch transactions, archive as needed and save out into raw_transactions parquet
-            if verbose:
-                print("    Fetching transactions from %s to %s" % (start_date, end_date))
-
-            self.add_transactions(self.papi.get_transactions(
-                access_token    = self.access_token,
-                start_date      = start_date,
-                end_date        = end_date,
-                status_callback = (lambda c,t: print("        %d/%d fetched" % ( c, t ) )) if verbose else None
-            ) )
+                log("Fetching current balances")
+                self.balances = self.papi.get_account_balance(self.access_token, realtime=self.realtime_balance)
+
+            log("Fetching account info")
+            self.account_info = self.papi.get_account_info(self.access_token, self.account_name)
+
+            if self.sync_mode == 'sync':
+                log("Fetching transaction changes since last sync")
+                self.delta = self.papi.sync_transactions(
+                    access_token    = self.access_token,
+                    cursor          = self.cursor,
+                    status_callback = (lambda c,t: log("    %d fetched" % c)) if verbose else None
+                )
+                self.add_transactions(self.delta.added)
+            else:
+                log("Fetching transactions from %s to %s" % (start_date, end_date))
+                self.streamed = on_page is not None
+                for page in self.papi.iter_transaction_pages(
+                    access_token    = self.access_token,
+                    start_date      = start_date,
+                    end_date        = end_date,
+                    status_callback = (lambda c,t: log("    %d/%d fetched" % ( c, t ) )) if verbose else None
+                ):
+                    if on_page:
+                        on_page(self, page)
+                    else:
+                        self.add_transactions(page)
 
-            account_ids     = set( t.account_id for t in self.transactions.values() )
-            tids_existing   = set( self.db.get_transaction_ids( start_date, end_date, list(account_ids) ) )
-            tids_fetched    = set( self.transactions.keys() )
-            tids_new        = tids_fetched.difference( tids_existing )
+        except plaidapi.PlaidError as ex:
+            self.plaid_error = ex
 
+    def count_new(self, tids_existing):
+        """
+        Works out which fetched transactions are new, given the txn_ids already stored
+        for the sync window (get mode; in sync mode everything added is new). Streamed
+        fetches were counted page by page as they were written.
+        """
+        if self.streamed:
             self.counts = SyncCounts(
-                new              = len(tids_new),
-                new_pending      = self.count_pending(tids_new),
-                total_fetched    = len(tids_fetched),
-                accounts         = len(account_ids),
+                new              = len(self.tids_new),
+                new_pending      = 0,
+                total_fetched    = len(self.tids_fetched),
+                accounts         = len(self.account_ids),
+                modified         = 0,
+                removed          = 0,
             )
+            return
+
+        tids_fetched = set( self.transactions.columns['txn_id'] )
+        if self.delta is not None:
+            self.tids_new = tids_fetched
+            modified, removed = len(self.delta.modified), len(self.delta.removed)
+            account_ids = set( self.delta.added.columns['account_id'] + self.delta.modified.columns['account_id'] )
+        else:
+            self.tids_new = tids_fetched.difference( tids_existing )
+            modified, removed = 0, 0
+            account_ids = set( self.transactions.columns['account_id'] )
+
+        self.counts = SyncCounts(
+            new              = len(self.tids_new),
+            new_pending      = self.count_pending(self.tids_new),
+            total_fetched    = len(tids_fetched) + modified + removed,
+            accounts         = len(account_ids),
+            modified         = modified,
+            removed          = removed,
+        )
 
-            if verbose:
-                print("    Fetched %d new (%d pending), %d total transactions from %d accounts" % (
-                    self.counts.new,
-                    self.counts.new_pending,
-                    self.counts.total_fetched,
-                    self.counts.accounts
-                ))
 
-            self.db.save_transactions([self.transactions.get(tid) for tid in tids_new])
-
-        except plaidapi.PlaidError as ex:
-            self.plaid_error = ex
+def write_transaction_page(db: transactionsdb.TransactionsDB, sync: PlaidSynchronizer, page: plaidapi.TransactionColumns,
+                           start_date, end_date):
+    """
+    Saves the new transactions of one page of a streamed get-mode fetch, and keeps
+    only their txn_ids on the synchronizer for its counts. Each save is durable on
+    its own (a raw_transactions fragment, or a committed SQLite insert), so an
+    interrupted sync keeps the pages it wrote. The txn_ids already stored for the
+    item's accounts in the sync window are read with its first page.
+    """
+    if sync.tids_existing is None:
+        account_ids = [ai.account_id for ai in sync.account_info or []]
+        sync.tids_existing = set( db.get_transaction_ids( start_date, end_date, account_ids ) ) if account_ids else set()
+    tids = set( page.columns['txn_id'] )
+    tids_new = tids - sync.tids_existing - sync.tids_new
+    sync.tids_fetched |= tids
+    sync.tids_new |= tids_new
+    sync.account_ids.update( page.columns['account_id'] )
+    if tids_new:
+        db.save_transactions(page.select(tids_new))
+
+
+def write_sync_results(db: transactionsdb.TransactionsDB, syncs: List[PlaidSynchronizer], start_date, end_date, verbose=True):
+    """
+    Single writer stage of a sync: merges the balances, account info and
+    transaction changes fetched for every account and saves each in one call, so
+    every table is written once per run however many accounts there are. Accounts
+    whose fetch failed are left out; pages already streamed by
+    write_transaction_page() are only counted.
+    """
+    for s in syncs:
+        if s.plaid_error is not None and s.streamed:
+            # Pages written before the error stay written
+            s.count_new(set())
+    syncs = [s for s in syncs if s.plaid_error is None]
+
+    balances = [b for s in syncs if s.balances for b in s.balances]
+    if balances:
+        db.save_balances(balances)
+
+    account_info = [ai for s in syncs if s.account_info for ai in s.account_info]
+    if account_info:
+        db.save_account_info(account_info)
+
+    account_ids     = set( a for s in syncs if s.delta is None and not s.streamed for a in s.transactions.columns['account_id'] )
+    tids_existing   = set( db.get_transaction_ids( start_date, end_date, list(account_ids) ) ) if account_ids else set()
+    for s in syncs:
+        s.count_new(tids_existing)
+        if verbose:
+            print("    [%s] Fetched %d new (%d pending), %d modified, %d removed, %d total transactions from %d accounts" % (
+                s.account_name,
+                s.counts.new,
+                s.counts.new_pending,
+                s.counts.modified,
+                s.counts.removed,
+                s.counts.total_fetched,
+                s.counts.accounts
+            ))
+
+    new_txns = plaidapi.TransactionColumns.concat([s.transactions.select(s.tids_new) for s in syncs])
+    if new_txns:
+        db.save_transactions(new_txns)
+
+    delta_syncs = [s for s in syncs if s.delta is not None]
+    db.update_transactions(plaidapi.TransactionColumns.concat([s.delta.modified for s in delta_syncs]))
+    db.remove_transactions([tid for s in delta_syncs for tid in s.delta.removed])
+    for s in delta_syncs:
+        db.save_sync_cursor(s.account_name, s.delta.next_cursor)
 
 
 def try_get_tqdm():
@@ -278,20 +393,51 @@ def sync_plaid_data(account_update, account_link, cfg, papi, start_date, end_dat
         sys.exit(1)
 
     # Begin account sync process
+    sync_mode = cfg.get_sync_mode()
     results = {}
+    for account_name in cfg.get_enabled_accounts():
+        results[account_name] = PlaidSynchronizer(
+            db, papi, account_name, cfg.get_account_access_token(account_name), sync_mode=sync_mode,
+            cursor=db.get_sync_cursor(account_name) if sync_mode == 'sync' else None,
+            realtime_balance=cfg.get_account_realtime_balance(account_name)
+        )
 
-    def process_account(account_name):
-        sync = PlaidSynchronizer(db, papi, account_name, cfg.get_account_access_token(account_name))
-        sync.sync(start_date, end_date, fetch_balances=fetch_balances, verbose=verbose)
-        results[account_name] = sync
+    # Fetch every account on a bounded pool of workers. Transaction pages come back
+    # through a bounded queue and are written by this thread as they arrive, which
+    # holds the workers back if writing falls behind; the rest is written at the end
+    workers = cfg.get_sync_workers()
+    pages = queue.Queue(maxsize=2 * workers)
+
+    def fetch(sync):
+        try:
+            sync.fetch(start_date, end_date, fetch_balances, verbose, on_page=lambda s, page: pages.put((s, page)))
+        finally:
+            pages.put((sync, None))
 
     tqdm = try_get_tqdm() if not verbose else None
-    if tqdm:
-        for account_name in tqdm(cfg.get_enabled_accounts(), desc="Synchronizing Plaid accounts", leave=False):
-            process_account(account_name)
-    else:
-        for account_name in cfg.get_enabled_accounts():
-            process_account(account_name)
+    progress = tqdm(total=len(results), desc="Synchronizing Plaid accounts", leave=False) if tqdm else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, sync) for sync in results.values()]
+        remaining = len(futures)
+        try:
+            while remaining:
+                sync, page = pages.get()
+                if page is None:
+                    remaining -= 1
+                    if progress: progress.update(1)
+                else:
+                    write_transaction_page(db, sync, page, start_date, end_date)
+        except BaseException:
+            # Workers blocked on a full queue would keep the pool from shutting down
+            while remaining:
+                if pages.get()[1] is None:
+                    remaining -= 1
+            raise
+        for future in futures:
+            future.result()
+    if progress: progress.close()
+
+    write_sync_results(db, list(results.values()), start_date, end_date, verbose=verbose)
 
     print("")
     print("")
@@ -304,6 +450,8 @@ def sync_plaid_data(account_update, account_link, cfg, papi, start_date, end_dat
             sync.counts.new_pending,
             sync.counts.accounts,
         ))
+        if sync.counts.modified or sync.counts.removed:
+            print("%-5s: %2d modified, %d removed transactions" % ("", sync.counts.modified, sync.counts.removed))
 
         if sync.plaid_error:
             import textwrap
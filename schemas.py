@@ -0,0 +1,160 @@
+#!python3
+"""
+Arrow schema registry for the TransactionsDB tables.
+
+Every table has one schema here, used both to write its parquet file and to set
+the pandas dtypes of the in-memory table. Low-cardinality text columns (account
+ids and names, categories, currency codes) are dictionary-encoded, which pandas
+reads as categorical; amounts are float64 and dates timestamp[ns].
+
+conform() casts only the columns that are not already of their registered type,
+so a table read from a file written with these schemas costs nothing to conform.
+
+raw_txns is a pyarrow dataset, whose scanner cannot cast the plain-string
+fragments written by older versions to dictionaries, so its text columns stay
+plain strings; the tables built from it are categorical.
+"""
+
+import pandas as pd
+import pyarrow as pa
+from typing import Dict
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMAS: Dict[str, pa.Schema] = {
+    'raw_txns': pa.schema([
+        ('txn_id', pa.string()),
+        ('txn_date', pa.timestamp('ns')),
+        ('txn_name', pa.string()),
+        ('txn_name_plaid', pa.string()),
+        ('txn_amount', pa.float64()),
+        ('txn_cat_plaid', pa.string()),
+        ('txn_cat_plaid_dtl', pa.string()),
+        ('create_dt', pa.timestamp('ns')),
+        ('archive_dt', pa.timestamp('ns')),
+        ('current', pa.bool_()),
+        ('pending', pa.bool_()),
+    ]),
+    'processed_txns': pa.schema([
+        ('account_id', CATEGORY),
+        ('txn_id', pa.string()),
+        ('txn_name', pa.string()),
+        ('txn_date', pa.timestamp('ns')),
+        ('txn_amount', pa.float64()),
+        ('account_name_parent', CATEGORY),
+        ('account_name', CATEGORY),
+        ('txn_cat', CATEGORY),
+        ('txn_cat_flag', pa.bool_()),
+        ('txn_cat_radius', pa.float64()),
+    ]),
+    'gsheet_txns': pa.schema([
+        ('txn_date', pa.timestamp('ns')),
+        ('txn_name', pa.string()),
+        ('txn_amount', pa.float64()),
+        ('txn_cat', CATEGORY),
+        ('account_name_parent', CATEGORY),
+        ('txn_cat_flag', pa.bool_()),
+        ('txn_id', pa.string()),
+    ]),
+    'cat_data': pa.schema([
+        ('txn_id', pa.string()),
+        ('txn_name', pa.string()),
+        ('txn_cat', CATEGORY),
+        ('txn_date', pa.timestamp('ns')),
+    ]),
+    'cat_prototypes': pa.schema([
+        ('txn_name_norm', pa.string()),
+        ('txn_cat', CATEGORY),
+        ('txn_count', pa.int64()),
+        ('last_seen', pa.timestamp('ns')),
+    ]),
+    'raw_balances': pa.schema([
+        ('account_id', CATEGORY),
+        ('account_name', CATEGORY),
+        ('bal_available', pa.float64()),
+        ('bal_limit', pa.float64()),
+        ('bal_currency_code', CATEGORY),
+        ('bal_current', pa.float64()),
+        ('bal_date', pa.timestamp('ns')),
+    ]),
+    'processed_balances': pa.schema([
+        ('account_name_parent', CATEGORY),
+        ('bal_date', pa.timestamp('ns')),
+        ('bal_processed', pa.float64()),
+    ]),
+    'account_info': pa.schema([
+        ('account_id', CATEGORY),
+        ('account_name', CATEGORY),
+        ('account_name_parent', CATEGORY),
+        ('account_name_ofcl', pa.string()),
+        ('account_type', CATEGORY),
+        ('account_subtype', CATEGORY),
+        ('account_number', pa.string()),
+    ]),
+}
+
+# Columns raw_txns is partitioned on, one directory level each
+RAW_TXN_PARTITION_SCHEMA = pa.schema([
+    ('account_id', pa.string()),
+    ('txn_month', pa.string()),
+])
+
+
+def pandas_dtype(arrow_type: pa.DataType) -> str:
+    if pa.types.is_dictionary(arrow_type):
+        return 'category'
+    if pa.types.is_timestamp(arrow_type):
+        return 'datetime64[ns]'
+    if pa.types.is_floating(arrow_type):
+        return 'float64'
+    if pa.types.is_integer(arrow_type):
+        return 'int64'
+    if pa.types.is_boolean(arrow_type):
+        return 'bool'
+    return 'object'
+
+
+def as_text(col: pd.Series) -> pd.Series:
+    # Keeps nulls as nulls; numbers read from CSV (e.g. account_number) become strings
+    return col.astype(object).where(col.isnull(), col.astype(str))
+
+
+def conform(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    """
+    Casts the columns of df that appear in the schema of table name to their
+    registered dtypes. Columns already of the right type, and columns the schema
+    does not know, are left alone. Boolean columns holding nulls are left as they
+    are rather than having the nulls turned into True.
+    """
+    casts = {}
+    for field in SCHEMAS[name]:
+        if field.name not in df.columns:
+            continue
+        col = df[field.name]
+        dtype = pandas_dtype(field.type)
+        if dtype == 'category':
+            if not isinstance(col.dtype, pd.CategoricalDtype):
+                casts[field.name] = as_text(col).astype('category')
+        elif dtype == 'object':
+            if col.dtype != object:
+                casts[field.name] = as_text(col)
+        elif dtype == 'bool':
+            if col.dtype != bool and not col.isnull().any():
+                casts[field.name] = col.astype(bool)
+        elif col.dtype != dtype:
+            casts[field.name] = col.astype(dtype)
+    return df.assign(**casts) if casts else df
+
+
+def to_arrow(df: pd.DataFrame, name: str) -> pa.Table:
+    """
+    Converts df to an Arrow table using the registered types of table name for
+    the columns it knows, and inferred types for any others.
+    """
+    df = conform(df, name)
+    registered = {f.name: f for f in SCHEMAS[name]}
+    fields = [
+        registered[c] if c in registered else pa.Schema.from_pandas(df[[c]], preserve_index=False).field(c)
+        for c in df.columns
+    ]
+    return pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
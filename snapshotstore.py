@@ -0,0 +1,166 @@
+#!python3
+"""
+Numbered, deduplicated snapshots of the TransactionsDB tables.
+
+Each snapshot of a table is a small JSON manifest listing the chunks that make
+up the table. Rows are sorted by the table's sort columns and cut into chunks
+at content-defined boundaries (rows whose key hash is a multiple of chunk_rows),
+so inserting or changing a few rows only changes the chunks those rows fall in.
+Chunks are stored once under objects/, named by the hash of their contents, and
+shared by every snapshot that contains them. Saving a snapshot therefore writes
+only the chunks that changed since the last one.
+
+Chunks and manifests are written atomically, and a manifest only after all of
+its chunks, so an interrupted save never leaves a snapshot pointing at missing
+data.
+
+Layout, inside the snapshot folder:
+
+    objects/<xx>/<sha256>.parquet
+    <table>/<version>.json
+"""
+
+import os
+import json
+import hashlib
+import datetime
+import pandas as pd
+from typing import List, Dict, Optional
+from journal import atomic_write, write_json
+
+
+def hash_rows(df: pd.DataFrame):
+    """
+    One uint64 hash per row. Object columns holding unhashable values (e.g. raw_data
+    dicts) are hashed through their string representation.
+    """
+    try:
+        return pd.util.hash_pandas_object(df, index=False).values
+    except TypeError:
+        obj_cols = [c for c, t in df.dtypes.items() if t == object]
+        return pd.util.hash_pandas_object(df.astype({c: str for c in obj_cols}), index=False).values
+
+
+class SnapshotStore():
+    def __init__(self, folder: str, retention: int = 10, chunk_rows: int = 1024):
+        self.folder = folder
+        self.retention = retention
+        self.chunk_rows = chunk_rows
+
+    def object_path(self, digest: str) -> str:
+        return '%s/objects/%s/%s.parquet' % (self.folder, digest[:2], digest)
+
+    def manifest_path(self, table: str, version: int) -> str:
+        return '%s/%s/%06d.json' % (self.folder, table, version)
+
+    def chunk(self, df: pd.DataFrame, sort_cols: List[str]) -> List[pd.DataFrame]:
+        """
+        Sorts df and cuts it after every row whose sort-column hash is a multiple of
+        chunk_rows. The boundaries depend only on the keys of the rows, not on their
+        position, so they stay put when rows are added or edited elsewhere.
+        """
+        if df.shape[0] == 0:
+            return []
+        df = df.sort_values(by=sort_cols, kind='stable').reset_index(drop=True)
+        key_hash = hash_rows(df[sort_cols])
+        cuts = (key_hash % self.chunk_rows == 0).nonzero()[0] + 1
+        bounds = [0] + [c for c in cuts.tolist() if c < df.shape[0]] + [df.shape[0]]
+        return [df.iloc[start:end].reset_index(drop=True) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def digest(self, chunk: pd.DataFrame) -> str:
+        h = hashlib.sha256()
+        h.update(repr([(c, str(t)) for c, t in chunk.dtypes.items()]).encode('utf-8'))
+        h.update(hash_rows(chunk).tobytes())
+        return h.hexdigest()
+
+    def versions(self, table: str) -> List[int]:
+        table_dir = '%s/%s' % (self.folder, table)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted(int(f[:-5]) for f in os.listdir(table_dir) if f.endswith('.json'))
+
+    def manifest(self, table: str, version: int) -> Dict:
+        with open(self.manifest_path(table, version)) as f:
+            return json.load(f)
+
+    def save(self, table: str, df: pd.DataFrame, sort_cols: List[str]) -> int:
+        """
+        Stores df as the next version of table and returns the version number. Only
+        chunks not already present in the store are written.
+        """
+        chunks = []
+        new_chunks = 0
+        for chunk in self.chunk(df, sort_cols):
+            digest = self.digest(chunk)
+            path = self.object_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                atomic_write(path, lambda p: chunk.to_parquet(p, index=False))
+                new_chunks += 1
+            chunks.append(digest)
+
+        versions = self.versions(table)
+        version = versions[-1] + 1 if versions else 1
+        manifest = {
+            'table': table,
+            'version': version,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'rows': int(df.shape[0]),
+            'columns': list(df.columns),
+            'chunks': chunks,
+            'new_chunks': new_chunks,
+        }
+        os.makedirs(os.path.dirname(self.manifest_path(table, version)), exist_ok=True)
+        atomic_write(self.manifest_path(table, version), lambda p: write_json(p, manifest))
+        return version
+
+    def load(self, table: str, version: Optional[int] = None) -> pd.DataFrame:
+        """
+        Rebuilds a table from a snapshot, the latest one if no version is given. Rows
+        come back in sort-column order rather than their original order.
+        """
+        versions = self.versions(table)
+        if not versions:
+            raise KeyError("No snapshots of table [%s]" % table)
+        if version is None:
+            version = versions[-1]
+        if version not in versions:
+            raise KeyError("No snapshot version %d of table [%s], available: %s" % (version, table, versions))
+        manifest = self.manifest(table, version)
+        if not manifest['chunks']:
+            return pd.DataFrame(columns=manifest['columns'])
+        return pd.concat([pd.read_parquet(self.object_path(d)) for d in manifest['chunks']], ignore_index=True)
+
+    def list(self) -> pd.DataFrame:
+        rows = []
+        for table in sorted(os.listdir(self.folder)) if os.path.isdir(self.folder) else []:
+            if table == 'objects':
+                continue
+            for version in self.versions(table):
+                m = self.manifest(table, version)
+                rows.append({k: m[k] for k in ['table', 'version', 'created', 'rows', 'new_chunks']})
+        return pd.DataFrame(rows, columns=['table', 'version', 'created', 'rows', 'new_chunks'])
+
+    def prune(self):
+        """
+        Applies the retention policy: keeps the newest `retention` versions of each
+        table (all of them if retention is 0), then deletes every chunk no remaining
+        snapshot refers to.
+        """
+        if not os.path.isdir(self.folder):
+            return
+        referenced = set()
+        for table in os.listdir(self.folder):
+            if table == 'objects':
+                continue
+            versions = self.versions(table)
+            for version in versions[:-self.retention] if self.retention > 0 else []:
+                os.remove(self.manifest_path(table, version))
+            for version in self.versions(table):
+                referenced.update(self.manifest(table, version)['chunks'])
+
+        objects_dir = self.folder + '/objects'
+        for prefix in os.listdir(objects_dir) if os.path.isdir(objects_dir) else []:
+            for f in os.listdir('%s/%s' % (objects_dir, prefix)):
+                if f[:-len('.parquet')] not in referenced:
+                    os.remove('%s/%s/%s' % (objects_dir, prefix, f))
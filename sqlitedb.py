@@ -0,0 +1,550 @@
+#!python3
+"""
+SQLite implementation of the TransactionsDB interface.
+
+All tables live in a single transactions.db file inside the database folder.
+Every table has a primary key (txn_id, or the natural key for balances and
+account info), and the transaction tables are also indexed on account_id and
+txn_date, so that inserts, upserts and lookups are O(log n) per row rather than
+a rewrite of the whole table.
+
+Dates are stored as ISO-8601 text, so range comparisons work on the indexes.
+Raw Plaid payloads are kept out of the transaction and balance tables, as
+zlib-compressed JSON in raw_payloads, and only read by get_raw_payloads().
+
+cat_prototypes holds cat_data compacted to one row per normalized name and
+category (see categorizer.build_prototypes), kept up to date by
+update_training_data() with the normalize_name() SQL function registered on the
+connection. The CategoryIndex predict_categories searches is saved next to
+transactions.db, in cat_index/, and kept in step with cat_prototypes.
+
+Tables are snapshotted into the same deduplicated SnapshotStore as the parquet
+backend, backup/snapshots/, so unchanged chunks of rows are stored once. Triggers
+on the temp schema record which tables a run changes, and checkpoint() saves
+only those as their next version, keeping the newest snapshot_retention.
+restore_table() writes a version back. raw_payloads is not snapshotted.
+
+Needs SQLite 3.24 or later, for upserts (INSERT ... ON CONFLICT); Python 3.7's
+sqlite3 module is enough otherwise.
+"""
+
+import sqlite3
+import json
+import zlib
+import datetime
+import numpy as np
+import pandas as pd
+from typing import List, Dict
+from plaidapi import AccountBalance, AccountInfo, TransactionColumns
+from schemas import conform
+from snapshotstore import SnapshotStore
+from transactionsdb import (GSHEET_TXN_MAP, build_placeholders, dump_raw_data, balance_payload_key,
+                            clean_gsheet_txns, build_processed_balances)
+from categorizer import normalize_name
+from categoryindex import CategoryIndex
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw_transactions (
+    txn_id              TEXT PRIMARY KEY,
+    account_id          TEXT NOT NULL,
+    txn_date            TEXT,
+    txn_name            TEXT,
+    txn_name_plaid      TEXT,
+    txn_amount          REAL,
+    txn_cat_plaid       TEXT,
+    txn_cat_plaid_dtl   TEXT,
+    create_dt           TEXT,
+    archive_dt          TEXT,
+    current             INTEGER,
+    pending             INTEGER
+);
+CREATE INDEX IF NOT EXISTS raw_transactions_account_date ON raw_transactions (account_id, txn_date);
+CREATE INDEX IF NOT EXISTS raw_transactions_date ON raw_transactions (txn_date);
+
+CREATE TABLE IF NOT EXISTS processed_transactions (
+    txn_id              TEXT PRIMARY KEY,
+    account_id          TEXT,
+    account_name_parent TEXT,
+    account_name        TEXT,
+    txn_name            TEXT,
+    txn_date            TEXT,
+    txn_amount          REAL,
+    txn_cat             TEXT,
+    txn_cat_flag        INTEGER,
+    txn_cat_radius      REAL
+);
+CREATE INDEX IF NOT EXISTS processed_transactions_account_date ON processed_transactions (account_id, txn_date);
+CREATE INDEX IF NOT EXISTS processed_transactions_date ON processed_transactions (txn_date);
+CREATE INDEX IF NOT EXISTS processed_transactions_cat ON processed_transactions (txn_cat_flag, txn_cat);
+
+CREATE TABLE IF NOT EXISTS gsheet_transactions (
+    txn_id              TEXT PRIMARY KEY,
+    txn_date            TEXT,
+    txn_name            TEXT,
+    txn_amount          REAL,
+    txn_cat             TEXT,
+    account_name_parent TEXT,
+    txn_cat_flag        INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS cat_data (
+    txn_id              TEXT PRIMARY KEY,
+    txn_name            TEXT,
+    txn_cat             TEXT,
+    txn_date            TEXT
+);
+
+CREATE TABLE IF NOT EXISTS cat_prototypes (
+    txn_name_norm       TEXT NOT NULL,
+    txn_cat             TEXT NOT NULL,
+    txn_count           INTEGER,
+    last_seen           TEXT,
+    PRIMARY KEY (txn_name_norm, txn_cat)
+);
+
+CREATE TABLE IF NOT EXISTS account_info (
+    account_id          TEXT PRIMARY KEY,
+    account_name        TEXT,
+    account_name_parent TEXT,
+    account_name_ofcl   TEXT,
+    account_type        TEXT,
+    account_subtype     TEXT,
+    account_number      TEXT
+);
+
+CREATE TABLE IF NOT EXISTS raw_balances (
+    account_id          TEXT NOT NULL,
+    bal_date            TEXT NOT NULL,
+    account_name        TEXT,
+    bal_available       REAL,
+    bal_limit           REAL,
+    bal_currency_code   TEXT,
+    bal_current         REAL,
+    PRIMARY KEY (account_id, bal_date)
+);
+
+CREATE TABLE IF NOT EXISTS raw_payloads (
+    kind                TEXT NOT NULL,
+    key                 TEXT NOT NULL,
+    payload             BLOB,
+    PRIMARY KEY (kind, key)
+);
+
+CREATE TABLE IF NOT EXISTS processed_balances (
+    account_name_parent TEXT NOT NULL,
+    bal_date            TEXT NOT NULL,
+    bal_processed       REAL,
+    PRIMARY KEY (account_name_parent, bal_date)
+);
+
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    item                TEXT PRIMARY KEY,
+    cursor              TEXT
+);
+"""
+
+# The prototypes of the categorized rows of processed_transactions not yet in cat_data
+NEW_PROTOTYPES = """
+    SELECT normalize_name(txn_name) AS txn_name_norm, txn_cat, COUNT(*) AS txn_count, MAX(txn_date) AS last_seen
+    FROM processed_transactions AS p
+    WHERE txn_cat_flag = 1 AND txn_cat IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM cat_data AS c WHERE c.txn_id = p.txn_id)
+    GROUP BY 1, 2
+"""
+
+# Columns added to existing tables since their CREATE TABLE was first run
+MIGRATIONS = [
+    ('raw_transactions', 'pending', 'INTEGER'),
+    ('cat_data', 'txn_date', 'TEXT'),
+    ('processed_transactions', 'txn_cat_radius', 'REAL'),
+]
+
+TABLE_COLUMNS = {
+    'raw_transactions': ['txn_id', 'account_id', 'txn_date', 'txn_name', 'txn_name_plaid', 'txn_amount', 'txn_cat_plaid',
+                         'txn_cat_plaid_dtl', 'create_dt', 'archive_dt', 'current', 'pending'],
+    'processed_transactions': ['txn_id', 'account_id', 'account_name_parent', 'account_name', 'txn_name', 'txn_date',
+                               'txn_amount', 'txn_cat', 'txn_cat_flag', 'txn_cat_radius'],
+    'gsheet_transactions': ['txn_id', 'txn_date', 'txn_name', 'txn_amount', 'txn_cat', 'account_name_parent', 'txn_cat_flag'],
+    'cat_data': ['txn_id', 'txn_name', 'txn_cat', 'txn_date'],
+    'cat_prototypes': ['txn_name_norm', 'txn_cat', 'txn_count', 'last_seen'],
+    'account_info': ['account_id', 'account_name', 'account_name_parent', 'account_name_ofcl', 'account_type',
+                     'account_subtype', 'account_number'],
+    'raw_balances': ['account_id', 'bal_date', 'account_name', 'bal_available', 'bal_limit', 'bal_currency_code',
+                     'bal_current'],
+    'processed_balances': ['account_name_parent', 'bal_date', 'bal_processed'],
+}
+
+TABLE_KEYS = {
+    'raw_transactions': ['txn_id'],
+    'processed_transactions': ['txn_id'],
+    'gsheet_transactions': ['txn_id'],
+    'cat_data': ['txn_id'],
+    'cat_prototypes': ['txn_name_norm', 'txn_cat'],
+    'account_info': ['account_id'],
+    'raw_balances': ['account_id', 'bal_date'],
+    'processed_balances': ['account_name_parent', 'bal_date'],
+}
+
+DATE_COLUMNS = ['txn_date', 'create_dt', 'archive_dt', 'bal_date', 'last_seen']
+
+
+def to_sql_value(value):
+    """
+    Converts a pandas/numpy cell into a value the sqlite3 module can bind.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return None if pd.isnull(value) else value.strftime('%Y-%m-%d')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (np.bool_, bool)):
+        return int(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if pd.isnull(value) is True:
+        return None
+    return value
+
+
+class SQLiteTransactionsDB():
+    def __init__(self, dbfolder: str, snapshot_retention: int = 10, predict_candidates: int = 0,
+                 predict_half_life: float = 0, predict_engine: str = 'levenshtein'):
+        self.dbfolder = dbfolder if dbfolder[-1] != '/' else dbfolder[:-1]
+        self.predict_candidates = predict_candidates
+        self.predict_half_life = predict_half_life
+        self.predict_engine = predict_engine
+        self.paths = {
+            'account_ref': self.dbfolder + '/accounts.xlsx',
+            'sqlite': self.dbfolder + '/transactions.db',
+            'cat_index': self.dbfolder + '/cat_index',
+            'snapshots': self.dbfolder + '/backup/snapshots',
+        }
+        self.gsheet_txn_map = GSHEET_TXN_MAP
+        self.cat_index = None
+        # Normalized names update_training_data added training rows for, whose
+        # neighbourhoods predict_categories re-predicts
+        self.retrained_names = []
+        self.conn = sqlite3.connect(self.paths['sqlite'])
+        try:
+            self.conn.create_function('normalize_name', 1, normalize_name, deterministic=True)
+        except (TypeError, sqlite3.NotSupportedError):
+            # deterministic needs Python 3.8 and SQLite 3.8.3
+            self.conn.create_function('normalize_name', 1, normalize_name)
+        self.conn.executescript(SCHEMA)
+        for table, column, col_type in MIGRATIONS:
+            if column not in [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % table)]:
+                self.conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, col_type))
+        # Tables changed since the last checkpoint, recorded by temporary triggers. Not
+        # INSERT OR IGNORE, which an upsert's own conflict clause would override
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS dirty_tables (name TEXT PRIMARY KEY)")
+        for table in TABLE_COLUMNS:
+            for event in ['INSERT', 'UPDATE', 'DELETE']:
+                self.conn.execute(
+                    "CREATE TEMP TRIGGER IF NOT EXISTS %s_%s_dirty AFTER %s ON main.%s "
+                    "BEGIN INSERT INTO dirty_tables (name) SELECT '%s' "
+                    "WHERE NOT EXISTS (SELECT 1 FROM dirty_tables WHERE name = '%s'); END" % (
+                        table, event.lower(), event, table, table, table))
+        self.snapshots = SnapshotStore(self.paths['snapshots'], retention=snapshot_retention)
+
+    def upsert(self, table: str, df: pd.DataFrame, update: bool = False):
+        """
+        Inserts the rows of df into table. Rows whose key already exists are left
+        alone, or overwritten with the new values when update is True.
+        """
+        cols = [c for c in TABLE_COLUMNS[table] if c in df.columns]
+        keys = TABLE_KEYS[table]
+        if update and any(c not in keys for c in cols):
+            conflict = "DO UPDATE SET " + ", ".join("%s=excluded.%s" % (c, c) for c in cols if c not in keys)
+        else:
+            conflict = "DO NOTHING"
+        sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) %s" % (
+            table, ",".join(cols), build_placeholders(cols), ",".join(keys), conflict)
+        rows = [tuple(to_sql_value(v) for v in row) for row in df[cols].itertuples(index=False, name=None)]
+        with self.conn:
+            self.conn.executemany(sql, rows)
+
+    def read_table(self, table: str, where: str = "", params=()) -> pd.DataFrame:
+        df = pd.read_sql_query("SELECT * FROM %s %s" % (table, where), self.conn, params=params)
+        for col in DATE_COLUMNS:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+        if 'txn_cat_flag' in df.columns:
+            df['txn_cat_flag'] = df['txn_cat_flag'].fillna(0).astype('bool')
+        return df
+
+    def save_payloads(self, kind: str, keys, payloads):
+        rows = [(kind, k, zlib.compress(p.encode('utf-8')))
+                for k, p in zip(keys, map(dump_raw_data, payloads)) if p is not None]
+        with self.conn:
+            self.conn.executemany("INSERT INTO raw_payloads (kind, key, payload) VALUES (?,?,?) "
+                                  "ON CONFLICT (kind, key) DO NOTHING", rows)
+
+    def get_raw_payloads(self, kind: str, keys: List[str]) -> Dict[str, dict]:
+        if not keys:
+            return {}
+        sql = "SELECT key, payload FROM raw_payloads WHERE kind = ? AND key IN (%s)" % build_placeholders(keys)
+        return {k: json.loads(zlib.decompress(p)) for k, p in self.conn.execute(sql, [kind] + list(keys))}
+
+    def get_transaction_ids(self, start_date: datetime.date, end_date: datetime.date, account_ids: List[str]) -> List[str]:
+        sql = "SELECT txn_id FROM raw_transactions WHERE account_id IN (%s) AND txn_date BETWEEN ? AND ?" % (
+            build_placeholders(account_ids))
+        params = list(account_ids) + [to_sql_value(start_date), to_sql_value(end_date)]
+        return [row[0] for row in self.conn.execute(sql, params)]
+
+    def save_transactions_csv(self, csv_path):
+        new_txns = pd.read_csv(csv_path)
+        new_txns['archive_dt'] = np.nan
+        new_txns['current'] = True
+        new_txns = conform(new_txns, 'raw_txns')
+
+        self.upsert('raw_transactions', new_txns)
+        if 'raw_data' in new_txns.columns:
+            self.save_payloads('transactions', new_txns['txn_id'], new_txns['raw_data'])
+
+    def transactions_frame(self, transactions: TransactionColumns) -> pd.DataFrame:
+        new_txns = pd.DataFrame(TransactionColumns.of(transactions).columns)
+        new_txns['archive_dt'] = np.nan
+        new_txns['current'] = True
+        return new_txns
+
+    def save_transactions(self, transactions: TransactionColumns):
+        new_txns = self.transactions_frame(transactions)
+        self.upsert('raw_transactions', new_txns)
+        self.save_payloads('transactions', new_txns['txn_id'], new_txns['raw_data'])
+
+    def update_transactions(self, transactions: TransactionColumns):
+        if not transactions:
+            return
+        new_txns = self.transactions_frame(transactions)
+        self.upsert('raw_transactions', new_txns, update=True)
+        with self.conn:
+            self.conn.execute("DELETE FROM raw_payloads WHERE kind = 'transactions' AND key IN (%s)" % (
+                build_placeholders(new_txns['txn_id'])), list(new_txns['txn_id']))
+            # Correlated subqueries rather than UPDATE ... FROM, which needs SQLite 3.33
+            self.conn.execute("""
+                UPDATE processed_transactions
+                SET (txn_name, txn_date, txn_amount) = (
+                    SELECT r.txn_name, r.txn_date, r.txn_amount FROM raw_transactions AS r
+                    WHERE r.txn_id = processed_transactions.txn_id)
+                WHERE txn_id IN (%s)
+                  AND EXISTS (SELECT 1 FROM raw_transactions AS r WHERE r.txn_id = processed_transactions.txn_id)
+            """ % build_placeholders(new_txns['txn_id']), list(new_txns['txn_id']))
+        self.save_payloads('transactions', new_txns['txn_id'], new_txns['raw_data'])
+
+    def remove_transactions(self, txn_ids: List[str]):
+        if not txn_ids:
+            return
+        with self.conn:
+            self.conn.execute("UPDATE raw_transactions SET current = 0, archive_dt = ? WHERE txn_id IN (%s)" % (
+                build_placeholders(txn_ids)), [to_sql_value(datetime.date.today())] + list(txn_ids))
+            self.conn.execute("DELETE FROM processed_transactions WHERE txn_id IN (%s)" % build_placeholders(txn_ids),
+                              list(txn_ids))
+
+    def get_sync_cursor(self, item: str):
+        row = self.conn.execute("SELECT cursor FROM sync_cursors WHERE item = ?", (item,)).fetchone()
+        return row[0] if row else None
+
+    def save_sync_cursor(self, item: str, cursor: str):
+        with self.conn:
+            self.conn.execute("INSERT INTO sync_cursors (item, cursor) VALUES (?, ?) "
+                              "ON CONFLICT (item) DO UPDATE SET cursor = excluded.cursor", (item, cursor))
+
+    def process_transactions(self):
+        with self.conn:
+            self.conn.execute("""
+                INSERT INTO processed_transactions (txn_id, account_id, account_name_parent, account_name,
+                                                    txn_name, txn_date, txn_amount, txn_cat, txn_cat_flag)
+                SELECT r.txn_id, r.account_id, a.account_name_parent, a.account_name,
+                       r.txn_name, r.txn_date, r.txn_amount, '', 0
+                FROM raw_transactions r
+                INNER JOIN account_info a ON a.account_id = r.account_id
+                WHERE COALESCE(r.current, 1) = 1 AND COALESCE(r.pending, 0) = 0
+                ON CONFLICT (txn_id) DO NOTHING
+            """)
+
+    def get_processed_transactions(self) -> pd.DataFrame:
+        return self.read_table('processed_transactions')
+
+    def update_gsheet_txns(self, gsheet_txns):
+        self.upsert('gsheet_transactions', clean_gsheet_txns(gsheet_txns), update=True)
+
+    def sync_categories(self):
+        if self.conn.execute("SELECT 1 FROM gsheet_transactions LIMIT 1").fetchone() is None:
+            print("No categories synced - no gsheet data")
+            return
+        with self.conn:
+            self.conn.execute("""
+                UPDATE processed_transactions
+                SET (txn_cat, txn_cat_flag, txn_date, txn_amount) = (
+                    SELECT COALESCE(g.txn_cat, processed_transactions.txn_cat),
+                           COALESCE(g.txn_cat_flag, processed_transactions.txn_cat_flag),
+                           COALESCE(g.txn_date, processed_transactions.txn_date),
+                           COALESCE(g.txn_amount, processed_transactions.txn_amount)
+                    FROM gsheet_transactions AS g
+                    WHERE g.txn_id = processed_transactions.txn_id)
+                WHERE txn_id IN (SELECT txn_id FROM gsheet_transactions)
+            """)
+
+    def sync_category_prototypes(self):
+        """
+        Rebuilds cat_prototypes from cat_data if it does not count every
+        categorized row of it, e.g. on a database created before cat_prototypes
+        existed.
+        """
+        prototype_count = self.conn.execute("SELECT COALESCE(SUM(txn_count), 0) FROM cat_prototypes").fetchone()[0]
+        cat_count = self.conn.execute("SELECT COUNT(txn_cat) FROM cat_data").fetchone()[0]
+        if prototype_count == cat_count:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM cat_prototypes")
+            self.conn.execute("""
+                INSERT INTO cat_prototypes (txn_name_norm, txn_cat, txn_count, last_seen)
+                SELECT normalize_name(txn_name), txn_cat, COUNT(*), MAX(txn_date) FROM cat_data
+                WHERE txn_cat IS NOT NULL
+                GROUP BY 1, 2
+            """)
+
+    def prototypes_version(self) -> list:
+        return list(self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(txn_count), 0), MAX(last_seen) FROM cat_prototypes").fetchone())
+
+    def category_index(self) -> CategoryIndex:
+        """
+        Returns the CategoryIndex predict_categories searches. A saved index is
+        trusted, memory-mapped, if it was written for the current row count, vote
+        total and latest last_seen of cat_prototypes, and rebuilt from the table
+        otherwise.
+        """
+        if self.cat_index is not None:
+            return self.cat_index
+        self.sync_category_prototypes()
+        index = CategoryIndex(self.paths['cat_index'])
+        version = self.prototypes_version()
+        if not index.load() or index.meta.get('table_version') != version:
+            index.reset(self.read_table('cat_prototypes'))
+            index.meta['table_version'] = version
+            index.save()
+        self.cat_index = index
+        return index
+
+    def update_training_data(self):
+        index = self.category_index()
+        new_prototypes = pd.read_sql_query(NEW_PROTOTYPES, self.conn, parse_dates=['last_seen'])
+        with self.conn:
+            # Prototypes of the rows about to be added to cat_data, before they are
+            self.conn.execute("""
+                INSERT INTO cat_prototypes (txn_name_norm, txn_cat, txn_count, last_seen)
+                """ + NEW_PROTOTYPES + """
+                ON CONFLICT (txn_name_norm, txn_cat) DO UPDATE
+                SET txn_count = txn_count + excluded.txn_count,
+                    last_seen = MAX(COALESCE(last_seen, excluded.last_seen), COALESCE(excluded.last_seen, last_seen))
+            """)
+            self.conn.execute("""
+                INSERT INTO cat_data (txn_id, txn_name, txn_cat, txn_date)
+                SELECT txn_id, txn_name, txn_cat, txn_date FROM processed_transactions
+                WHERE txn_cat_flag = 1
+                ON CONFLICT (txn_id) DO NOTHING
+            """)
+        index.add(new_prototypes)
+        index.meta['table_version'] = self.prototypes_version()
+        index.save()
+        self.retrained_names = list(new_prototypes['txn_name_norm'].unique())
+
+    def save_account_info_csv(self, csv_path):
+        self.upsert('account_info', pd.read_csv(csv_path))
+
+    def save_account_info(self, account_info: AccountInfo):
+        cols = ['account_id', 'account_name', 'account_name_parent', 'account_name_ofcl', 'account_type', 'account_subtype', 'account_number']
+        vals = [[getattr(ai, col) for ai in account_info] for col in cols]
+        self.upsert('account_info', pd.DataFrame(dict(zip(cols, vals))))
+
+    def predict_categories(self):
+        """
+        Predicts a category for the unconfirmed transactions without one, and again
+        for those predicted before that the training rows update_training_data just
+        added may change (see CategoryIndex.outdated()).
+        """
+        unconfirmed = self.read_table('processed_transactions', "WHERE txn_cat_flag = 0")
+        uncat = (unconfirmed['txn_cat'] == '').values
+        outdated = np.zeros(uncat.shape[0], dtype=bool)
+        if self.retrained_names and not uncat.all():
+            outdated[~uncat] = self.category_index().outdated(unconfirmed[~uncat], self.retrained_names,
+                                                              engine=self.predict_engine)
+            print("Re-predicting categories for %d transactions near %d retrained names" % (
+                outdated.sum(), len(self.retrained_names)))
+        self.retrained_names = []
+        if not (uncat | outdated).any():
+            print("No records to predict categories for")
+            return
+
+        data = self.category_index().predict(unconfirmed[uncat | outdated], candidates=self.predict_candidates,
+                                             half_life_days=self.predict_half_life, engine=self.predict_engine)
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE processed_transactions SET txn_cat = COALESCE(?, txn_cat), txn_cat_radius = ? WHERE txn_id = ?",
+                [(to_sql_value(cat), to_sql_value(radius), txn_id)
+                 for txn_id, cat, radius in zip(data['txn_id'], data['txn_cat_new'], data['txn_cat_radius'])]
+            )
+
+    def save_balances(self, balances: AccountBalance):
+        cols = ['account_id', 'account_name', 'bal_available', 'bal_limit', 'bal_currency_code', 'bal_current', 'bal_date', 'raw_data']
+        vals = [[getattr(b, col) for b in balances] for col in cols]
+        new_bals = pd.DataFrame(dict(zip(cols, vals)))
+
+        self.upsert('raw_balances', new_bals)
+        self.save_payloads('balances', [balance_payload_key(a, d) for a, d in zip(new_bals['account_id'], new_bals['bal_date'])],
+                           new_bals['raw_data'])
+
+    def process_balances(self, start_date):
+        processed_bals_new = build_processed_balances(
+            self.read_table('account_info'),
+            self.read_table('raw_balances'),
+            self.read_table('processed_transactions'),
+            start_date
+        )
+        self.upsert('processed_balances', processed_bals_new)
+
+    def checkpoint(self):
+        """
+        Commits the open transaction and saves every table changed since the last
+        checkpoint (or never snapshotted) as its next snapshot version, then
+        deletes all but the newest snapshot_retention versions of each table (0
+        keeps every one) and the chunks only they used.
+        """
+        self.conn.commit()
+        changed = {row[0] for row in self.conn.execute("SELECT name FROM dirty_tables")}
+        for table in TABLE_COLUMNS:
+            if table in changed or not self.snapshots.versions(table):
+                self.snapshots.save(table, self.read_table(table), TABLE_KEYS[table])
+        with self.conn:
+            self.conn.execute("DELETE FROM dirty_tables")
+        self.snapshots.prune()
+
+    def list_snapshots(self) -> pd.DataFrame:
+        return self.snapshots.list()
+
+    def restore_table(self, name: str, version: int):
+        """
+        Replaces the rows of a table with those of a snapshot version. The restore
+        is itself saved as a new version, so it can be undone the same way.
+        """
+        if name not in TABLE_COLUMNS:
+            raise KeyError("Unknown table [%s], expected one of %s" % (name, list(TABLE_COLUMNS)))
+        restored = self.snapshots.load(name, version)
+        self.conn.commit()
+        with self.conn:
+            self.conn.execute("DELETE FROM %s" % name)
+        # Snapshots taken before a migration lack its columns, which restore as NULL
+        self.upsert(name, restored)
+        self.cat_index = None
+        self.checkpoint()
+
+    def process_bal_summaries(self):
+        processed_bals = self.read_table('processed_balances')
+        pass
@@ -0,0 +1,25 @@
+"""
+Plaid-shaped records for building small test databases.
+"""
+
+import datetime
+
+from plaidapi import AccountInfo, Transaction
+
+
+def account(account_id):
+    return {'account_id': account_id, 'name': 'acct ' + account_id, 'official_name': 'Official ' + account_id,
+            'type': 'credit', 'subtype': 'credit card', 'mask': '1234',
+            'balances': {'current': 100.0, 'available': 50.0, 'limit': 1000.0, 'iso_currency_code': 'USD'}}
+
+
+def account_info(*account_ids):
+    return [AccountInfo(account(a), 'Card') for a in account_ids]
+
+
+def transaction(i, account_id='A1', day=None, amount=None):
+    return Transaction({'account_id': account_id, 'category': None, 'transaction_id': 't%05d' % i,
+                        'date': datetime.date(2024, 1, 1) + datetime.timedelta(days=i if day is None else day),
+                        'name': 'SHOP %d' % i, 'merchant_name': None, 'amount': float(i if amount is None else amount),
+                        'pending': False,
+                        'personal_finance_category': {'primary': 'GENERAL_MERCHANDISE', 'detailed': 'GENERAL_MERCHANDISE_OTHER'}})
@@ -0,0 +1,56 @@
+"""
+Checks PlaidAPI makes one /accounts request per access token, shared by
+get_account_balance and get_account_info, and forgets a failed one.
+"""
+
+import concurrent.futures
+
+import pytest
+
+import fakeplaid
+import plaidapi
+
+
+@pytest.fixture
+def fake():
+    fake = fakeplaid.FakePlaid(fakeplaid.FakePlaidData(items=2, transactions_per_item=10),
+                               latency={'/accounts/balance/get': 0.2, '*': 0})
+    server = fakeplaid.start(fake)
+    papi = plaidapi.PlaidAPI('fake', 'fake', 'sandbox', host='http://127.0.0.1:%d' % server.server_address[1],
+                             max_retries=0)
+    yield fake, papi
+    server.shutdown()
+
+
+def test_balance_and_info_share_one_request(fake):
+    fake, papi = fake
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        balances = [pool.submit(papi.get_account_balance, 'access-fake-0') for _ in range(3)]
+        info = pool.submit(papi.get_account_info, 'access-fake-0', 'Fake0000')
+        assert all(len(b.result()) == 2 for b in balances)
+        assert [a.account_name_parent for a in info.result()] == ['Fake0000'] * 2
+    assert fake.requests == {'/accounts/balance/get': 1}
+
+    papi.get_account_balance('access-fake-1')
+    papi.get_account_info('access-fake-1', 'Fake0001')
+    assert fake.requests == {'/accounts/balance/get': 2}
+
+
+def test_cached_balances_without_realtime(fake):
+    fake, papi = fake
+    papi.get_account_balance('access-fake-0', realtime=False)
+    papi.get_account_info('access-fake-0', 'Fake0000')
+    assert fake.requests == {'/accounts/get': 1}
+    # A real-time balance is still requested once asked for
+    papi.get_account_balance('access-fake-0')
+    assert fake.requests == {'/accounts/get': 1, '/accounts/balance/get': 1}
+
+
+def test_failed_request_is_not_cached(fake):
+    fake, papi = fake
+    fake.error_rate, fake.errors = 1.0, ['ITEM_LOGIN_REQUIRED']
+    with pytest.raises(plaidapi.PlaidError):
+        papi.get_account_balance('access-fake-0')
+    fake.error_rate = 0.0
+    assert len(papi.get_account_balance('access-fake-0')) == 2
+    assert fake.requests == {'/accounts/balance/get': 2}
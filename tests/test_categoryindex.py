@@ -0,0 +1,158 @@
+"""
+Checks CategoryIndex predictions against the original row-level search, where
+the two are meant to agree, and pins the cases where they differ on purpose:
+a known name votes alone, without a search, and neighbours are distinct names voting with all of
+their rows. Also checks an index built up from saved deltas predicts like one
+built in one go.
+"""
+
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from Levenshtein import distance
+
+import fakeplaid
+from categorizer import build_prototypes, merge_prototypes, normalize_name
+from categoryindex import DELTA_ARRAYS, CategoryIndex
+
+
+def baseline_predict(uncat: pd.DataFrame, cat_data: pd.DataFrame) -> pd.Series:
+    # predict_categories before the categorizer rewrite: a cross join, rank by
+    # distance in cat_data order, and the mode of the 10 nearest categories
+    data = (
+        uncat.assign(keycol=1)[['txn_id', 'txn_name', 'keycol']]
+        .merge(cat_data.rename(columns={'txn_name': 'txn_name_r', 'txn_id': 'txn_id_r'}).assign(keycol=1),
+               how='inner', left_on='keycol', right_on='keycol')
+        .assign(distance=lambda x: x.apply(lambda x: distance(x.txn_name, x.txn_name_r), axis=1))
+        .assign(rank=lambda x: x.groupby('txn_id')['distance'].rank(method='first', ascending=True))
+        .query('rank <= 10')
+        .groupby('txn_id')
+        .agg({'txn_name': 'first', 'txn_cat': pd.Series.mode})
+        .reset_index()
+        .assign(txn_cat_new=lambda x: x['txn_cat'].apply(lambda x: x[0] if type(x) is np.ndarray else x))
+    )
+    return data.set_index('txn_id')['txn_cat_new']
+
+
+def predict(cat_data: pd.DataFrame, uncat: pd.DataFrame) -> pd.Series:
+    index = CategoryIndex(None)
+    index.reset(build_prototypes(cat_data))
+    return index.predict(uncat).set_index('txn_id')['txn_cat_new']
+
+
+def test_matches_baseline_on_distinct_names():
+    # One row per normalized name, in name order, and no query with a known name:
+    # the cases where prototypes and the row-level search agree exactly
+    data = fakeplaid.FakePlaidData(items=2, transactions_per_item=400, seed=3)
+    txns = [data.transaction(0, i) for i in range(400)]
+    cat_data = (pd.DataFrame({'txn_id': [t['transaction_id'] for t in txns],
+                              'txn_name': [normalize_name(t['name']) for t in txns],
+                              'txn_cat': [t['personal_finance_category']['primary'] for t in txns],
+                              'txn_date': pd.to_datetime([t['date'] for t in txns])})
+                .drop_duplicates(subset=['txn_name']).sort_values('txn_name').reset_index(drop=True))
+    rng = random.Random(3)
+    names = set(cat_data['txn_name'])
+    queries = [normalize_name(data.transaction(1, i)['name'] + rng.choice(['', ' X', 'Q'])) for i in range(80)]
+    queries = [q for q in queries if q not in names]
+    uncat = pd.DataFrame({'txn_id': ['u%03d' % i for i in range(len(queries))], 'txn_name': queries})
+
+    expected = baseline_predict(uncat, cat_data)
+    pd.testing.assert_series_equal(predict(cat_data, uncat).loc[expected.index], expected, check_names=False)
+
+
+def test_known_name_votes_alone():
+    # The row-level search would take the 10 nearest rows, most of them FOOD
+    cat_data = pd.DataFrame({
+        'txn_id': ['c%02d' % i for i in range(12)],
+        'txn_name': ['SHELL'] + ['SHELLY %d' % i for i in range(11)],
+        'txn_cat': ['GAS'] + ['FOOD'] * 11,
+        'txn_date': pd.to_datetime(['2024-01-01'] * 12),
+    })
+    uncat = pd.DataFrame({'txn_id': ['u1'], 'txn_name': ['shell ']})
+    assert baseline_predict(uncat.assign(txn_name='SHELL'), cat_data)['u1'] == 'FOOD'
+    assert predict(cat_data, uncat)['u1'] == 'GAS'
+
+
+def test_known_names_skip_search(monkeypatch):
+    cat_data = pd.DataFrame({
+        'txn_id': ['c%02d' % i for i in range(6)],
+        'txn_name': ['SHELL OIL', 'SHELL OIL', 'KROGER #55', 'NETFLIX', 'AMAZON MKTP', 'STARBUCKS'],
+        'txn_cat': ['GAS', 'GAS', 'FOOD', 'FUN', 'SHOP', 'FOOD'],
+        'txn_date': pd.to_datetime(['2024-01-01'] * 6),
+    })
+    index = CategoryIndex(None)
+    index.reset(build_prototypes(cat_data))
+    searched = []
+    neighbours = CategoryIndex.neighbours
+    monkeypatch.setattr(CategoryIndex, 'neighbours',
+                        lambda self, queries, **kwargs: searched.extend(queries) or neighbours(self, queries, **kwargs))
+    uncat = pd.DataFrame({'txn_id': ['u1', 'u2', 'u3'], 'txn_name': [' shell   oil', 'Kroger #55', 'SHELL OILS']})
+    for engine in ['levenshtein', 'tfidf']:
+        searched.clear()
+        predicted = index.predict(uncat, engine=engine).set_index('txn_id')
+        assert searched == ['SHELL OILS']
+        assert predicted.loc[['u1', 'u2'], 'txn_cat_new'].tolist() == ['GAS', 'FOOD']
+        assert predicted.loc[['u1', 'u2'], 'txn_cat_radius'].tolist() == [0, 0]
+
+
+def test_neighbours_are_distinct_names():
+    # ABCE is nearest, with five rows. The row-level search fills its 10 nearest
+    # with those and five GAS rows, a tie FOOD wins in sort order; the prototype
+    # search takes 10 distinct names, so all nine GAS names vote too
+    gas_names = ['AB%s' % pair for pair in ['FG', 'HI', 'JK', 'LM', 'NO', 'PQ', 'RS', 'TU', 'VW']]
+    cat_data = pd.DataFrame({
+        'txn_id': ['c%02d' % i for i in range(14)],
+        'txn_name': ['ABCE'] * 5 + gas_names,
+        'txn_cat': ['FOOD'] * 5 + ['GAS'] * 9,
+        'txn_date': pd.to_datetime(['2024-01-01'] * 14),
+    })
+    uncat = pd.DataFrame({'txn_id': ['u1'], 'txn_name': ['ABCD']})
+    assert baseline_predict(uncat, cat_data)['u1'] == 'FOOD'
+    assert predict(cat_data, uncat)['u1'] == 'GAS'
+
+
+@pytest.mark.parametrize('merge_ratio', [0.25, 10.0])
+def test_incremental_matches_rebuild(tmp_path, merge_ratio):
+    # Built up through add() calls, saved and reloaded between them, the index
+    # predicts like one reset from the merged prototypes in one go
+    data = fakeplaid.FakePlaidData(items=2, transactions_per_item=600, seed=5)
+    txns = [data.transaction(0, i) for i in range(600)]
+    cat_data = pd.DataFrame({'txn_id': [t['transaction_id'] for t in txns],
+                             'txn_name': [t['name'] for t in txns],
+                             'txn_cat': [t['personal_finance_category']['primary'] for t in txns],
+                             'txn_date': pd.to_datetime([t['date'] for t in txns])})
+    folder = str(tmp_path / 'cat_index')
+    index = CategoryIndex(folder, merge_ratio=merge_ratio)
+    index.reset(build_prototypes(cat_data[:300]))
+    index.save()
+    prototypes = build_prototypes(cat_data[:300])
+    for start in range(300, 600, 50):
+        batch = build_prototypes(cat_data[start:start + 50].assign(
+            txn_cat=lambda x: x['txn_cat'].where(x.index % 7 != 0, 'NEW_%d' % start)))
+        index = CategoryIndex(folder, merge_ratio=merge_ratio)
+        assert index.load()
+        index.add(batch)
+        written = []
+        index.save(stage=lambda p: written.append(os.path.basename(p)) or p)
+        if merge_ratio > 1:
+            assert set(written) == {'%s.npy' % a for a in DELTA_ARRAYS} | {'meta.json'}
+        prototypes = merge_prototypes(prototypes, batch)
+
+    index = CategoryIndex(folder, merge_ratio=merge_ratio)
+    assert index.load()
+    if merge_ratio > 1:
+        assert len(index.names.added) > 0
+    fresh = CategoryIndex(None)
+    fresh.reset(prototypes)
+    assert sorted(index.names) == sorted(fresh.names)
+    assert [index.names[i] for i in index.lookup(list(fresh.names))] == list(fresh.names)
+    assert index.lookup(['NO SUCH NAME']).tolist() == [-1]
+
+    queries = [data.transaction(1, i)['name'] + ' 1' for i in range(60)] + [txns[i]['name'] for i in range(0, 600, 60)]
+    uncat = pd.DataFrame({'txn_id': ['u%03d' % i for i in range(len(queries))], 'txn_name': queries})
+    for engine, candidates in [('levenshtein', None), ('levenshtein', 50), ('tfidf', None)]:
+        pd.testing.assert_frame_equal(index.predict(uncat, engine=engine, candidates=candidates, half_life_days=30),
+                                      fresh.predict(uncat, engine=engine, candidates=candidates, half_life_days=30))
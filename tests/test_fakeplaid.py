@@ -0,0 +1,106 @@
+"""
+Checks the fake Plaid server serves the same data for the same seed: pages of
+/transactions/get cover a date window once, /transactions/sync sends every
+transaction and then rounds of changes that never touch a removed transaction
+again, and injected errors repeat from run to run.
+"""
+
+import datetime
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import fakeplaid
+
+ANCHOR = datetime.date(2024, 6, 30)
+
+
+def make_fake(**kwargs):
+    data = fakeplaid.FakePlaidData(items=2, transactions_per_item=700, days=365, seed=11, anchor_date=ANCHOR)
+    return fakeplaid.FakePlaid(data, **kwargs)
+
+
+def get_pages(fake, start_date, end_date, count=100):
+    txns, offset = [], 0
+    while True:
+        page = fake.handle('/transactions/get', {'access_token': 'access-fake-1', 'start_date': start_date,
+                                                 'end_date': end_date, 'options': {'count': count, 'offset': offset}})
+        txns += page['transactions']
+        offset += count
+        if offset >= page['total_transactions']:
+            return txns, page['total_transactions']
+
+
+def test_pages_cover_window_once():
+    txns, total = get_pages(make_fake(), '2024-03-01', '2024-03-31')
+    ids = [t['transaction_id'] for t in txns]
+    assert len(ids) == total == len(set(ids)) > 0
+    assert all('2024-03-01' <= t['date'] <= '2024-03-31' for t in txns)
+    # Everything in the window, as a full scan of the item would find it
+    data = make_fake().data
+    expected = {data.transaction(1, i)['transaction_id'] for i in range(700)
+                if '2024-03-01' <= data.transaction(1, i)['date'] <= '2024-03-31'}
+    assert set(ids) == expected
+    assert get_pages(make_fake(), '2024-03-01', '2024-03-31', count=37)[0] == txns
+
+
+def test_sync_rounds():
+    fake = make_fake()
+    cursor, added = None, []
+    while True:
+        page = fake.handle('/transactions/sync', {'access_token': 'access-fake-0', 'cursor': cursor, 'count': 300})
+        added += [t['transaction_id'] for t in page['added']]
+        cursor = page['next_cursor']
+        if not page['has_more']:
+            break
+    assert len(added) == len(set(added)) == 700
+
+    removed = set()
+    for _ in range(5):
+        page = fake.handle('/transactions/sync', {'access_token': 'access-fake-0', 'cursor': cursor})
+        modified = {t['transaction_id'] for t in page['modified']}
+        gone = {t['transaction_id'] for t in page['removed']}
+        assert len(modified) == 5 and len(gone) == 2
+        assert not (modified | gone) & removed and not modified & gone
+        removed |= gone
+        cursor = page['next_cursor']
+    again = make_fake().handle('/transactions/sync', {'access_token': 'access-fake-0', 'cursor': cursor})
+    assert again['modified'] == fake.handle('/transactions/sync', {'access_token': 'access-fake-0', 'cursor': cursor})['modified']
+
+
+def test_injected_errors_repeat():
+    def outcomes():
+        fake = make_fake(error_rate=0.5, errors=['RATE_LIMIT_EXCEEDED', 'INSTITUTION_DOWN'], seed=3)
+        codes = []
+        for _ in range(40):
+            try:
+                fake.handle('/accounts/get', {'access_token': 'access-fake-0'})
+                codes.append(None)
+            except fakeplaid.FakePlaidError as ex:
+                assert (ex.status, ex.error_type) == fakeplaid.ERRORS[ex.error_code]
+                codes.append(ex.error_code)
+        return codes
+    codes = outcomes()
+    assert codes == outcomes()
+    assert {None, 'RATE_LIMIT_EXCEEDED', 'INSTITUTION_DOWN'} == set(codes)
+
+
+def test_http_errors_are_plaid_shaped():
+    httpd = fakeplaid.start(make_fake())
+    try:
+        url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+        def post(path, body):
+            request = urllib.request.Request(url + path, data=json.dumps(body).encode('utf-8'),
+                                             headers={'Content-type': 'application/json'})
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        assert len(post('/accounts/get', {'access_token': 'access-fake-1'})['accounts']) == 2
+        with pytest.raises(urllib.error.HTTPError) as ex:
+            post('/accounts/get', {'access_token': 'access-fake-9'})
+        assert ex.value.code == 400
+        assert json.loads(ex.value.read())['error_code'] == 'INVALID_ACCESS_TOKEN'
+    finally:
+        httpd.shutdown()
@@ -0,0 +1,91 @@
+"""
+Interrupts a TransactionsDB checkpoint on either side of the journal's commit
+point, reopens the database and checks it holds all of the old tables or all
+of the new ones, with no staging files left behind, found without walking the
+database folder.
+"""
+
+import os
+
+import pytest
+
+import journal
+import transactionsdb
+from helpers import account_info, transaction
+
+
+def add_transactions(dbfolder, ids, interrupt=None):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    db.save_account_info(account_info('A1'))
+    db.save_transactions([transaction(i) for i in ids])
+    db.process_transactions()
+    if interrupt is None:
+        db.checkpoint()
+    else:
+        with pytest.raises(RuntimeError):
+            db.checkpoint()
+
+
+def pending_files(dbfolder):
+    return [f for _, _, files in os.walk(dbfolder) for f in files if f.endswith('.pending')]
+
+
+def processed_ids(dbfolder):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    ids = set(db.get_processed_transactions()['txn_id'])
+    assert db.key_index('processed_txns').contains(sorted(ids)).all()
+    assert len(db.key_index('processed_txns')) == len(ids)
+    return ids
+
+
+def crash(*args, **kwargs):
+    raise RuntimeError("interrupted")
+
+
+@pytest.fixture
+def dbfolder(tmp_path):
+    folder = tmp_path / 'db'
+    (folder / 'backup').mkdir(parents=True)
+    add_transactions(str(folder), range(10))
+    return str(folder)
+
+
+def test_interrupted_before_commit_keeps_old_tables(dbfolder, monkeypatch):
+    # The journal is never written, so the staged tables are discarded on reopen
+    monkeypatch.setattr(journal, 'atomic_write', crash)
+    add_transactions(dbfolder, range(10, 20), interrupt=True)
+    monkeypatch.undo()
+    assert pending_files(dbfolder)
+
+    assert processed_ids(dbfolder) == {'t%05d' % i for i in range(10)}
+    assert not pending_files(dbfolder)
+    assert not os.path.exists(dbfolder + '/journal.json')
+
+    # The raw fragments written before the checkpoint are still picked up
+    add_transactions(dbfolder, [])
+    assert processed_ids(dbfolder) == {'t%05d' % i for i in range(20)}
+
+
+def test_interrupted_after_commit_rolls_forward(dbfolder, monkeypatch):
+    # The journal is written but none of its renames happen until reopen
+    monkeypatch.setattr(journal.Journal, 'apply', crash)
+    add_transactions(dbfolder, range(10, 20), interrupt=True)
+    monkeypatch.undo()
+    assert os.path.exists(dbfolder + '/journal.json')
+
+    assert processed_ids(dbfolder) == {'t%05d' % i for i in range(20)}
+    assert not pending_files(dbfolder)
+    assert not os.path.exists(dbfolder + '/journal.json')
+
+
+def test_recover_only_looks_in_staging_folder(dbfolder, monkeypatch):
+    monkeypatch.setattr(journal, 'atomic_write', crash)
+    add_transactions(dbfolder, range(10, 20), interrupt=True)
+    monkeypatch.undo()
+    assert sorted(pending_files(dbfolder)) == sorted(os.listdir(dbfolder + '/.staging'))
+
+    def no_walk(*args, **kwargs):
+        raise AssertionError("walked the database folder")
+    monkeypatch.setattr(os, 'walk', no_walk)
+    assert not journal.Journal(dbfolder).recover()
+    assert os.listdir(dbfolder + '/.staging') == []
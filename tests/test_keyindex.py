@@ -0,0 +1,79 @@
+"""
+Builds a KeyIndex up through add() calls, saved and reloaded between them, and
+checks it answers like an index reset from the same keys in one go, and that
+keys removed from it can be added back.
+"""
+
+import numpy as np
+import pytest
+
+from keyindex import KeyIndex
+
+KEYS = ['t%06d' % i for i in range(2000)]
+
+
+def batches(rng):
+    # Overlapping batches, so some keys are added more than once
+    for _ in range(12):
+        start = rng.integers(0, len(KEYS) - 200)
+        yield KEYS[start:start + rng.integers(1, 200)]
+
+
+@pytest.mark.parametrize('merge_ratio', [0.25, 10.0])
+def test_incremental_matches_rebuild(tmp_path, merge_ratio):
+    rng = np.random.default_rng(0)
+    added = []
+    index = KeyIndex(str(tmp_path), 'txns', merge_ratio=merge_ratio)
+    for keys in batches(rng):
+        index.add(keys)
+        index.save()
+        index = KeyIndex(str(tmp_path), 'txns', merge_ratio=merge_ratio)
+        assert index.load()
+        added += keys
+
+    fresh = KeyIndex(str(tmp_path / 'fresh'), 'txns')
+    fresh.reset(added)
+    assert len(index) == len(fresh) == len(set(added))
+    np.testing.assert_array_equal(index.contains(KEYS), fresh.contains(KEYS))
+    if merge_ratio > 1:
+        assert index.delta.shape[0] > 0
+
+
+@pytest.mark.parametrize('merge_ratio', [0.25, 10.0])
+def test_incremental_values_match_rebuild(tmp_path, merge_ratio):
+    # Later values of a key replace earlier ones, as when a transaction moves partition
+    rng = np.random.default_rng(1)
+    latest = {}
+    index = KeyIndex(str(tmp_path), 'txns', merge_ratio=merge_ratio, with_values=True)
+    for keys in batches(rng):
+        values = rng.integers(0, 5, len(keys))
+        index.add(keys, values)
+        index.save()
+        index = KeyIndex(str(tmp_path), 'txns', merge_ratio=merge_ratio, with_values=True)
+        assert index.load()
+        latest.update(zip(keys, values.tolist()))
+
+    fresh = KeyIndex(str(tmp_path / 'fresh'), 'txns', with_values=True)
+    fresh.reset(list(latest), list(latest.values()))
+    np.testing.assert_array_equal(index.lookup(KEYS), fresh.lookup(KEYS))
+    np.testing.assert_array_equal(index.lookup(KEYS) >= 0, [k in latest for k in KEYS])
+
+
+@pytest.mark.parametrize('with_values', [False, True])
+def test_removed_keys_can_be_added_again(tmp_path, with_values):
+    index = KeyIndex(str(tmp_path), 'txns', with_values=with_values)
+    index.reset(KEYS[:1000], list(range(1000)) if with_values else None)
+    index.add(KEYS[1000:1100], list(range(1000, 1100)) if with_values else None)
+    index.remove(KEYS[990:1010] + ['missing'])
+    index.save()
+    index = KeyIndex(str(tmp_path), 'txns', with_values=with_values)
+    assert index.load()
+    np.testing.assert_array_equal(index.contains(KEYS[:1100]), [not 990 <= i < 1010 for i in range(1100)])
+
+    # Added back with the value it had, which is not skipped as unchanged
+    index.add(KEYS[995:1005], list(range(995, 1005)) if with_values else None)
+    index.merge_delta()
+    np.testing.assert_array_equal(index.contains(KEYS[:1100]), [not (990 <= i < 995 or 1005 <= i < 1010) for i in range(1100)])
+    if with_values:
+        assert index.lookup(KEYS[995:1005]).tolist() == list(range(995, 1005))
+        assert (index.base_values >= 0).all()
@@ -0,0 +1,45 @@
+"""
+Checks RequestScheduler retries transient failures of the read endpoints only,
+and throttles them at the configured rates.
+"""
+
+import plaid
+import pytest
+
+import config
+from plaidapi import RequestScheduler
+
+
+def failing(failures):
+    calls = []
+
+    def fn(request):
+        calls.append(request)
+        if len(calls) <= failures:
+            raise plaid.ApiException(status=500, reason='Internal Server Error')
+        return {'ok': True}
+    return fn, calls
+
+
+@pytest.mark.parametrize('endpoint', ['transactions_get', 'transactions_sync', 'accounts_balance_get', 'accounts_get'])
+def test_read_endpoints_are_retried(endpoint):
+    scheduler = RequestScheduler(rate_limits={}, max_retries=3, sleep=lambda seconds: None)
+    fn, calls = failing(2)
+    assert scheduler.call(endpoint, fn, 'request') == {'ok': True}
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('endpoint', ['item_public_token_exchange', 'link_token_create'])
+def test_other_endpoints_are_not_retried(endpoint):
+    scheduler = RequestScheduler(rate_limits={}, max_retries=3, sleep=lambda seconds: None)
+    fn, calls = failing(1)
+    with pytest.raises(plaid.ApiException):
+        scheduler.call(endpoint, fn, 'request')
+    assert len(calls) == 1
+
+
+def test_configured_rate_limits(tmp_path):
+    (tmp_path / 'config').write_text("[PLAID]\nclient_id = x\nsecret = y\nrate_limits = accounts_get: 30, institutions_get:5\n")
+    limits = config.Config(str(tmp_path / 'config')).get_rate_limits()
+    assert limits == dict(config.DEFAULT_RATE_LIMITS, accounts_get=30.0, institutions_get=5.0)
+    assert RequestScheduler().rate_limits == config.DEFAULT_RATE_LIMITS
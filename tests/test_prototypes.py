@@ -0,0 +1,68 @@
+"""
+Checks training prototypes: cat_data compacts to one row per normalized name
+and category whether built in one go or merged batch by batch, and the
+database keeps cat_prototypes in step with cat_data, rebuilding it when it
+falls behind.
+"""
+
+import pandas as pd
+
+import transactionsdb
+from categorizer import build_prototypes, merge_prototypes
+from helpers import account_info, transaction
+
+
+def cat_rows(names, cats, days):
+    return pd.DataFrame({'txn_id': ['c%03d' % i for i in range(len(names))], 'txn_name': names, 'txn_cat': cats,
+                         'txn_date': pd.Timestamp('2024-01-01') + pd.to_timedelta(days, unit='D')})
+
+
+def sorted_prototypes(prototypes):
+    return (prototypes.assign(txn_cat=prototypes['txn_cat'].astype(object))
+            .sort_values(['txn_name_norm', 'txn_cat']).reset_index(drop=True))
+
+
+def test_build_prototypes():
+    cat_data = cat_rows(['shell  oil', 'SHELL OIL', 'Shell Oil', 'SHELL OIL', 'KROGER'],
+                        ['GAS', 'GAS', 'FOOD', None, 'FOOD'], [3, 9, 5, 20, 1])
+    prototypes = sorted_prototypes(build_prototypes(cat_data))
+    assert prototypes.to_dict('records') == [
+        {'txn_name_norm': 'KROGER', 'txn_cat': 'FOOD', 'txn_count': 1, 'last_seen': pd.Timestamp('2024-01-02')},
+        {'txn_name_norm': 'SHELL OIL', 'txn_cat': 'FOOD', 'txn_count': 1, 'last_seen': pd.Timestamp('2024-01-06')},
+        {'txn_name_norm': 'SHELL OIL', 'txn_cat': 'GAS', 'txn_count': 2, 'last_seen': pd.Timestamp('2024-01-10')},
+    ]
+
+
+def test_merged_batches_match_one_build():
+    names = ['SHOP %d' % (i % 13) for i in range(200)]
+    cat_data = cat_rows(names, ['FOOD' if i % 3 else 'GAS' for i in range(200)], [(i * 7) % 90 for i in range(200)])
+    prototypes = None
+    for start in range(0, 200, 30):
+        prototypes = merge_prototypes(prototypes, build_prototypes(cat_data[start:start + 30]))
+    pd.testing.assert_frame_equal(sorted_prototypes(prototypes), sorted_prototypes(build_prototypes(cat_data)))
+
+
+def test_database_prototypes_follow_cat_data(tmp_path):
+    (tmp_path / 'backup').mkdir()
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    db.save_account_info(account_info('A1'))
+    db.save_transactions([transaction(i) for i in range(60)])
+    db.process_transactions()
+    for batch in [range(0, 20), range(20, 45)]:
+        txns = db.read_table('processed_txns').astype({'txn_cat': object})
+        rows = txns['txn_id'].isin(['t%05d' % i for i in batch])
+        txns.loc[rows, 'txn_cat'] = ['FOOD' if i % 2 else 'GAS' for i in range(rows.sum())]
+        txns.loc[rows, 'txn_cat_flag'] = True
+        db.write_table('processed_txns', txns, new_keys=[])
+        db.update_training_data()
+    db.checkpoint()
+
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    cat_data = db.read_table('cat_data')
+    assert len(cat_data) == 45
+    expected = sorted_prototypes(build_prototypes(cat_data))
+    pd.testing.assert_frame_equal(sorted_prototypes(db.read_table('cat_prototypes')), expected)
+
+    # cat_data restored to fewer rows than the prototypes count: rebuilt from it
+    db.write_table('cat_data', cat_data[:30])
+    assert db.category_prototypes()['txn_count'].sum() == 30
@@ -0,0 +1,116 @@
+"""
+Checks the raw_transactions dataset of the parquet backend: new fragments are
+found from the raw_txns key index's fragment log rather than by walking the
+dataset, the log only holds fragments not yet processed, and a partition's
+processed fragments are compacted once there are enough of them. Payloads are
+stored before the index records their rows.
+"""
+
+import os
+import shutil
+
+import pytest
+
+import transactionsdb
+from helpers import account_info, transaction
+
+
+def no_walk(self):
+    raise AssertionError("walked the raw_transactions dataset")
+
+
+def run(dbfolder, txns, accounts=('A1',)):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    db.save_account_info(account_info(*accounts))
+    db.save_transactions(txns)
+    db.process_transactions()
+    db.checkpoint()
+    return db
+
+
+def processed_ids(db):
+    return set(db.get_processed_transactions()['txn_id'])
+
+
+@pytest.fixture
+def dbfolder(tmp_path):
+    (tmp_path / 'backup').mkdir()
+    run(str(tmp_path), [transaction(i) for i in range(40)])
+    return str(tmp_path)
+
+
+def test_new_fragments_come_from_the_log(dbfolder, monkeypatch):
+    monkeypatch.setattr(transactionsdb.TransactionsDB, 'raw_txn_fragments', no_walk)
+    db = transactionsdb.TransactionsDB(dbfolder)
+    assert db.key_index('raw_txns').meta['fragments'] == {}
+    seq = db.key_index('raw_txns').meta['fragment_seq']
+
+    db = run(dbfolder, [transaction(i) for i in range(30, 60)])
+    assert processed_ids(db) == {'t%05d' % i for i in range(60)}
+    meta = db.key_index('raw_txns').meta
+    assert meta['fragment_seq'] == seq + 1
+    # Processed and committed, so dropped from the log
+    assert meta['fragments'] == {}
+
+    # Nothing new: nothing is read
+    monkeypatch.setattr(transactionsdb.TransactionsDB, 'read_raw_transactions', no_walk)
+    transactionsdb.TransactionsDB(dbfolder).process_transactions()
+
+
+def test_deferred_account(dbfolder, monkeypatch):
+    monkeypatch.setattr(transactionsdb.TransactionsDB, 'raw_txn_fragments', no_walk)
+    db = run(dbfolder, [transaction(i, account_id='B2') for i in range(100, 110)])
+    assert processed_ids(db) == {'t%05d' % i for i in range(40)}
+    assert len(db.key_index('processed_txns').meta['deferred_fragments']) > 0
+
+    db = run(dbfolder, [], accounts=('A1', 'B2'))
+    assert processed_ids(db) == {'t%05d' % i for i in list(range(40)) + list(range(100, 110))}
+    assert db.key_index('processed_txns').meta['deferred_fragments'] == []
+
+
+def test_lost_index_is_rebuilt(dbfolder):
+    shutil.rmtree(dbfolder + '/index')
+    db = run(dbfolder, [transaction(i) for i in range(30, 50)])
+    assert processed_ids(db) == {'t%05d' % i for i in range(50)}
+    assert len(db.get_processed_transactions()) == 50
+    assert len(db.key_index('raw_txns')) == 50
+
+
+def test_partition_fragments_are_compacted(dbfolder):
+    # Daily syncs all landing in January 2024
+    part_dir = dbfolder + '/raw_transactions/account_id=A1/txn_month=2024-01'
+    for i in range(transactionsdb.COMPACT_FRAGMENTS + 3):
+        db = run(dbfolder, [transaction(100 + i, day=5)])
+    fragments = [f for f in os.listdir(part_dir) if f.endswith('.parquet')]
+    assert len(fragments) < transactionsdb.COMPACT_FRAGMENTS
+    index = db.key_index('raw_txns')
+    assert index.meta['partition_fragments'][index.meta['partitions'].index(['A1', '2024-01'])] == len(fragments)
+
+    db = transactionsdb.TransactionsDB(dbfolder)
+    ids = {'t%05d' % i for i in list(range(40)) + list(range(100, 100 + transactionsdb.COMPACT_FRAGMENTS + 3))}
+    assert set(db.read_raw_transactions(columns=['txn_id'])['txn_id']) == ids
+    assert processed_ids(db) == ids
+
+    # Removal still finds the partition of a compacted transaction
+    db.remove_transactions(['t00100', 't00003'])
+    db.checkpoint()
+    db = transactionsdb.TransactionsDB(dbfolder)
+    assert set(db.read_raw_transactions(columns=['txn_id'])['txn_id']) == ids - {'t00100', 't00003'}
+
+
+def test_payloads_written_before_index(dbfolder, monkeypatch):
+    # Interrupted before the index is saved: the payloads are already stored, and
+    # the next sync writes the rows the index never recorded
+    def crash(self, stage=None):
+        raise RuntimeError("interrupted")
+    monkeypatch.setattr(transactionsdb.KeyIndex, 'save', crash)
+    db = transactionsdb.TransactionsDB(dbfolder)
+    with pytest.raises(RuntimeError):
+        db.save_transactions([transaction(i) for i in range(100, 110)])
+    monkeypatch.undo()
+    ids = ['t%05d' % i for i in range(100, 110)]
+    assert sorted(db.payloads.get('transactions', ids)) == ids
+
+    db = run(dbfolder, [transaction(i) for i in range(100, 110)])
+    assert processed_ids(db) == {'t%05d' % i for i in list(range(40)) + list(range(100, 110))}
+    assert db.get_processed_transactions().shape[0] == 50
@@ -0,0 +1,87 @@
+"""
+Checks that after new training rows only the transactions whose radius holds
+one of the retrained names are predicted again, and that this ends up where
+predicting every transaction again would with the exact levenshtein search.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import fakeplaid
+import transactionsdb
+from categorizer import build_prototypes, normalize_name
+from categoryindex import CategoryIndex
+from plaidapi import AccountInfo, TransactionColumns
+
+
+def fake_frame(item, count, seed=4):
+    data = fakeplaid.FakePlaidData(items=2, transactions_per_item=count, seed=seed)
+    txns = [data.transaction(item, i) for i in range(count)]
+    return pd.DataFrame({'txn_id': [t['transaction_id'] for t in txns],
+                         'txn_name': [t['name'] for t in txns],
+                         'txn_cat': [t['personal_finance_category']['primary'] for t in txns],
+                         'txn_date': pd.to_datetime([t['date'] for t in txns])})
+
+
+def test_outdated_matches_full_prediction():
+    cat_data = fake_frame(0, 400)
+    uncat = fake_frame(1, 300)[['txn_id', 'txn_name']]
+    index = CategoryIndex(None)
+    index.reset(build_prototypes(cat_data))
+    before = index.predict(uncat)
+
+    # A merchant fixed in the sheet, and a few names never seen before
+    fixed = uncat.iloc[[0, 1, 2]].assign(txn_id=['n1', 'n2', 'n3'], txn_cat='FIXED', txn_date=pd.Timestamp('2024-01-01'))
+    new_rows = pd.concat([fixed, fixed.assign(txn_id=['n4', 'n5', 'n6'], txn_name=lambda x: x['txn_name'] + ' ZZ')])
+    new_prototypes = build_prototypes(new_rows)
+    index.add(new_prototypes)
+    outdated = index.outdated(before, list(new_prototypes['txn_name_norm'].unique()))
+    assert 3 <= outdated.sum() < len(uncat) / 2
+
+    again = index.predict(uncat[uncat['txn_id'].isin(before['txn_id'][outdated])]).set_index('txn_id')
+    incremental = before.set_index('txn_id')
+    incremental.loc[again.index] = again
+    full = index.predict(uncat).set_index('txn_id')
+    pd.testing.assert_frame_equal(incremental, full)
+    assert (full.loc[uncat['txn_id'][:3], 'txn_cat_new'] == 'FIXED').all()
+
+
+def test_predict_categories_repredicts_outdated_only(tmp_path, monkeypatch):
+    (tmp_path / 'backup').mkdir()
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=500, seed=6)
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    db.save_account_info([AccountInfo(a, 'Fake0000') for a in data.accounts(0)])
+    db.save_transactions(TransactionColumns.from_json([data.transaction(0, i) for i in range(500)]))
+    db.process_transactions()
+
+    def confirm(txn_ids, cats):
+        txns = db.read_table('processed_txns').astype({'txn_cat': object})
+        rows = txns['txn_id'].isin(txn_ids)
+        txns.loc[rows, 'txn_cat'] = cats
+        txns.loc[rows, 'txn_cat_flag'] = True
+        db.write_table('processed_txns', txns, new_keys=[])
+        db.update_training_data()
+        db.predict_categories()
+
+    txns = db.read_table('processed_txns')
+    plaid_cats = {t['transaction_id']: t['personal_finance_category']['primary'] for t in
+                  (data.transaction(0, i) for i in range(500))}
+    trained = txns['txn_id'][:250]
+    confirm(trained, trained.map(plaid_cats).values)
+
+    predicted = []
+    predict = CategoryIndex.predict
+    monkeypatch.setattr(CategoryIndex, 'predict', lambda self, uncat, **kwargs: (predicted.append(len(uncat)),
+                                                                                   predict(self, uncat, **kwargs))[1])
+    name = normalize_name(txns['txn_name'].iloc[300])
+    fixed = txns['txn_id'][txns['txn_name'].map(normalize_name) == name].iloc[:1]
+    confirm(fixed, 'FIXED')
+    assert 0 < predicted[0] < 100
+
+    txns = db.read_table('processed_txns')
+    unconfirmed = txns[~txns['txn_cat_flag']]
+    full = predict(db.category_index(), unconfirmed).set_index('txn_id')['txn_cat_new']
+    np.testing.assert_array_equal(unconfirmed.set_index('txn_id')['txn_cat'].astype(object).loc[full.index].values,
+                                  full.values)
+    assert (txns.loc[txns['txn_name'].map(normalize_name) == name, 'txn_cat'] == 'FIXED').all()
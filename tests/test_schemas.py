@@ -0,0 +1,58 @@
+"""
+Checks the schema registry: conform() casts only what is not already of its
+registered type, and the parquet backend writes every table with its schema
+and reads it back with the compact dtypes.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import transactionsdb
+from helpers import account_info, transaction
+from schemas import SCHEMAS, conform, pandas_dtype, to_arrow
+
+
+def test_conform_casts_once():
+    df = pd.DataFrame({'txn_id': ['t1', 't2'], 'txn_cat': ['FOOD', None], 'txn_cat_flag': [1, 0],
+                       'txn_date': ['2024-01-01', '2024-01-02'], 'extra': [1, 2]})
+    conformed = conform(df, 'cat_data')
+    assert isinstance(conformed['txn_cat'].dtype, pd.CategoricalDtype)
+    assert conformed['txn_cat'].isnull().tolist() == [False, True]
+    assert conformed['txn_date'].dtype == 'datetime64[ns]'
+    assert conformed['extra'].dtype == np.int64
+    assert conform(conformed, 'cat_data') is conformed
+
+
+def test_conform_keeps_nulls():
+    df = pd.DataFrame({'account_number': [1234, None], 'txn_cat_flag': [True, None]})
+    assert conform(df, 'account_info')['account_number'][0] == '1234.0'
+    assert conform(df, 'account_info')['account_number'].isnull().tolist() == [False, True]
+    assert conform(df, 'gsheet_txns')['txn_cat_flag'].tolist() == [True, None]
+
+
+def test_to_arrow_uses_registered_types():
+    df = pd.DataFrame({'txn_name_norm': ['SHOP'], 'txn_cat': ['FOOD'], 'txn_count': [2],
+                       'last_seen': pd.to_datetime(['2024-01-01']), 'extra': [1.5]})
+    table = to_arrow(df, 'cat_prototypes')
+    assert table.schema.field('txn_cat').type == SCHEMAS['cat_prototypes'].field('txn_cat').type
+    assert str(table.schema.field('extra').type) == 'double'
+
+
+def test_tables_round_trip_with_schemas(tmp_path):
+    (tmp_path / 'backup').mkdir()
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    db.save_account_info(account_info('A1', 'A2'))
+    db.save_transactions([transaction(i, account_id='A%d' % (i % 2 + 1)) for i in range(20)])
+    db.process_transactions()
+    db.checkpoint()
+
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    for name in ['processed_txns', 'account_info']:
+        schema = pq.read_schema(db.paths[name])
+        df = db.read_table(name)
+        assert set(df.columns) <= set(SCHEMAS[name].names)
+        for column in df.columns:
+            registered = SCHEMAS[name].field(column).type
+            assert schema.field(column).type == registered, (name, column)
+            assert str(df[column].dtype) == pandas_dtype(registered), (name, column)
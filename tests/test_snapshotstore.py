@@ -0,0 +1,44 @@
+"""
+Saves several versions of a table to a SnapshotStore, prunes them to the
+retention and restores each version kept.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from snapshotstore import SnapshotStore
+
+
+def table(n, changed=()):
+    df = pd.DataFrame({'txn_id': ['t%05d' % i for i in range(n)], 'txn_amount': [float(i) for i in range(n)]})
+    df.loc[df['txn_id'].isin(changed), 'txn_amount'] += 0.5
+    return df
+
+
+def objects(store):
+    return {f for _, _, files in os.walk(store.folder + '/objects') for f in files}
+
+
+def test_save_prune_restore(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'snapshots'), retention=2, chunk_rows=16)
+    versions = [table(500), table(600), table(600, changed=['t00007']), table(400, changed=['t%05d' % i for i in range(400)])]
+    for i, df in enumerate(versions):
+        assert store.save('processed_txns', df, ['txn_id']) == i + 1
+
+    # Chunks are shared: changing one row only writes the chunk it falls in
+    assert store.manifest('processed_txns', 3)['new_chunks'] == 1
+
+    store.prune()
+    assert store.versions('processed_txns') == [3, 4]
+    kept = {d for v in [3, 4] for d in store.manifest('processed_txns', v)['chunks']}
+    assert objects(store) == {d + '.parquet' for d in kept}
+    for version in [3, 4]:
+        restored = store.load('processed_txns', version)
+        pd.testing.assert_frame_equal(restored, versions[version - 1].sort_values('txn_id').reset_index(drop=True))
+    pd.testing.assert_frame_equal(store.load('processed_txns'), store.load('processed_txns', 4))
+
+    with pytest.raises(KeyError):
+        store.load('processed_txns', 1)
+    assert store.list()['version'].tolist() == [3, 4]
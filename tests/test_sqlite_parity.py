@@ -0,0 +1,84 @@
+"""
+Checks the sqlite backend gives the same results as the parquet one for the
+same run: processed transactions, categories synced from the sheet and
+predicted, balances and transaction id lookups, over two syncs with an update
+and a removal in between.
+"""
+
+import datetime
+
+import pandas as pd
+import pytest
+
+import sqlitedb
+import transactionsdb
+from helpers import account, account_info, transaction
+from plaidapi import AccountBalance
+
+NAMES = ['STARBUCKS 12', 'SHELL OIL', 'AMAZON MKTP', 'KROGER #55', 'NETFLIX']
+COLUMNS = ['txn_id', 'txn_name', 'txn_date', 'txn_amount', 'account_name_parent', 'txn_cat', 'txn_cat_flag']
+
+
+def named(i, **kwargs):
+    txn = transaction(i, account_id='A%d' % (i % 2 + 1), day=i % 40, **kwargs)
+    txn.txn_name = '%s %d' % (NAMES[i % len(NAMES)], i % 7)
+    return txn
+
+
+def sheet(processed, count):
+    rows = processed.sort_values('txn_id').head(count)
+    return pd.DataFrame({'Date': (rows['txn_date'] - pd.Timestamp('1899-12-30')).dt.days,
+                         'Description': rows['txn_name'], 'Amount': rows['txn_amount'],
+                         'Category': ['Food' if n.startswith(('STAR', 'KROG')) else 'Other' for n in rows['txn_name']],
+                         'Account': rows['account_name_parent'], 'Complete': 'True', 'Key': rows['txn_id']})
+
+
+def run(db):
+    for sync in range(2):
+        db.save_account_info(account_info('A1', 'A2'))
+        db.save_balances([AccountBalance(account(a)) for a in ['A1', 'A2']])
+        if sync == 0:
+            db.save_transactions([named(i) for i in range(120)])
+        else:
+            db.update_transactions([named(i, amount=i + 0.5) for i in range(100, 160)])
+            db.remove_transactions(['t%05d' % i for i in range(5)])
+        db.process_transactions()
+        db.update_gsheet_txns(sheet(db.get_processed_transactions(), 40))
+        db.sync_categories()
+        db.update_training_data()
+        db.predict_categories()
+        db.process_balances(datetime.date(2024, 1, 1))
+        db.checkpoint()
+
+
+@pytest.fixture
+def dbs(tmp_path):
+    (tmp_path / 'parquet' / 'backup').mkdir(parents=True)
+    (tmp_path / 'sqlite').mkdir()
+    parquet = transactionsdb.TransactionsDB(str(tmp_path / 'parquet'))
+    sqlite = sqlitedb.SQLiteTransactionsDB(str(tmp_path / 'sqlite'))
+    run(parquet)
+    run(sqlite)
+    return parquet, sqlite
+
+
+def normalized(df, columns, key):
+    return df[columns].astype(str).sort_values(key).reset_index(drop=True)
+
+
+def test_same_results(dbs):
+    parquet, sqlite = dbs
+    processed = normalized(parquet.get_processed_transactions(), COLUMNS, 'txn_id')
+    assert processed['txn_cat'].isin(['Food', 'Other']).all()
+    assert 't00000' not in processed['txn_id'].values
+    assert processed.set_index('txn_id').loc['t00110', 'txn_amount'] == '110.5'
+    pd.testing.assert_frame_equal(normalized(sqlite.get_processed_transactions(), COLUMNS, 'txn_id'), processed)
+
+    balances = ['account_name_parent', 'bal_date', 'bal_processed']
+    pd.testing.assert_frame_equal(normalized(sqlite.read_table('processed_balances'), balances, balances),
+                                  normalized(pd.read_parquet(parquet.paths['processed_balances']), balances, balances))
+
+    window = datetime.date(2024, 1, 5), datetime.date(2024, 1, 20), ['A1']
+    ids = sorted(parquet.get_transaction_ids(*window))
+    assert len(ids) > 0
+    assert sorted(sqlite.get_transaction_ids(*window)) == ids
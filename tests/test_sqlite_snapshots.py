@@ -0,0 +1,63 @@
+"""
+Checks the sqlite backend snapshots only the tables a run changed, into
+deduplicated chunks, and restores a table from them.
+"""
+
+import pandas as pd
+import pytest
+
+import sqlitedb
+
+
+def transactions(n, amount=1.0):
+    return pd.DataFrame({
+        'txn_id': ['t%06d' % i for i in range(n)],
+        'account_id': 'A1',
+        'txn_name': ['SHOP %d' % i for i in range(n)],
+        'txn_date': pd.Timestamp('2024-01-01') + pd.to_timedelta([i % 365 for i in range(n)], unit='D'),
+        'txn_amount': amount,
+        'txn_cat': 'Other',
+        'txn_cat_flag': False,
+    })
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = sqlitedb.SQLiteTransactionsDB(str(tmp_path))
+    db.upsert('processed_transactions', transactions(5000))
+    db.checkpoint()
+    return db
+
+
+def test_one_row_change_writes_one_chunk(db):
+    manifest = db.snapshots.manifest('processed_transactions', 1)
+    assert manifest['rows'] == 5000 and len(manifest['chunks']) > 2
+
+    db.conn.execute("UPDATE processed_transactions SET txn_amount = 2 WHERE txn_id = 't000123'")
+    db.checkpoint()
+    manifest = db.snapshots.manifest('processed_transactions', 2)
+    assert manifest['new_chunks'] == 1
+    # Untouched tables get no new version
+    assert db.snapshots.versions('account_info') == [1]
+
+    db.checkpoint()
+    assert db.snapshots.versions('processed_transactions') == [1, 2]
+
+
+def test_restore(db):
+    db.conn.execute("DELETE FROM processed_transactions WHERE txn_id < 't001000'")
+    db.checkpoint()
+    assert db.read_table('processed_transactions').shape[0] == 4000
+
+    db.restore_table('processed_transactions', 1)
+    restored = db.read_table('processed_transactions')
+    pd.testing.assert_frame_equal(restored.sort_values('txn_id').reset_index(drop=True),
+                                  db.snapshots.load('processed_transactions', 1))
+    assert restored.shape[0] == 5000
+    assert db.snapshots.versions('processed_transactions') == [1, 2, 3]
+    assert db.list_snapshots().query("table == 'processed_transactions'")['rows'].tolist() == [5000, 4000, 5000]
+
+    with pytest.raises(KeyError):
+        db.restore_table('processed_transactions', 9)
+    with pytest.raises(KeyError):
+        db.restore_table('nope', 1)
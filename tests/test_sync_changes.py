@@ -0,0 +1,100 @@
+"""
+Syncs both database backends against fakeplaid with sync_mode = sync, then syncs
+again to pick up a round of modified and removed transactions, and checks both
+backends apply them to the raw and processed tables.
+"""
+
+import datetime
+import os
+
+import pandas as pd
+import pytest
+
+import config
+import fakeplaid
+import plaidapi
+import sqlitedb
+import transactionsdb
+from plaidsync import sync_plaid_data
+
+ANCHOR = datetime.date(2024, 6, 30)
+
+
+@pytest.fixture
+def fake():
+    data = fakeplaid.FakePlaidData(items=2, accounts_per_item=2, transactions_per_item=60, days=90, seed=7,
+                                   anchor_date=ANCHOR, modified_per_sync=4, removed_per_sync=3)
+    server = fakeplaid.start(fakeplaid.FakePlaid(data))
+    yield data, 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+
+
+def sync(cfg, db):
+    papi = plaidapi.PlaidAPI(**cfg.get_plaid_client_config())
+    sync_plaid_data(None, None, cfg, papi, ANCHOR - datetime.timedelta(days=120), ANCHOR, db, True, False)
+    db.process_transactions()
+    if hasattr(db, 'checkpoint'):
+        db.checkpoint()
+
+
+def expected_ids(data, rounds):
+    # Pending transactions are left out of processed_txns until they post
+    ids = set()
+    for item in range(data.items):
+        modified, removed = data.changes(item, rounds) if rounds else ([], [])
+        for i in range(data.transactions_per_item):
+            txn = data.modified_transaction(item, i, rounds) if i in modified else data.transaction(item, i)
+            if i not in removed and not txn['pending']:
+                ids.add(txn['transaction_id'])
+    return ids
+
+
+def processed(db) -> pd.DataFrame:
+    if isinstance(db, sqlitedb.SQLiteTransactionsDB):
+        return db.get_processed_transactions()
+    return pd.read_parquet(db.paths['processed_txns'])
+
+
+@pytest.mark.parametrize('make_db', [transactionsdb.TransactionsDB, sqlitedb.SQLiteTransactionsDB])
+def test_modified_and_removed_are_applied(tmp_path, fake, make_db):
+    data, url = fake
+    dbfolder = str(tmp_path / 'db')
+    (tmp_path / 'db' / 'backup').mkdir(parents=True)
+    fakeplaid.write_config(str(tmp_path / 'config'), url, data.items, dbfolder)
+    cfg = config.Config(str(tmp_path / 'config'))
+    cfg.config['plaid-sync']['sync_mode'] = 'sync'
+
+    sync(cfg, make_db(dbfolder))
+    assert set(processed(make_db(dbfolder))['txn_id']) == expected_ids(data, 0)
+
+    sync(cfg, make_db(dbfolder))
+    after = processed(make_db(dbfolder)).set_index('txn_id')
+    assert set(after.index) == expected_ids(data, 1)
+    for item in range(data.items):
+        for i in data.changes(item, 1)[0]:
+            txn = data.modified_transaction(item, i, 1)
+            assert after.loc[txn['transaction_id'], 'txn_name'] == txn['name']
+            assert after.loc[txn['transaction_id'], 'txn_amount'] == pytest.approx(txn['amount'])
+
+
+def test_removed_then_added_again(tmp_path, fake):
+    # Syncing again from no cursor, Plaid sends every transaction as added,
+    # including the ones it removed before
+    data, url = fake
+    dbfolder = str(tmp_path / 'db')
+    (tmp_path / 'db' / 'backup').mkdir(parents=True)
+    fakeplaid.write_config(str(tmp_path / 'config'), url, data.items, dbfolder)
+    cfg = config.Config(str(tmp_path / 'config'))
+    cfg.config['plaid-sync']['sync_mode'] = 'sync'
+    sync(cfg, transactionsdb.TransactionsDB(dbfolder))
+    sync(cfg, transactionsdb.TransactionsDB(dbfolder))
+    removed = {data.transaction(item, i)['transaction_id']
+               for item in range(data.items) for i in data.changes(item, 1)[1]
+               if not data.transaction(item, i)['pending']}
+    assert removed and not removed & set(processed(transactionsdb.TransactionsDB(dbfolder))['txn_id'])
+
+    os.remove(transactionsdb.TransactionsDB(dbfolder).paths['cursors'])
+    sync(cfg, transactionsdb.TransactionsDB(dbfolder))
+    db = transactionsdb.TransactionsDB(dbfolder)
+    assert set(processed(db)['txn_id']) == expected_ids(data, 1) | removed
+    assert removed <= set(db.read_raw_transactions(columns=['txn_id'])['txn_id'])
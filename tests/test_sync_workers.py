@@ -0,0 +1,132 @@
+"""
+Syncs several fakeplaid items on a pool of workers and checks they are fetched
+at the same time, while every database write happens on the calling thread,
+each table written once per run, and streamed pages wait in a bounded queue.
+"""
+
+import collections
+import datetime
+import threading
+import time
+
+import pytest
+
+import config
+import fakeplaid
+import plaidapi
+import plaidsync
+import transactionsdb
+from plaidsync import sync_plaid_data
+
+ANCHOR = datetime.date(2024, 6, 30)
+WRITES = ['save_balances', 'save_account_info', 'save_transactions', 'update_transactions', 'remove_transactions',
+          'save_sync_cursor']
+UNTHROTTLED = ','.join('%s:100000' % endpoint for endpoint in config.DEFAULT_RATE_LIMITS)
+
+
+class Recorder():
+    # Wraps FakePlaid.handle, recording how many items had a request in flight at once
+    def __init__(self, fake):
+        self.handle = fake.handle
+        self.lock = threading.Lock()
+        self.in_flight = collections.Counter()
+        self.max_items = 0
+        fake.handle = self
+
+    def __call__(self, path, body):
+        token = body.get('access_token')
+        with self.lock:
+            self.in_flight[token] += 1
+            self.max_items = max(self.max_items, len(+self.in_flight))
+        try:
+            return self.handle(path, body)
+        finally:
+            with self.lock:
+                self.in_flight[token] -= 1
+
+
+@pytest.fixture
+def fake():
+    # Five pages of transactions per item
+    data = fakeplaid.FakePlaidData(items=4, transactions_per_item=2200, days=90, anchor_date=ANCHOR)
+    fake = fakeplaid.FakePlaid(data, latency=0.05)
+    recorder = Recorder(fake)
+    server = fakeplaid.start(fake)
+    yield data, recorder, 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    calls = []
+    for name in WRITES:
+        def record(self, *args, method=getattr(transactionsdb.TransactionsDB, name), name=name):
+            calls.append((name, threading.current_thread()))
+            return method(self, *args)
+        monkeypatch.setattr(transactionsdb.TransactionsDB, name, record)
+    return calls
+
+
+@pytest.mark.parametrize('sync_mode', ['get', 'sync'])
+def test_concurrent_fetch_single_writer(tmp_path, fake, writes, sync_mode):
+    data, recorder, url = fake
+    dbfolder = str(tmp_path / 'db')
+    (tmp_path / 'db' / 'backup').mkdir(parents=True)
+    fakeplaid.write_config(str(tmp_path / 'config'), url, data.items, dbfolder)
+    cfg = config.Config(str(tmp_path / 'config'))
+    cfg.config['PLAID']['rate_limits'] = UNTHROTTLED
+    cfg.config['plaid-sync']['sync_mode'] = sync_mode
+    cfg.config['plaid-sync']['sync_workers'] = '4'
+    papi = plaidapi.PlaidAPI(**cfg.get_plaid_client_config())
+    db = transactionsdb.TransactionsDB(dbfolder)
+    sync_plaid_data(None, None, cfg, papi, ANCHOR - datetime.timedelta(days=120), ANCHOR, db, True, False)
+
+    assert recorder.max_items > 1
+    assert {thread for _, thread in writes} == {threading.main_thread()}
+    names = collections.Counter(name for name, _ in writes)
+    assert names['save_balances'] == names['save_account_info'] == 1
+    if sync_mode == 'sync':
+        assert names['save_transactions'] == 1
+    db.process_transactions()
+    expected = {t['transaction_id'] for item in range(data.items)
+                for t in (data.transaction(item, i) for i in range(data.transactions_per_item)) if not t['pending']}
+    assert set(db.get_processed_transactions()['txn_id']) == expected
+
+
+def test_pages_streamed_through_bounded_queue(tmp_path, fake, monkeypatch):
+    # With a slow writer, workers wait on the queue rather than piling up pages
+    data, recorder, url = fake
+    dbfolder = str(tmp_path / 'db')
+    (tmp_path / 'db' / 'backup').mkdir(parents=True)
+    fakeplaid.write_config(str(tmp_path / 'config'), url, data.items, dbfolder)
+    cfg = config.Config(str(tmp_path / 'config'))
+    cfg.config['PLAID']['rate_limits'] = UNTHROTTLED
+    cfg.config['plaid-sync']['sync_workers'] = '2'
+    papi = plaidapi.PlaidAPI(**cfg.get_plaid_client_config())
+    lock = threading.Lock()
+    held = {'pages': 0, 'max': 0}
+    iter_pages = plaidapi.PlaidAPI.iter_transaction_pages
+
+    def counting_pages(self, *args, **kwargs):
+        for page in iter_pages(self, *args, **kwargs):
+            with lock:
+                held['pages'] += 1
+                held['max'] = max(held['max'], held['pages'])
+            yield page
+
+    def slow_write(*args, write=plaidsync.write_transaction_page):
+        time.sleep(0.02)
+        write(*args)
+        with lock:
+            held['pages'] -= 1
+    monkeypatch.setattr(plaidapi.PlaidAPI, 'iter_transaction_pages', counting_pages)
+    monkeypatch.setattr(plaidsync, 'write_transaction_page', slow_write)
+    db = transactionsdb.TransactionsDB(dbfolder)
+    sync_plaid_data(None, None, cfg, papi, ANCHOR - datetime.timedelta(days=120), ANCHOR, db, True, False)
+
+    # Queued (2 per worker), plus one waiting to be queued and one being written
+    assert held['pages'] == 0
+    assert held['max'] <= 2 * 2 + 2 + 1
+    db.process_transactions()
+    assert db.get_processed_transactions().shape[0] == sum(
+        not data.transaction(item, i)['pending'] for item in range(data.items) for i in range(data.transactions_per_item))
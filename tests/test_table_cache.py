@@ -0,0 +1,74 @@
+"""
+Checks the session table cache of the parquet backend: a table is read from
+disk once, and again only when its file changes (mtime or size) and the session
+has no unsaved changes to it.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import transactionsdb
+from helpers import account_info, transaction
+
+
+def populate(dbfolder, ids):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    db.save_account_info(account_info('A1'))
+    db.save_transactions([transaction(i) for i in ids])
+    db.process_transactions()
+    db.checkpoint()
+
+
+@pytest.fixture
+def dbfolder(tmp_path):
+    (tmp_path / 'backup').mkdir()
+    populate(str(tmp_path), range(20))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    paths = []
+    read_parquet = pd.read_parquet
+
+    def counting(path, *args, **kwargs):
+        paths.append(os.path.basename(path))
+        return read_parquet(path, *args, **kwargs)
+    monkeypatch.setattr(pd, 'read_parquet', counting)
+    return paths
+
+
+def test_read_once(dbfolder, reads):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    for _ in range(3):
+        assert db.read_table('processed_txns').shape[0] == 20
+    db.get_processed_transactions()
+    assert reads.count('processed_transactions.parquet') == 1
+
+
+def test_reread_when_the_file_changes(dbfolder, reads):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    assert db.read_table('processed_txns').shape[0] == 20
+    # Another session writes the table
+    populate(dbfolder, range(20, 30))
+    reads.clear()
+    assert db.read_table('processed_txns').shape[0] == 30
+    assert reads == ['processed_transactions.parquet']
+
+    # Same size, new mtime
+    st = os.stat(db.paths['processed_txns'])
+    os.utime(db.paths['processed_txns'], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    db.read_table('processed_txns')
+    assert len(reads) == 2
+
+
+def test_unsaved_changes_win(dbfolder, reads):
+    db = transactionsdb.TransactionsDB(dbfolder)
+    txns = db.read_table('processed_txns')
+    db.write_table('processed_txns', txns[txns['txn_id'] != 't00000'])
+    populate(dbfolder, range(20, 30))
+    reads.clear()
+    assert db.read_table('processed_txns').shape[0] == 19
+    assert reads == []
@@ -0,0 +1,56 @@
+"""
+Builds the tfidf engine over a few names with known nearest neighbours and
+predicts through it. Skipped without scipy, which the engine needs.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('scipy')
+
+import tfidfsearch
+from categorizer import TrigramIndex, build_prototypes
+from categoryindex import CategoryIndex
+
+NAMES = ['STARBUCKS COFFEE 1234', 'STARBUCKS RESERVE', 'SHELL OIL 5678', 'SHELL GAS STATION', 'KROGER FUEL', 'NETFLIX.COM']
+
+
+def similarity_of(trigrams, queries, ids):
+    return [tfidfsearch.similarities(trigrams, [q], np.array([i]))[0, 0] for q, i in zip(queries, ids)]
+
+
+def test_neighbours():
+    trigrams = TrigramIndex(NAMES)
+    rank = np.argsort(np.argsort(np.array(NAMES, dtype=object), kind='stable'))
+    nearest = tfidfsearch.tfidf_neighbours(trigrams, ['STARBUCKS COFFEE 9999', 'SHELL OIL', 'NETFLIX', 'ZZZZ'], rank, k=2)
+    assert nearest[0].tolist() == [0, 1]
+    assert nearest[1].tolist() == [2, 3]
+    # Only one name shares a trigram with NETFLIX, and none with ZZZZ
+    assert nearest[2].tolist() == [5, -1]
+    assert nearest[3].tolist() == [-1, -1]
+
+    similarity = tfidfsearch.similarities(trigrams, ['STARBUCKS COFFEE 1234'], np.arange(len(NAMES)))[0]
+    assert similarity[0] == pytest.approx(1.0, abs=1e-6)
+    assert similarity.argmax() == 0
+    np.testing.assert_allclose(tfidfsearch.pair_similarities(trigrams, ['SHELL OIL', 'NETFLIX'], np.array([2, 5])),
+                               similarity_of(trigrams, ['SHELL OIL', 'NETFLIX'], [2, 5]), rtol=1e-6)
+
+
+def test_predict():
+    cat_data = pd.DataFrame({
+        'txn_id': ['c%d' % i for i in range(len(NAMES))],
+        'txn_name': NAMES,
+        'txn_cat': ['Coffee', 'Coffee', 'Gas', 'Gas', 'Gas', 'Streaming'],
+        'txn_date': pd.to_datetime(['2024-01-01'] * len(NAMES)),
+    })
+    index = CategoryIndex(None)
+    index.reset(build_prototypes(cat_data))
+    uncat = pd.DataFrame({'txn_id': ['u1', 'u2', 'u3', 'u4'],
+                          'txn_name': ['starbucks  coffee 42', 'SHELL OIL 1111', 'NETFLIX.COM', 'ZZZZ']})
+    predicted = index.predict(uncat, k=2, engine='tfidf').set_index('txn_id')
+    assert predicted['txn_cat_new'].tolist() == ['Coffee', 'Gas', 'Streaming', None]
+    # NETFLIX.COM is looked up, not searched
+    assert predicted.loc['u3', 'txn_cat_radius'] == 0
+    assert 0 < predicted.loc['u1', 'txn_cat_radius'] < 1
+    assert predicted.loc['u4', 'txn_cat_radius'] == 1
@@ -0,0 +1,69 @@
+"""
+Checks the Plaid response types: the per-object ones use __slots__, and a
+TransactionColumns batch built from the JSON holds the same values as
+Transaction objects built one at a time, however it is then combined.
+"""
+
+import datetime
+
+import pandas as pd
+import pytest
+
+import fakeplaid
+import transactionsdb
+from plaidapi import TRANSACTION_COLUMNS, AccountBalance, AccountInfo, Transaction, TransactionColumns
+
+CREATE_DT = datetime.datetime(2024, 7, 1, 12, 0)
+
+
+@pytest.fixture
+def txns():
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=50, seed=2)
+    txns = [data.transaction(0, i) for i in range(50)]
+    txns[3] = dict(txns[3], personal_finance_category=None, merchant_name=None)
+    return txns
+
+
+def as_objects(txns):
+    objects = [Transaction(t) for t in txns]
+    for t in objects:
+        t.create_dt = CREATE_DT
+    return objects
+
+
+def test_slots():
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=1)
+    account = data.accounts(0)[0]
+    for obj in [Transaction(data.transaction(0, 0)), AccountBalance(account), AccountInfo(account, 'Parent'),
+                TransactionColumns()]:
+        assert not hasattr(obj, '__dict__')
+        with pytest.raises(AttributeError):
+            obj.unknown = 1
+
+
+def test_columns_match_objects(txns):
+    batch = TransactionColumns.from_json(txns, CREATE_DT)
+    objects = as_objects(txns)
+    assert len(batch) == 50
+    for col in TRANSACTION_COLUMNS:
+        assert batch.columns[col] == [getattr(t, col) for t in objects], col
+    assert batch.columns['txn_cat_plaid'][3] is None
+
+    # Iterated back into objects
+    assert [(t.txn_id, t.txn_amount, t.create_dt) for t in batch] == [(t.txn_id, t.txn_amount, t.create_dt) for t in objects]
+
+
+def test_combining(txns):
+    first, second = TransactionColumns.from_json(txns[:20], CREATE_DT), TransactionColumns.from_json(txns[20:], CREATE_DT)
+    both = TransactionColumns.concat([first, as_objects(txns[20:])])
+    assert both.columns == TransactionColumns.concat([first, second]).columns == TransactionColumns.from_json(txns, CREATE_DT).columns
+    ids = {txns[i]['transaction_id'] for i in [1, 7, 30]}
+    assert both.select(ids).columns['txn_id'] == [txns[i]['transaction_id'] for i in [1, 7, 30]]
+    assert TransactionColumns.of(both) is both
+
+
+def test_database_frame(tmp_path, txns):
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    frame = db.transactions_frame(TransactionColumns.from_json(txns, CREATE_DT))
+    pd.testing.assert_frame_equal(frame, db.transactions_frame(as_objects(txns)))
+    assert list(frame.columns) == TRANSACTION_COLUMNS + ['archive_dt', 'current']
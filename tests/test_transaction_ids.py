@@ -0,0 +1,62 @@
+"""
+Checks get_transaction_ids of the parquet backend: it returns the txn_ids of the
+given accounts and dates, opens no fragment of another account or month, and
+reads only the txn_id column.
+"""
+
+import datetime
+import os
+
+import pyarrow as pa
+import pytest
+
+import transactionsdb
+from helpers import account_info, transaction
+
+
+class Recording():
+    # Stands in for the dataset, recording how it is read
+    def __init__(self, dataset, calls):
+        self.dataset = dataset
+        self.calls = calls
+
+    def to_table(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.dataset.to_table(**kwargs)
+
+
+@pytest.fixture
+def db(tmp_path):
+    (tmp_path / 'backup').mkdir()
+    db = transactionsdb.TransactionsDB(str(tmp_path))
+    db.save_account_info(account_info('A1', 'B2'))
+    # 120 days from 2024-01-01 for each account
+    db.save_transactions([transaction(i, account_id=a, day=i % 120) for a, ids in [('A1', range(120)), ('B2', range(200, 320))]
+                          for i in ids])
+    return db
+
+
+def test_window(db):
+    ids = db.get_transaction_ids(datetime.date(2024, 2, 10), datetime.date(2024, 3, 5), ['A1'])
+    # Days 40 to 64 after 2024-01-01
+    assert sorted(ids) == ['t%05d' % i for i in range(40, 65)]
+    assert db.get_transaction_ids(datetime.date(2024, 2, 10), datetime.date(2024, 3, 5), []) == []
+    assert len(db.get_transaction_ids(datetime.date(2024, 1, 1), datetime.date(2024, 12, 31), ['A1', 'B2'])) == 240
+
+
+def test_pushdown(db, monkeypatch):
+    # Fragments outside the window are made unreadable, so opening one fails
+    for account_id, txn_month in [('A1', '2024-01'), ('A1', '2024-04'), ('B2', '2024-02')]:
+        part_dir = db.raw_txn_partition_dir(account_id, txn_month)
+        for f in os.listdir(part_dir):
+            with open('%s/%s' % (part_dir, f), 'wb') as out:
+                out.write(b'not parquet')
+    with pytest.raises(pa.ArrowInvalid):
+        db.raw_transactions_dataset().to_table(columns=['txn_id'])
+    calls = []
+    dataset = db.raw_transactions_dataset
+    monkeypatch.setattr(db, 'raw_transactions_dataset', lambda *args: Recording(dataset(*args), calls))
+
+    ids = db.get_transaction_ids(datetime.date(2024, 2, 1), datetime.date(2024, 3, 31), ['A1'])
+    assert len(ids) == 29 + 31
+    assert [call['columns'] for call in calls] == [['txn_id']]
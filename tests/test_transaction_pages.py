@@ -0,0 +1,76 @@
+"""
+Fetches transactions from fakeplaid a page at a time and checks PlaidAPI asks
+for every page offset once, up to page_concurrency of them at a time, and
+yields the pages in offset order without running further ahead of the
+consumer.
+"""
+
+import datetime
+import threading
+import time
+
+import pytest
+
+import fakeplaid
+import plaidapi
+
+ANCHOR = datetime.date(2024, 6, 30)
+START, END = ANCHOR - datetime.timedelta(days=400), ANCHOR
+
+
+class Recorder():
+    # Wraps FakePlaid.handle, recording the offset of each /transactions/get and
+    # how many were in flight at once
+    def __init__(self, fake):
+        self.handle = fake.handle
+        self.lock = threading.Lock()
+        self.offsets = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        fake.handle = self
+
+    def __call__(self, path, body):
+        if path != '/transactions/get':
+            return self.handle(path, body)
+        with self.lock:
+            self.offsets.append(body['options']['offset'])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self.handle(path, body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def fake():
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=4100, days=365, anchor_date=ANCHOR)
+    fake = fakeplaid.FakePlaid(data, latency={'/transactions/get': 0.05, '*': 0})
+    recorder = Recorder(fake)
+    server = fakeplaid.start(fake)
+    papi = plaidapi.PlaidAPI('fake', 'fake', 'sandbox', host='http://127.0.0.1:%d' % server.server_address[1],
+                             page_concurrency=3, rate_limits={})
+    yield data, recorder, papi
+    server.shutdown()
+
+
+def test_every_offset_once_in_order(fake):
+    data, recorder, papi = fake
+    pages = list(papi.iter_transaction_pages('access-fake-0', START, END))
+    assert sorted(recorder.offsets) == list(range(0, 4100, 500))
+    assert 1 < recorder.max_in_flight <= 3
+
+    expected = [t['transaction_id'] for t in (data.transaction(0, i) for i in range(4100)) if not t['pending']]
+    assert [txn_id for page in pages for txn_id in page.columns['txn_id']] == expected
+
+
+def test_bounded_read_ahead(fake):
+    data, recorder, papi = fake
+    pages = papi.iter_transaction_pages('access-fake-0', START, END)
+    next(pages)
+    next(pages)
+    # A slow consumer holds up the requests after page_concurrency pages ahead
+    time.sleep(0.5)
+    assert len(recorder.offsets) == 2 + 3
+    pages.close()
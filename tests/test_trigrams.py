@@ -0,0 +1,59 @@
+"""
+Checks the TrigramIndex candidate pool: a small pool still holds the name a
+typo away from the query, a pool of every name scores like the full
+search, and names added through the delta are found like those indexed at once.
+"""
+
+import random
+
+import numpy as np
+
+import fakeplaid
+from categorizer import TrigramIndex, nearest_neighbours, normalize_name
+
+
+def fake_names(count=600, seed=7):
+    data = fakeplaid.FakePlaidData(items=1, transactions_per_item=count, seed=seed)
+    return sorted({normalize_name(data.transaction(0, i)['name']) for i in range(count)})
+
+
+def typo(name, rng):
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice('ABCXYZ') + name[i + 1:]
+
+
+def test_small_pool_holds_near_names():
+    names = fake_names()
+    index = TrigramIndex(names)
+    rng = random.Random(7)
+    for name_id in rng.sample(range(len(names)), 50):
+        query = typo(names[name_id], rng)
+        pool = index.candidates(query, 20)
+        assert len(pool) <= 20
+        assert name_id in pool
+
+
+def test_whole_pool_matches_full_search():
+    names = fake_names()
+    index = TrigramIndex(names)
+    rng = random.Random(8)
+    queries = [typo(names[i], rng) for i in rng.sample(range(len(names)), 30)] + ['ZZZZ QQQQ']
+    expected = nearest_neighbours(queries, names, k=10)
+    for query, row in zip(queries, expected):
+        assert index.nearest(query, len(names), k=10).tolist() == row.tolist()
+    # No trigram in common: the pool holds fewer than k names, so every name is scored
+    assert index.nearest('ZZZZ QQQQ', 20, k=10).tolist() == expected[-1].tolist()
+
+
+def test_delta_matches_one_build():
+    names = fake_names()
+    whole = TrigramIndex(names)
+    split = TrigramIndex(names[:200])
+    split.add(names[200:450])
+    split.add(names[450:])
+    rng = random.Random(9)
+    for query in [typo(names[i], rng) for i in rng.sample(range(len(names)), 30)]:
+        assert np.sort(split.candidates(query, len(names))).tolist() == np.sort(whole.candidates(query, len(names))).tolist()
+    split.merge_delta()
+    for a in ['gram_keys', 'gram_offsets', 'postings', 'name_grams']:
+        np.testing.assert_array_equal(getattr(split, a), getattr(whole, a))
@@ -0,0 +1,119 @@
+#!python3
+"""
+TF-IDF character trigram search, the tfidf engine of predict_categories.
+
+Each name is the vector of the TF-IDF weights of its distinct character
+trigrams (categorizer.trigram_keys), scaled to unit length, and the neighbours
+of a transaction are the K names whose vectors have the highest cosine
+similarity to its name's. The postings of a TrigramIndex already are the names x
+trigrams matrix in compressed sparse form, so it is used as it is, and the
+similarities of a batch of transactions to every name are one sparse matrix
+product. Transactions are taken in chunks sized so that their similarities stay
+within CHUNK_CELLS cells, like categorizer.nearest_neighbours().
+
+Unlike the Levenshtein search, a name sharing no trigram with a transaction is
+never its neighbour, so a transaction like no training name gets no category.
+
+Needs scipy; without it, sparse is None and predict_categories falls back to
+the levenshtein engine.
+"""
+
+import numpy as np
+from categorizer import K, CHUNK_CELLS, TrigramIndex, trigram_keys
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+# Similarities are compared at this resolution, so that ties go to name order
+SIMILARITY_STEPS = 2**20
+
+
+def idf(trigrams: TrigramIndex) -> np.ndarray:
+    """
+    Returns the smoothed inverse document frequency of each trigram of the index,
+    log((1 + names) / (1 + names holding it)) + 1. A trigram no name holds
+    weighs log(1 + names) + 1.
+    """
+    df = np.diff(trigrams.gram_offsets)
+    return np.log((1 + len(trigrams.names)) / (1 + df)) + 1
+
+
+def name_matrix(trigrams: TrigramIndex, weights: np.ndarray):
+    """
+    Returns the unit-length TF-IDF vectors of the names of the index, transposed:
+    a trigrams x names CSR matrix, built straight from the postings.
+    """
+    posting_weights = np.repeat(weights, np.diff(trigrams.gram_offsets))
+    norms = np.sqrt(np.bincount(trigrams.postings, weights=posting_weights ** 2, minlength=len(trigrams.names)))
+    return sparse.csr_matrix(((posting_weights / norms[trigrams.postings]).astype(np.float32), trigrams.postings,
+                              trigrams.gram_offsets), shape=(trigrams.gram_keys.shape[0], len(trigrams.names)))
+
+
+def query_matrix(trigrams: TrigramIndex, queries, weights: np.ndarray):
+    """
+    Returns the unit-length TF-IDF vectors of queries over the trigrams of the
+    index, as a queries x trigrams CSR matrix. Trigrams the index does not hold
+    count towards the length of a vector, but are not in the matrix.
+    """
+    keys, query_ids = trigram_keys(queries)
+    columns = np.minimum(np.searchsorted(trigrams.gram_keys, keys), trigrams.gram_keys.shape[0] - 1)
+    known = trigrams.gram_keys[columns] == keys
+    key_weights = np.where(known, weights[columns], np.log(1 + len(trigrams.names)) + 1)
+    norms = np.sqrt(np.bincount(query_ids, weights=key_weights ** 2, minlength=len(queries)))
+    return sparse.csr_matrix(((key_weights / norms[query_ids])[known].astype(np.float32),
+                              (query_ids[known], columns[known])), shape=(len(queries), trigrams.gram_keys.shape[0]))
+
+
+def tfidf_neighbours(trigrams: TrigramIndex, queries, rank: np.ndarray, k: int = K,
+                     chunk_cells: int = CHUNK_CELLS) -> np.ndarray:
+    """
+    Returns the ids of the k names of the index most cosine-similar to each
+    query, most similar first, as an array of shape (len(queries), min(k, names)).
+    Names at the same similarity are ordered by rank (their position in name
+    order). Rows are padded with -1 where fewer than k names share a trigram
+    with the query.
+    """
+    queries = list(queries)
+    n, m = len(queries), len(trigrams.names)
+    k = min(k, m)
+    nearest = np.full((n, k), -1, dtype=np.int64)
+    if n == 0 or k == 0:
+        return nearest
+    weights = idf(trigrams)
+    names = name_matrix(trigrams, weights)
+    rows = max(1, chunk_cells // m)
+    for start in range(0, n, rows):
+        similarity = (query_matrix(trigrams, queries[start:start + rows], weights) @ names).toarray()
+        # Every name at least as similar as the k-th most similar, after quantizing,
+        # ordered by quantized similarity then rank
+        kth = -np.partition(-similarity, k - 1, axis=1)[:, k - 1]
+        threshold = (np.rint(kth * SIMILARITY_STEPS) - 0.5) / SIMILARITY_STEPS
+        query_rows, top = np.nonzero(similarity >= threshold[:, None])
+        steps = np.rint(similarity[query_rows, top] * SIMILARITY_STEPS).astype(np.int64)
+        order = np.lexsort((rank[top], -steps, query_rows))
+        query_rows, top, steps = query_rows[order], top[order], steps[order]
+        position = np.arange(query_rows.shape[0]) - np.searchsorted(query_rows, query_rows)
+        keep = (position < k) & (steps > 0)
+        nearest[start + query_rows[keep], position[keep]] = top[keep]
+    return nearest
+
+
+def similarities(trigrams: TrigramIndex, queries, ids: np.ndarray) -> np.ndarray:
+    """
+    Returns the cosine similarity of each query to each of the names ids of the
+    index, as an array of shape (len(queries), len(ids)).
+    """
+    weights = idf(trigrams)
+    return (query_matrix(trigrams, list(queries), weights) @ name_matrix(trigrams, weights)[:, ids]).toarray()
+
+
+def pair_similarities(trigrams: TrigramIndex, queries, ids: np.ndarray) -> np.ndarray:
+    """
+    Returns the cosine similarity of each query to the name ids of the index at
+    the same position.
+    """
+    weights = idf(trigrams)
+    pairs = query_matrix(trigrams, list(queries), weights).multiply(name_matrix(trigrams, weights)[:, ids].T)
+    return np.asarray(pairs.sum(axis=1)).ravel()
@@ -1,178 +1,770 @@
 #!python3
 
+import os
+import re
+import shutil
+import operator
+import functools
 import sqlite3
 import json
+import uuid
 import datetime
+import urllib.parse
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from typing import List, Optional, Dict
-from plaidapi import AccountBalance, AccountInfo, Transaction as PlaidTransaction
-from Levenshtein import distance
+from plaidapi import AccountBalance, AccountInfo, TransactionColumns
+from snapshotstore import SnapshotStore
+from journal import Journal, atomic_write, write_json
+from payloadstore import PayloadStore
+from keyindex import KeyIndex
+from schemas import SCHEMAS, RAW_TXN_PARTITION_SCHEMA, conform, to_arrow
+from categorizer import build_prototypes, merge_prototypes
+from categoryindex import CategoryIndex
+
+GSHEET_TXN_MAP = {
+    'Date': 'txn_date',
+    'Description': 'txn_name',
+    'Amount': 'txn_amount',
+    'Category': 'txn_cat',
+    'Account': 'account_name_parent',
+    'Complete': 'txn_cat_flag',
+    'Key': 'txn_id',
+}
+# Columns each cached table is sorted on when it is chunked into snapshots
+TABLE_SORT_COLS = {
+    'processed_txns': ['txn_date', 'txn_id'],
+    'gsheet_txns': ['txn_date', 'txn_id'],
+    'cat_data': ['txn_id'],
+    'cat_prototypes': ['txn_name_norm', 'txn_cat'],
+    'raw_balances': ['bal_date', 'account_id'],
+    'processed_balances': ['bal_date', 'account_name_parent'],
+    'account_info': ['account_id'],
+}
+# Tables with a persistent KeyIndex, used to skip rows that are already stored
+INDEXED_TABLES = ['raw_txns', 'processed_txns', 'cat_data', 'raw_balances']
+# Fragments a raw_transactions partition may have before its processed ones are
+# compacted into one
+COMPACT_FRAGMENTS = 8
+
+
+def fragment_seq(name: str) -> int:
+    """
+    Returns the sequence number in a raw_transactions fragment name, -1 for a
+    fragment written before they were numbered.
+    """
+    match = re.match(r'part-(\d{8})-[0-9a-f]{8}\.parquet$', name)
+    return int(match.group(1)) if match else -1
+
 
 def build_placeholders(list):
     return ",".join(["?"]*len(list))
 
+
+def balance_payload_key(account_id, bal_date) -> str:
+    return '%s|%s' % (account_id, pd.Timestamp(bal_date).strftime('%Y-%m-%d'))
+
+
+def table_keys(name: str, df: pd.DataFrame) -> List[str]:
+    if name == 'raw_balances':
+        return [balance_payload_key(a, d) for a, d in zip(df['account_id'], df['bal_date'])]
+    return df['txn_id'].tolist()
+
+
+def dump_raw_data(raw_data):
+    if raw_data is None or (isinstance(raw_data, float) and np.isnan(raw_data)):
+        return None
+    if isinstance(raw_data, str):
+        return raw_data
+    return json.dumps(raw_data, default=str)
+
+
+def clean_gsheet_txns(gsheet_txns: pd.DataFrame) -> pd.DataFrame:
+    """
+    Maps the columns pulled from the Google Sheet transaction tabs onto the
+    processed_transactions column names and types.
+    """
+    gsheet_txns = (
+        gsheet_txns
+        .rename(columns=GSHEET_TXN_MAP)
+        .assign(txn_cat_flag=lambda x: x['txn_cat_flag'].map({'True':True, 'False':False}))
+    )
+    gsheet_txns['txn_date'] = pd.TimedeltaIndex(gsheet_txns['txn_date'].astype('int64'), unit='d') + datetime.datetime(1899, 12, 30)
+    gsheet_txns['txn_name'] = gsheet_txns['txn_name'].astype('str')
+    gsheet_txns['txn_id'] = gsheet_txns['txn_id'].astype('str')
+    return conform(gsheet_txns, 'gsheet_txns')
+
+
+def build_processed_balances(account_info: pd.DataFrame, raw_bals: pd.DataFrame,
+                             processed_txns: pd.DataFrame, start_date) -> pd.DataFrame:
+    """
+    Backfills daily balances per parent account, back to start_date, from the
+    earliest raw balance of each account and the processed transactions.
+    """
+    # Grouping on a categorical would emit every parent account for every date
+    account_info = account_info.astype({'account_name_parent': object})
+    processed_txns = processed_txns.astype({'account_name_parent': object})
+    raw_bals_latest = (
+        raw_bals
+        .merge(account_info[['account_id', 'account_name_parent']],
+               on='account_id',
+               how='inner')
+        [['account_name_parent', 'bal_current', 'bal_date']]
+        .groupby(['account_name_parent', 'bal_date'])
+        .agg({'bal_current':'sum'}).reset_index()
+        .assign(rank=lambda x: x.groupby('account_name_parent')['bal_date'].rank(method='first', ascending=True))
+        .query('rank==1')
+        .drop(columns=['rank'])
+    )
+
+    # Summarize transactions by day and parent account
+    dates = pd.DataFrame({'txn_date': pd.date_range(start_date, datetime.datetime.today())})
+    account_dates = (
+        dates.assign(keycol=1)
+        .merge(processed_txns.assign(keycol=1)[['account_name_parent', 'keycol']].drop_duplicates(),
+               on='keycol',
+               how='inner')
+        .drop(columns=['keycol'])
+    )
+    processed_txns_byday = (
+        processed_txns
+        .groupby(['account_name_parent', 'txn_date'])
+        .agg({'txn_amount': 'sum'})
+        .reset_index()
+        .merge(account_dates, on=['account_name_parent', 'txn_date'], how='right')
+        .fillna(value={'txn_amount': 0})
+        .rename(columns={'txn_date':'bal_date'})
+    )
+
+    # Do cumulative math to get the historical view of balances by day by parent account, back to start_date
+    return (
+        raw_bals_latest
+        .merge(processed_txns_byday, on=['bal_date', 'account_name_parent'], how='outer')
+        .fillna({'bal_current':0, 'txn_amount': 0})
+        .sort_values(by=['account_name_parent', 'bal_date'], ascending=False, axis=0)
+        .assign(new_bal=lambda x: x['bal_current'] + x['txn_amount'])
+        .assign(out_bal=lambda x: x.groupby('account_name_parent')['new_bal'].cumsum())
+        .drop(columns=['new_bal', 'txn_amount', 'bal_current'])
+        .rename(columns={'out_bal':'bal_processed'})
+        .reset_index(drop=True)
+    )
+
 class TransactionsDB():
-    def __init__(self, dbfolder: str):
+    def __init__(self, dbfolder: str, snapshot_retention: int = 10, predict_candidates: int = 0,
+                 predict_half_life: float = 0, predict_engine: str = 'levenshtein'):
         self.dbfolder = dbfolder if dbfolder[-1] != '/' else dbfolder[:-1]
+        self.predict_candidates = predict_candidates
+        self.predict_half_life = predict_half_life
+        self.predict_engine = predict_engine
         self.paths = {
             'account_ref': self.dbfolder + '/accounts.xlsx',
-            'raw_txns': self.dbfolder + '/raw_transactions.parquet',
+            'raw_txns': self.dbfolder + '/raw_transactions',
+            'raw_txns_legacy': self.dbfolder + '/raw_transactions.parquet',
             'raw_txns_backup': self.dbfolder + '/backup/raw_transactions.parquet',
             'cat_data': self.dbfolder + '/cat_data.parquet',
-            'cat_data_backup': self.dbfolder + '/backup/cat_data.parquet',
+            'cat_prototypes': self.dbfolder + '/cat_prototypes.parquet',
             'gsheet_txns': self.dbfolder + '/gsheet_transactions.parquet',
-            'gsheet_txns_backup': self.dbfolder + '/backup/gsheet_transactions.parquet',
             'processed_txns': self.dbfolder + '/processed_transactions.parquet',
-            'processed_txns_backup_1': self.dbfolder + '/backup/processed_transactions_1.parquet',
-            'processed_txns_backup_2': self.dbfolder + '/backup/processed_transactions_2.parquet',
-            'processed_txns_backup_3': self.dbfolder + '/backup/processed_transactions_3.parquet',
             'raw_balances': self.dbfolder + '/raw_balances.parquet',
-            'raw_balances_backup': self.dbfolder + '/backup/raw_balances.parquet',
             'processed_balances': self.dbfolder + '/processed_balances.parquet',
-            'processed_balances_backup': self.dbfolder + '/backup/processed_balances.parquet',
             'account_info': self.dbfolder + '/account_info.parquet',
-            'account_info_backup': self.dbfolder + '/backup/account_info.parquet'
-        }
-        self.gsheet_txn_map = {
-            'Date': 'txn_date',
-            'Description': 'txn_name',
-            'Amount': 'txn_amount',
-            'Category': 'txn_cat',
-            'Account': 'account_name_parent',
-            'Complete': 'txn_cat_flag',
-            'Key': 'txn_id',
-        }
-        self.txn_types = {
-            'account_id': 'object',
-            'account_name': 'object',
-            'account_name_parent': 'object',
-            'txn_id': 'object',
-            'txn_date': 'datetime64[ns]',
-            'txn_name': 'object',
-            'txn_name_plaid': 'object',
-            'txn_amount': 'float64',
-            'txn_cat': 'object',
-            'txn_cat_plaid': 'object',
-            'txn_cat_plaid_dtl': 'object',
-            'create_dt': 'datetime64[ns]',
-            'archive_dt': 'datetime64[ns]',
-            'txn_cat_flag': 'bool',
-            'current': 'object',
-            'raw_data': 'object'
-        }
-        self.bal_types = {
-            'account_id': 'object', 
-            'account_name': 'object', 
-            'bal_available': 'float64', 
-            'bal_limit': 'float64', 
-            'bal_currency_code': 'object', 
-            'bal_current': 'float64', 
-            'bal_date': 'datetime64[ns]', 
-            'raw_data': 'object'
+            'snapshots': self.dbfolder + '/backup/snapshots',
+            'raw_payloads': self.dbfolder + '/raw_payloads',
+            'key_index': self.dbfolder + '/index',
+            'cat_index': self.dbfolder + '/cat_index',
+            'cursors': self.dbfolder + '/cursors.json',
         }
+        self.gsheet_txn_map = GSHEET_TXN_MAP
 
-    def get_transaction_ids(self, start_date: datetime.date, end_date: datetime.date, account_ids: List[str]) -> List[str]:
+        # Session cache of the single-file tables, keyed by their paths entry. Tables are
+        # read once per run and written back by checkpoint()
+        self.tables = {}
+        self.table_versions = {}
+        self.dirty = set()
+        self.indexes = {}
+        self.cat_index = None
+        # Normalized names update_training_data added training rows for, whose
+        # neighbourhoods predict_categories re-predicts
+        self.retrained_names = []
+        self.cursors = None
+        self.cursors_dirty = False
+        self.snapshots = SnapshotStore(self.paths['snapshots'], retention=snapshot_retention)
+        self.payloads = PayloadStore(self.paths['raw_payloads'])
+        self.journal = Journal(self.dbfolder)
+        self.journal.recover()
+        self.migrate_raw_transactions()
+
+    def migrate_raw_transactions(self):
+        """
+        Converts a single-file raw_transactions.parquet from older versions into the
+        partitioned raw_transactions dataset. The dataset is built in a staging folder
+        and renamed into place, then the old file is moved into backup/.
+        """
+        if not os.path.exists(self.paths['raw_txns_legacy']) or os.path.exists(self.paths['raw_txns']):
+            return
+        print("Migrating raw_transactions.parquet to partitioned dataset at %s" % self.paths['raw_txns'])
+        staging = self.dbfolder + '/.raw_transactions.migrating'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        legacy_txns = pd.read_parquet(self.paths['raw_txns_legacy'])
+        self.append_raw_transactions(legacy_txns, dataset_dir=staging)
+        if 'raw_data' in legacy_txns.columns:
+            self.payloads.append('transactions', legacy_txns['txn_id'].tolist(), legacy_txns['raw_data'].map(dump_raw_data).tolist())
+        os.replace(staging, self.paths['raw_txns'])
+        os.makedirs(os.path.dirname(self.paths['raw_txns_backup']), exist_ok=True)
+        os.replace(self.paths['raw_txns_legacy'], self.paths['raw_txns_backup'])
+
+    def file_version(self, path: str):
         try:
-            txns = pd.read_parquet(self.paths['txns'])
-            txn_ids = (
-                txns
-                [txns['account_id'].isin(account_ids)]
-                ['txn_id'].tolist()
-            )
-        except:
-            txn_ids = []
-        return txn_ids
-    
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def read_table(self, name: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the named table from the session cache. The parquet file is only read
+        on first use, or again if it has changed on disk (mtime/size) since it was
+        cached and there are no unsaved changes. Returns None if the table does not
+        exist yet.
+        """
+        if name in self.tables:
+            if name in self.dirty or self.file_version(self.paths[name]) == self.table_versions[name]:
+                return self.tables[name]
+        version = self.file_version(self.paths[name])
+        if version is None:
+            return None
+        self.tables[name] = conform(pd.read_parquet(self.paths[name]), name)
+        self.table_versions[name] = version
+        return self.tables[name]
+
+    def write_table(self, name: str, df: pd.DataFrame, new_keys: Optional[List[str]] = None):
+        """
+        Replaces the named table in the session cache, conformed to its registered
+        schema. Nothing is written to disk until checkpoint() is called.
+
+        For indexed tables, new_keys are the keys df adds to the previous contents
+        of the table and are added to its key index. Without them the index is
+        rebuilt from df.
+        """
+        self.tables[name] = conform(df, name)
+        self.dirty.add(name)
+        if name == 'cat_prototypes':
+            # Rebuilt from the new table when next needed
+            self.cat_index = None
+        if name in INDEXED_TABLES:
+            if new_keys is not None:
+                self.key_index(name).add(new_keys)
+            else:
+                index = KeyIndex(self.paths['key_index'], name)
+                index.reset(table_keys(name, self.tables[name]))
+                self.indexes[name] = index
+
+    def key_index(self, name: str) -> KeyIndex:
+        """
+        Returns the key index of an indexed table. A saved index is trusted if it
+        was written with the current version of the table file, and rebuilt from
+        the table otherwise. The raw_transactions index is kept up to date by
+        append_raw_transactions() itself, and only rebuilt from the dataset if it
+        is missing (see rebuild_raw_txn_index()).
+        """
+        if name in self.indexes:
+            return self.indexes[name]
+        if name == 'raw_txns':
+            index = KeyIndex(self.paths['key_index'], name, with_values=True)
+            if not index.load() or 'partition_fragments' not in index.meta:
+                self.rebuild_raw_txn_index(index)
+        else:
+            index = KeyIndex(self.paths['key_index'], name)
+            table = self.read_table(name)
+            version = list(self.table_versions[name]) if table is not None else None
+            if not index.load() or index.meta.get('table_version') != version:
+                index.reset(table_keys(name, table) if table is not None else [])
+                index.meta = {}
+        self.indexes[name] = index
+        return index
+
+    def category_index(self) -> CategoryIndex:
+        """
+        Returns the CategoryIndex predict_categories searches. A saved index is
+        trusted, memory-mapped, if it was written with the current version of the
+        cat_prototypes file and the table has not changed since, and rebuilt from
+        the table otherwise.
+        """
+        if self.cat_index is not None:
+            return self.cat_index
+        index = CategoryIndex(self.paths['cat_index'])
+        version = self.file_version(self.paths['cat_prototypes'])
+        if ('cat_prototypes' in self.dirty or version is None or not index.load()
+                or index.meta.get('table_version') != list(version)):
+            index.reset(self.category_prototypes())
+        self.cat_index = index
+        return index
+
+    def checkpoint(self):
+        """
+        Writes every table changed since the last checkpoint back to disk, once, as a
+        single journaled commit: either all of them are replaced or none are. The new
+        contents are then recorded as the next snapshot version of each table.
+
+        Sync cursors are committed with the tables, so a cursor never gets ahead of
+        the changes fetched with it.
+        """
+        dirty = sorted(self.dirty)
+        prototypes_version = None
+        self.journal.begin()
+        for name in dirty:
+            path = self.paths[name]
+            if not self.snapshots.versions(name) and os.path.exists(path):
+                # First checkpoint since snapshots were introduced, keep what was on disk
+                self.snapshots.save(name, pd.read_parquet(path), TABLE_SORT_COLS[name])
+            staged = self.journal.stage(path)
+            pq.write_table(to_arrow(self.tables[name], name), staged)
+            if name == 'cat_prototypes':
+                prototypes_version = self.file_version(staged)
+            if name in INDEXED_TABLES:
+                # The rename keeps the staged file's mtime, so this is the committed version
+                index = self.key_index(name)
+                index.meta['table_version'] = list(self.file_version(staged))
+                index.save(stage=self.journal.stage)
+        if self.cat_index is not None and (prototypes_version is not None or self.cat_index.changed):
+            # Like the key indexes, saved with the version of the table it was built from
+            self.cat_index.meta['table_version'] = list(prototypes_version or self.file_version(self.paths['cat_prototypes']) or [])
+            self.cat_index.save(stage=self.journal.stage)
+        if self.cursors_dirty:
+            write_json(self.journal.stage(self.paths['cursors']), self.cursors)
+        self.journal.commit()
+        self.cursors_dirty = False
+        if 'processed_txns' in dirty:
+            self.trim_raw_fragment_log()
+            self.compact_raw_transactions()
+
+        for name in dirty:
+            self.table_versions[name] = self.file_version(self.paths[name])
+            self.snapshots.save(name, self.tables[name], TABLE_SORT_COLS[name])
+        self.dirty.clear()
+        self.snapshots.prune()
+
+    def trim_raw_fragment_log(self):
+        """
+        Drops the fragments of the sequence numbers processed_txns has committed
+        as processed from the raw_txns index's fragment log, so the log only holds
+        fragments written since.
+        """
+        raw_index = self.key_index('raw_txns')
+        meta = self.key_index('processed_txns').meta
+        if meta.get('raw_epoch') != raw_index.meta['epoch']:
+            return
+        log = raw_index.meta['fragments']
+        processed = [seq for seq in log if int(seq) < meta['raw_seq']]
+        if processed:
+            for seq in processed:
+                del log[seq]
+            raw_index.save()
+
+    def compact_raw_transactions(self, min_fragments: int = COMPACT_FRAGMENTS):
+        """
+        Merges the fragments of each raw_transactions partition that has reached
+        min_fragments into one, keeping the latest version of each transaction.
+        Only fragments process_transactions() has committed as processed, and not
+        deferred, are merged, so the fragment log and the deferred list never name
+        a merged fragment. The merged fragment is written atomically before the
+        ones it replaces are deleted; a crash in between leaves rows stored twice,
+        which reads ignore and the next compaction merges.
+        """
+        index = self.key_index('raw_txns')
+        meta = self.key_index('processed_txns').meta
+        if meta.get('raw_epoch') != index.meta['epoch']:
+            return
+        deferred = set(meta['deferred_fragments'])
+        raw_txn_schema = SCHEMAS['raw_txns']
+        compacted = 0
+        for partition_id, count in enumerate(index.meta['partition_fragments']):
+            if count < min_fragments:
+                continue
+            account_id, txn_month = index.meta['partitions'][partition_id]
+            part_dir = self.raw_txn_partition_dir(account_id, txn_month)
+            rel_dir = os.path.relpath(part_dir, self.paths['raw_txns']).replace(os.sep, '/')
+            files = [f for f in os.listdir(part_dir) if f.endswith('.parquet') and not f.startswith('.')]
+            merged = [f for f in files
+                      if fragment_seq(f) < meta['raw_seq'] and '%s/%s' % (rel_dir, f) not in deferred]
+            if len(merged) > 1:
+                txns = (
+                    self.raw_transactions_dataset(['%s/%s' % (rel_dir, f) for f in merged])
+                    .to_table(columns=raw_txn_schema.names).to_pandas()
+                    .sort_values(by=['create_dt'], kind='stable')
+                    .drop_duplicates(subset=['txn_id'], keep='last')
+                )
+                fragment = pa.Table.from_pandas(txns, schema=raw_txn_schema, preserve_index=False)
+                name = 'part-%08d-%s.parquet' % (max(fragment_seq(f) for f in merged), uuid.uuid4().hex[:8])
+                atomic_write(part_dir + '/' + name, lambda p: pq.write_table(fragment, p))
+                for f in merged:
+                    os.remove(part_dir + '/' + f)
+                files = [f for f in files if f not in merged] + [name]
+                compacted += 1
+            index.meta['partition_fragments'][partition_id] = len(files)
+        if compacted:
+            index.save()
+
+    def list_snapshots(self) -> pd.DataFrame:
+        return self.snapshots.list()
+
+    def restore_table(self, name: str, version: int):
+        """
+        Rolls a table back to a snapshot version. The restore is itself saved as a
+        new version, so it can be undone the same way.
+        """
+        if name not in TABLE_SORT_COLS:
+            raise KeyError("Unknown table [%s], expected one of %s" % (name, list(TABLE_SORT_COLS)))
+        self.write_table(name, self.snapshots.load(name, version))
+        self.checkpoint()
+
+    def raw_txn_partition_dir(self, account_id: str, txn_month: str, dataset_dir: Optional[str] = None) -> str:
+        return '%s/account_id=%s/txn_month=%s' % (
+            dataset_dir or self.paths['raw_txns'], urllib.parse.quote(str(account_id), safe=''), txn_month)
+
+    def raw_txn_partition_ids(self, index: KeyIndex, account_ids, txn_months) -> List[int]:
+        """
+        Returns the position of each account_id/txn_month partition in the raw_txns
+        index's list of partitions, the values its keys map to, adding new ones.
+        """
+        partitions = index.meta['partitions']
+        ids = {tuple(p): i for i, p in enumerate(partitions)}
+        out = []
+        for partition in zip(map(str, account_ids), map(str, txn_months)):
+            if partition not in ids:
+                ids[partition] = len(partitions)
+                partitions.append(list(partition))
+                index.meta['partition_fragments'].append(0)
+            out.append(ids[partition])
+        return out
+
+    def rebuild_raw_txn_index(self, index: KeyIndex):
+        """
+        Rebuilds the raw_txns key index from every fragment of the dataset, mapping
+        each txn_id to the partition of its latest version, unless that version
+        marks it removed. Its meta holds:
+
+            epoch           a new id per rebuild, so readers of fragment_seq can
+                            tell the numbering started over
+            fragment_seq    the sequence number of the next append, in the names
+                            of the fragments it writes
+            fragments       the fragments of each sequence number not yet known to
+                            be processed (see process_transactions())
+            partitions      the account_id/txn_month partitions keys map to
+            partition_fragments
+                            the number of fragments in each of partitions
+        """
+        print("Building the raw_transactions key index")
+        index.meta = {'epoch': uuid.uuid4().hex[:8], 'fragment_seq': 0, 'fragments': {}, 'partitions': [],
+                      'partition_fragments': []}
+        txns = (
+            self.raw_transactions_dataset().to_table(columns=['txn_id', 'account_id', 'txn_month', 'create_dt', 'current'])
+            .to_pandas().sort_values(by=['create_dt'], kind='stable')
+            .drop_duplicates(subset=['txn_id'], keep='last')
+            .query('current != False')
+        )
+        index.reset(txns['txn_id'].tolist(), self.raw_txn_partition_ids(index, txns['account_id'], txns['txn_month']))
+        for fragment in self.raw_txn_fragments():
+            account_id, txn_month = [part.split('=', 1)[1] for part in fragment.split('/')[:2]]
+            index.meta['partition_fragments'][self.raw_txn_partition_ids(index, [urllib.parse.unquote(account_id)], [txn_month])[0]] += 1
+        index.save()
+
+    def raw_txn_fragments(self) -> List[str]:
+        """
+        Lists the fragment files of the raw_transactions dataset, relative to it.
+        This walks the whole dataset, so is only done when the fragment log of the
+        raw_txns key index cannot be used.
+        """
+        fragments = []
+        for folder, _, files in os.walk(self.paths['raw_txns']):
+            rel = os.path.relpath(folder, self.paths['raw_txns']).replace(os.sep, '/')
+            fragments += ['%s/%s' % (rel, f) for f in files if f.endswith('.parquet') and not f.startswith('.')]
+        return sorted(fragments)
+
+    def raw_transactions_dataset(self, fragments: Optional[List[str]] = None) -> ds.Dataset:
+        """
+        Returns the raw_transactions dataset, or only the given fragments of it
+        (relative to it, as listed by raw_txn_fragments()).
+        """
+        schema = pa.unify_schemas([SCHEMAS['raw_txns'], RAW_TXN_PARTITION_SCHEMA])
+        if not os.path.exists(self.paths['raw_txns']) or fragments == []:
+            return ds.dataset(schema.empty_table())
+        return ds.dataset(
+            self.paths['raw_txns'] if fragments is None else ['%s/%s' % (self.paths['raw_txns'], f) for f in fragments],
+            schema=schema,
+            format='parquet',
+            partitioning=ds.partitioning(RAW_TXN_PARTITION_SCHEMA, flavor='hive'),
+            partition_base_dir=self.paths['raw_txns'],
+        )
+
+    def read_raw_transactions(self, columns: Optional[List[str]] = None, filter=None,
+                              fragments: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Reads the partitioned raw_transactions dataset as one logical table, holding
+        the latest version (by create_dt) of each transaction that has not been
+        removed. Only the requested columns are read, and filter (a pyarrow.dataset
+        expression) is pushed down to the partition directories and parquet row
+        groups. With fragments, only those are read.
+        """
+        read_columns = None if columns is None else list(dict.fromkeys(columns + ['txn_id', 'create_dt', 'current']))
+        txns = (
+            self.raw_transactions_dataset(fragments).to_table(columns=read_columns, filter=filter).to_pandas()
+            .sort_values(by=['create_dt'], kind='stable')
+            .drop_duplicates(subset=['txn_id'], keep='last')
+            .query('current != False')
+            .reset_index(drop=True)
+        )
+        return txns[columns] if columns is not None else txns.drop(columns=['txn_month'])
+
+    def append_raw_transactions(self, new_txns: pd.DataFrame, dataset_dir: Optional[str] = None, new_versions: bool = False):
+        """
+        Appends transactions to the raw_transactions dataset. Each account_id/txn_month
+        partition touched gets one new fragment holding only the txn_ids not already
+        stored, as told by the raw_txns key index; existing fragments are never read
+        or rewritten. Fragments are written atomically, so a crash never leaves a
+        partial one. The fragments of one call share the next sequence number of
+        the index, which logs them for process_transactions(). The raw_data
+        payloads of the rows written go to the payload sidecar, before the index
+        records the rows as stored.
+
+        With new_versions, rows are written even if their txn_id is already stored,
+        as newer versions of those transactions.
+
+        A dataset_dir other than the live dataset (used by the migration) must start
+        out empty, and is not indexed.
+        """
+        raw_txn_schema = SCHEMAS['raw_txns']
+        new_txns = conform(new_txns.reindex(columns=['account_id', 'raw_data'] + raw_txn_schema.names), 'raw_txns')
+        new_txns = new_txns.drop_duplicates(subset=['txn_id'])
+        index = self.key_index('raw_txns') if dataset_dir is None else None
+        if index is not None and not new_versions:
+            new_txns = new_txns[~index.contains(new_txns['txn_id'])]
+        new_txns['txn_month'] = new_txns['txn_date'].dt.strftime('%Y-%m')
+        seq = index.meta['fragment_seq'] if index is not None else 0
+        fragment_name = 'part-%08d-%s.parquet' % (seq, uuid.uuid4().hex[:8])
+        written = []
+        fragments = []
+
+        for (account_id, txn_month), part in new_txns.groupby(['account_id', 'txn_month'], observed=True):
+            part_dir = self.raw_txn_partition_dir(account_id, txn_month, dataset_dir)
+            os.makedirs(part_dir, exist_ok=True)
+            fragment = pa.Table.from_pandas(part[raw_txn_schema.names], schema=raw_txn_schema, preserve_index=False)
+            atomic_write(part_dir + '/' + fragment_name, lambda p: pq.write_table(fragment, p))
+            written.append(part[['txn_id', 'account_id', 'txn_month', 'raw_data']])
+            fragments.append(os.path.relpath(part_dir, dataset_dir or self.paths['raw_txns']).replace(os.sep, '/') + '/' + fragment_name)
+
+        if written and index is not None:
+            written = pd.concat(written)
+            # Payloads first: once the index is saved these rows are never written again.
+            # A crash before that leaves fragments the index does not know of, whose
+            # rows the next sync, from the last committed cursor, writes again
+            self.payloads.append('transactions', written['txn_id'].tolist(), written['raw_data'].map(dump_raw_data).tolist())
+            partition_ids = self.raw_txn_partition_ids(index, written['account_id'], written['txn_month'])
+            index.add(written['txn_id'].tolist(), partition_ids)
+            for partition_id in set(partition_ids):
+                index.meta['partition_fragments'][partition_id] += 1
+            index.meta['fragments'][str(seq)] = fragments
+            index.meta['fragment_seq'] = seq + 1
+            index.save()
+
+    def get_transaction_ids(self, start_date: datetime.date, end_date: datetime.date, account_ids: List[str]) -> List[str]:
+        """
+        Returns the txn_ids already stored for the given accounts between start_date
+        and end_date (inclusive). The account and month filters prune the partition
+        directories before any file is opened, and only the txn_id column of the
+        remaining fragments is read, so the cost tracks the size of the window rather
+        than the size of the history.
+        """
+        if not account_ids:
+            return []
+        start = pd.Timestamp(start_date)
+        end = pd.Timestamp(end_date)
+        txn_months = pd.period_range(start, end, freq='M').strftime('%Y-%m').tolist()
+        txn_filter = (
+            ds.field('account_id').isin(list(account_ids))
+            & ds.field('txn_month').isin(txn_months)
+            & (ds.field('txn_date') >= pa.scalar(start.to_datetime64(), type=pa.timestamp('ns')))
+            & (ds.field('txn_date') <= pa.scalar(end.to_datetime64(), type=pa.timestamp('ns')))
+        )
+        txn_ids = self.raw_transactions_dataset().to_table(columns=['txn_id'], filter=txn_filter)['txn_id']
+        return txn_ids.unique().to_pylist()
+
     def save_transactions_csv(self, csv_path):
         new_txns = pd.read_csv(csv_path)
         new_txns['archive_dt'] = np.nan
         new_txns['current'] = True
-        new_txns = new_txns.astype({k: v for k, v in self.txn_types.items() if k in new_txns.columns})
 
-        try:
-            existing_txns = pd.read_parquet(self.paths['raw_txns'])
-            existing_txns.to_parquet(self.paths['raw_txns_backup'])
-            out_txns = pd.concat([existing_txns, new_txns], ignore_index=True).drop_duplicates(subset=['txn_id'])
-        except:
-            out_txns = new_txns
-        
-        out_txns.to_parquet(self.paths['raw_txns'])
+        self.append_raw_transactions(new_txns)
 
-    def save_transactions(self, transactions: PlaidTransaction):
-        cols = ['account_id', 'txn_id', 'txn_date', 'txn_name', 'txn_name_plaid', 'txn_amount', 'txn_cat_plaid', 
-                'txn_cat_plaid_dtl', 'create_dt', 'raw_data']
-        vals = [[getattr(t, col) for t in transactions] for col in cols]
-        new_txns = pd.DataFrame(dict(zip(cols, vals)))
+    def transactions_frame(self, transactions: TransactionColumns) -> pd.DataFrame:
+        new_txns = pd.DataFrame(TransactionColumns.of(transactions).columns)
         new_txns['archive_dt'] = np.nan
         new_txns['current'] = True
-        new_txns = new_txns.astype({k: v for k, v in self.txn_types.items() if k in new_txns.columns})
+        return new_txns
 
-        try:
-            existing_txns = pd.read_parquet(self.paths['raw_txns'])
-            existing_txns.to_parquet(self.paths['raw_txns_backup'])
-            out_txns = pd.concat([existing_txns, new_txns], ignore_index=True).drop_duplicates(subset=['txn_id'])
-        except:
-            out_txns = new_txns
-        
-        out_txns.to_parquet(self.paths['raw_txns'])
+    def save_transactions(self, transactions: TransactionColumns):
+        self.append_raw_transactions(self.transactions_frame(transactions))
+
+    def update_transactions(self, transactions: TransactionColumns):
+        """
+        Applies transactions Plaid reports as modified: each is stored as a new version
+        in raw_transactions, and its name, date and amount are updated in
+        processed_transactions if it has been processed already. Categories are kept.
+        """
+        if not transactions:
+            return
+        new_txns = self.transactions_frame(transactions)
+        self.append_raw_transactions(new_txns, new_versions=True)
+
+        processed_txns = self.read_table('processed_txns')
+        if processed_txns is None:
+            return
+        changes = conform(new_txns, 'raw_txns').drop_duplicates(subset=['txn_id'], keep='last').set_index('txn_id')
+        is_changed = processed_txns['txn_id'].isin(changes.index)
+        if not is_changed.any():
+            return
+        out_txns = processed_txns.copy()
+        for col in ['txn_name', 'txn_date', 'txn_amount']:
+            out_txns.loc[is_changed, col] = out_txns.loc[is_changed, 'txn_id'].map(changes[col])
+        self.write_table('processed_txns', out_txns, new_keys=[])
+
+    def remove_transactions(self, txn_ids: List[str]):
+        """
+        Applies transactions Plaid reports as removed: a new version of each, with
+        current False and archive_dt set, is stored in raw_transactions, and the
+        transaction is deleted from processed_transactions.
+        """
+        if not txn_ids:
+            return
+        # Only the partitions holding the latest version of a removed transaction are read
+        index = self.key_index('raw_txns')
+        partitions = [index.meta['partitions'][i] for i in np.unique(index.lookup(txn_ids)) if i >= 0]
+        if partitions:
+            in_partitions = functools.reduce(operator.or_, [
+                (ds.field('account_id') == account_id) & (ds.field('txn_month') == txn_month)
+                for account_id, txn_month in partitions])
+            removed = self.read_raw_transactions(filter=in_partitions & ds.field('txn_id').isin(list(txn_ids)))
+        else:
+            removed = pd.DataFrame()
+        if removed.shape[0] > 0:
+            now = pd.Timestamp.now()
+            self.append_raw_transactions(removed.assign(current=False, archive_dt=now, create_dt=now), new_versions=True)
+        # Dropped from the index, so a transaction Plaid adds again is stored again
+        index.remove(txn_ids)
+        index.save()
+
+        processed_txns = self.read_table('processed_txns')
+        if processed_txns is not None and processed_txns['txn_id'].isin(txn_ids).any():
+            self.write_table('processed_txns', processed_txns[~processed_txns['txn_id'].isin(txn_ids)], new_keys=[])
+            self.key_index('processed_txns').remove(txn_ids)
+
+    def get_sync_cursor(self, item: str) -> Optional[str]:
+        """
+        Returns the /transactions/sync cursor saved for a Plaid item (a configured
+        account), or None if it has never been synced.
+        """
+        if self.cursors is None:
+            self.cursors = {}
+            if os.path.exists(self.paths['cursors']):
+                with open(self.paths['cursors']) as f:
+                    self.cursors = json.load(f)
+        return self.cursors.get(item)
+
+    def save_sync_cursor(self, item: str, cursor: str):
+        """
+        Records the cursor to resume an item's sync from. It is written to disk by
+        checkpoint().
+        """
+        self.get_sync_cursor(item)
+        self.cursors[item] = cursor
+        self.cursors_dirty = True
+
+    def unprocessed_raw_fragments(self) -> List[str]:
+        """
+        Returns the raw_transactions fragments process_transactions() has not
+        processed: those logged by the raw_txns index from the sequence number the
+        processed_txns index got to (raw_seq), and those it deferred. If the two
+        indexes do not line up, e.g. after either was rebuilt, every fragment is.
+        """
+        raw_meta = self.key_index('raw_txns').meta
+        meta = self.key_index('processed_txns').meta
+        seqs = [str(seq) for seq in range(meta.get('raw_seq', 0), raw_meta['fragment_seq'])]
+        if meta.get('raw_epoch') != raw_meta['epoch'] or any(seq not in raw_meta['fragments'] for seq in seqs):
+            return self.raw_txn_fragments()
+        return sorted(set(meta['deferred_fragments']).union(*[raw_meta['fragments'][seq] for seq in seqs]))
 
     def process_transactions(self):
-        raw_txns = pd.read_parquet(self.paths['raw_txns'])
-        acct_names = pd.read_parquet(self.paths['account_info'])[['account_id', 'account_name_parent', 'account_name']]
+        """
+        Adds the transactions of the raw_transactions fragments written since the
+        last run to processed_transactions (see unprocessed_raw_fragments()). The
+        sequence number processed up to is recorded in the processed_txns key
+        index, and the fragments of accounts without account_info are deferred,
+        their transactions left for a run that has it.
+        """
+        processed_txns = self.read_table('processed_txns')
+        index = self.key_index('processed_txns')
+        raw_meta = self.key_index('raw_txns').meta
+        fragments = self.unprocessed_raw_fragments()
+        if not fragments:
+            return
+        raw_txns = self.read_raw_transactions(columns=['account_id', 'txn_id', 'txn_name', 'txn_date', 'txn_amount', 'pending'],
+                                              fragments=fragments)
+        # Pending transactions are processed once they post, under their posted txn_id
+        raw_txns = raw_txns[raw_txns['pending'] != True]
+        acct_names = self.read_table('account_info')[['account_id', 'account_name_parent', 'account_name']]
         raw_txn_adj = (
                 raw_txns[['account_id', 'txn_id', 'txn_name', 'txn_date', 'txn_amount']]
                 .merge(acct_names, how='inner', on=['account_id'])
                 .assign(txn_cat='')
                 .assign(txn_cat_flag=False)
             )
-        raw_txn_adj = raw_txn_adj.astype({k: v for k, v in self.txn_types.items() if k in raw_txn_adj.columns})
-        try:
-            processed_txns = pd.read_parquet(self.paths['processed_txns'])
-            processed_txns.to_parquet(self.paths['processed_txns_backup_1'])
-            out_txns = pd.concat([raw_txn_adj[~raw_txn_adj['txn_id'].isin(processed_txns['txn_id'])], processed_txns])
-        except:
-            out_txns = raw_txn_adj
-        
-        out_txns.to_parquet(self.paths['processed_txns'])
+        new_txns = raw_txn_adj[~index.contains(raw_txn_adj['txn_id'])]
+        if processed_txns is not None:
+            out_txns = pd.concat([new_txns, processed_txns])
+        else:
+            out_txns = new_txns
+
+        self.write_table('processed_txns', out_txns, new_keys=new_txns['txn_id'].tolist())
+        accounts = set(acct_names['account_id'].astype(str))
+        index.meta.update({
+            'raw_epoch': raw_meta['epoch'],
+            'raw_seq': raw_meta['fragment_seq'],
+            'deferred_fragments': [f for f in fragments
+                                   if urllib.parse.unquote(f.split('/')[0][len('account_id='):]) not in accounts],
+        })
+
+    def get_processed_transactions(self) -> pd.DataFrame:
+        return self.read_table('processed_txns')
 
     def update_gsheet_txns(self, gsheet_txns):
-        gsheet_txns = (
-            gsheet_txns
-            .rename(columns=self.gsheet_txn_map)
-            .assign(txn_cat_flag=lambda x: x['txn_cat_flag'].map({'True':True, 'False':False}))
-            .astype({k:v for k, v in self.txn_types.items() if k in gsheet_txns.columns})
-        )
-        gsheet_txns['txn_date'] = pd.TimedeltaIndex(gsheet_txns['txn_date'].astype('int64'), unit='d') + datetime.datetime(1899, 12, 30)
-        gsheet_txns['txn_name'] = gsheet_txns['txn_name'].astype('str')
-        gsheet_txns['txn_id'] = gsheet_txns['txn_id'].astype('str')
-        try:
-            prev_gsheet_txns = pd.read_parquet(self.paths['gsheet_txns'])
-            prev_gsheet_txns.to_parquet(self.paths['gsheet_txns_backup'])
+        gsheet_txns = clean_gsheet_txns(gsheet_txns)
+        prev_gsheet_txns = self.read_table('gsheet_txns')
+        if prev_gsheet_txns is not None:
             out_txns = pd.concat([prev_gsheet_txns[~prev_gsheet_txns['txn_id'].isin(gsheet_txns['txn_id'])], gsheet_txns])
-        except:
+        else:
             out_txns = gsheet_txns
 
-        out_txns.to_parquet(self.paths['gsheet_txns'])
+        self.write_table('gsheet_txns', out_txns)
 
     def sync_categories(self):
-        try:
-            gsheet_txns = (
-                pd.read_parquet(self.paths['gsheet_txns'])
-                .rename(columns={'txn_cat': 'txn_cat_new', 
-                                 'txn_cat_flag':'txn_cat_flag_new',
-                                 'txn_date': 'txn_date_new',
-                                 'txn_amount': 'txn_amount_new'})
-            )
-        except:
+        gsheet_txns = self.read_table('gsheet_txns')
+        if gsheet_txns is None:
             print("No categories synced - no gsheet data")
             return
-        processed_txns = pd.read_parquet(self.paths['processed_txns'])
-        processed_txns.to_parquet(self.paths['processed_txns_backup_2'])
+        gsheet_txns = gsheet_txns.rename(columns={'txn_cat': 'txn_cat_new',
+                                                  'txn_cat_flag':'txn_cat_flag_new',
+                                                  'txn_date': 'txn_date_new',
+                                                  'txn_amount': 'txn_amount_new'})
+        processed_txns = self.read_table('processed_txns')
         out_txns = (
             processed_txns
-            .merge(gsheet_txns[['txn_id', 'txn_cat_new', 'txn_cat_flag_new']], how='left', on=['txn_id'])
-            .assign(txn_cat_out = lambda x: x['txn_cat_new'].fillna(x['txn_cat']))
+            .merge(gsheet_txns[['txn_id', 'txn_cat_new', 'txn_cat_flag_new', 'txn_date_new', 'txn_amount_new']],
+                   how='left', on=['txn_id'])
+            .assign(txn_cat_out = lambda x: x['txn_cat_new'].astype(object).fillna(x['txn_cat'].astype(object)))
             .assign(txn_cat_flag_out = lambda x: x['txn_cat_flag_new'].fillna(x['txn_cat_flag']))
             .assign(txn_date_out = lambda x: x['txn_date_new'].fillna(x['txn_date']))
             .assign(txn_amount_out = lambda x: x['txn_amount_new'].fillna(x['txn_amount']))
@@ -181,171 +773,159 @@ class TransactionsDB():
             .rename(columns={'txn_cat_out': 'txn_cat', 'txn_cat_flag_out': 'txn_cat_flag',
                              'txn_date_out': 'txn_date', 'txn_amount_out': 'txn_amount'})
         )
-        out_txns.to_parquet(self.paths['processed_txns'])
+        self.write_table('processed_txns', out_txns, new_keys=[])
+
+    def category_prototypes(self) -> Optional[pd.DataFrame]:
+        """
+        Returns the cat_prototypes table, cat_data compacted to one row per
+        normalized name and category (see categorizer.build_prototypes). It is
+        rebuilt from cat_data if it is missing or does not count every categorized
+        row of it, e.g. after cat_data was restored from a snapshot. Returns None
+        if there is no cat_data.
+        """
+        cat_data = self.read_table('cat_data')
+        if cat_data is None:
+            return None
+        prototypes = self.read_table('cat_prototypes')
+        if prototypes is None or prototypes['txn_count'].sum() != cat_data['txn_cat'].notnull().sum():
+            prototypes = build_prototypes(cat_data)
+            self.write_table('cat_prototypes', prototypes)
+        return prototypes
 
     def update_training_data(self):
-        processed_txns = pd.read_parquet(self.paths['processed_txns'])
+        prototypes = self.category_prototypes()
+        index = self.category_index()
+        processed_txns = self.read_table('processed_txns')
         new_cat_data = (
             processed_txns
             .query("txn_cat_flag==True")
-            [['txn_id', 'txn_name', 'txn_cat']]
+            [['txn_id', 'txn_name', 'txn_cat', 'txn_date']]
         )
-        try:
-            cat_data = pd.read_parquet(self.paths['cat_data'])
-            cat_data.to_parquet(self.paths['cat_data_backup'])
-            out_cat = pd.concat([cat_data, new_cat_data]).drop_duplicates(subset=['txn_id'])
-        except:
+        cat_data = self.read_table('cat_data')
+        new_cat_data = new_cat_data[~self.key_index('cat_data').contains(new_cat_data['txn_id'])].drop_duplicates(subset=['txn_id'])
+        if cat_data is not None:
+            out_cat = pd.concat([cat_data, new_cat_data])
+        else:
             out_cat = new_cat_data
 
-        out_cat.to_parquet(self.paths['cat_data'])
+        self.write_table('cat_data', out_cat, new_keys=new_cat_data['txn_id'].tolist())
+        new_prototypes = build_prototypes(new_cat_data)
+        self.write_table('cat_prototypes', merge_prototypes(prototypes, new_prototypes))
+        # Writing the table dropped the index, which only lacks the new prototypes
+        index.add(new_prototypes)
+        self.cat_index = index
+        self.retrained_names = list(new_prototypes['txn_name_norm'].unique())
 
     def save_account_info_csv(self, csv_path):
-        new_info = pd.read_csv(csv_path)
-
-        try:
-            existing_info = pd.read_parquet(self.paths['account_info'])
-            existing_info.to_parquet(self.paths['account_info_backup'])
-            out_info = pd.concat([existing_info, new_info], ignore_index=True)
-            out_info = out_info.drop_duplicates(subset=['account_id'])
-        except:
-            out_info = new_info      
-        
-        out_info.to_parquet(self.paths['account_info'])
+        self.merge_account_info(pd.read_csv(csv_path))
 
     def save_account_info(self, account_info: AccountInfo):
         cols = ['account_id', 'account_name', 'account_name_parent', 'account_name_ofcl', 'account_type', 'account_subtype', 'account_number']
         vals = [[getattr(ai, col) for ai in account_info] for col in cols]
-        new_info = pd.DataFrame(dict(zip(cols, vals)))
+        self.merge_account_info(pd.DataFrame(dict(zip(cols, vals))))
 
-        try:
-            existing_info = pd.read_parquet(self.paths['account_info'])
-            existing_info.to_parquet(self.paths['account_info_backup'])
+    def merge_account_info(self, new_info: pd.DataFrame):
+        existing_info = self.read_table('account_info')
+        if existing_info is not None:
             out_info = pd.concat([existing_info, new_info], ignore_index=True)
             out_info = out_info.drop_duplicates(subset=['account_id'])
-        except:
-            out_info = new_info      
-        
-        out_info.to_parquet(self.paths['account_info'])
+        else:
+            out_info = new_info
+
+        self.write_table('account_info', out_info)
 
     def predict_categories(self):
-        cat_data = pd.read_parquet(self.paths['cat_data'])
-        processed_txns = pd.read_parquet(self.paths['processed_txns'])
-        processed_txns.to_parquet(self.paths['processed_txns_backup_3'])
+        """
+        Predicts a category for the unconfirmed transactions without one, and again
+        for the unconfirmed transactions predicted before whose prediction the
+        training rows update_training_data just added may change (see
+        CategoryIndex.outdated()), so a category fixed in the sheet carries over to
+        the rest of that merchant's transactions on the same run.
+        """
+        processed_txns = self.read_table('processed_txns')
+        if 'txn_cat_radius' not in processed_txns.columns:
+            processed_txns = processed_txns.assign(txn_cat_radius=np.nan)
+        unconfirmed = processed_txns.query("txn_cat_flag==False")
+        uncat = (unconfirmed['txn_cat'] == '').values
+        outdated = np.zeros(uncat.shape[0], dtype=bool)
+        if self.retrained_names and not uncat.all():
+            outdated[~uncat] = self.category_index().outdated(unconfirmed[~uncat], self.retrained_names,
+                                                              engine=self.predict_engine)
+            print("Re-predicting categories for %d transactions near %d retrained names" % (
+                outdated.sum(), len(self.retrained_names)))
+        self.retrained_names = []
 
-        if processed_txns.query("txn_cat=='' & txn_cat_flag==False").shape[0] > 0:
-            data = (
-                processed_txns
-                .query("txn_cat=='' & txn_cat_flag==False")
-                .assign(keycol=1)
-                [['txn_id', 'txn_name', 'keycol']]
-                .merge(
-                    cat_data.rename(columns={'txn_name':'txn_name_r', 'txn_id':'txn_id_r'}).assign(keycol=1),
-                    how='inner',
-                    left_on='keycol',
-                    right_on='keycol'
-                )
-                .assign(distance = lambda x: x.apply(lambda x: distance(x.txn_name, x.txn_name_r), axis=1))
-                .assign(rank=lambda x: x.groupby('txn_id')['distance'].rank(method='first', ascending=True))
-                .query('rank <= 10')
-                .groupby('txn_id')
-                .agg({'txn_name': 'first', 'txn_cat': pd.Series.mode})
-                .reset_index()
-                .assign(txn_cat_new = lambda x: x['txn_cat'].apply(lambda x: x[0] if type(x) is np.ndarray else x))
-                .drop(columns=['txn_cat'])
-            )
+        if (uncat | outdated).any():
+            data = self.category_index().predict(unconfirmed[uncat | outdated],
+                                                 candidates=self.predict_candidates,
+                                                 half_life_days=self.predict_half_life,
+                                                 engine=self.predict_engine)
 
+            data = data.rename(columns={'txn_cat_radius': 'txn_cat_radius_new'})
             out_txns = (
                 processed_txns
-                .merge(data[['txn_id', 'txn_cat_new']], on=['txn_id'], how='left')
-                .assign(txn_cat_out = lambda x: x['txn_cat_new'].fillna(x['txn_cat']))
-                .drop(columns=['txn_cat', 'txn_cat_new'])
-                .rename(columns={'txn_cat_out':'txn_cat'})
+                .merge(data[['txn_id', 'txn_cat_new', 'txn_cat_radius_new']], on=['txn_id'], how='left')
+                .assign(txn_cat_out = lambda x: x['txn_cat_new'].fillna(x['txn_cat'].astype(object)))
+                .assign(txn_cat_radius_out = lambda x: x['txn_cat_radius_new'].fillna(x['txn_cat_radius']))
+                .drop(columns=['txn_cat', 'txn_cat_new', 'txn_cat_radius', 'txn_cat_radius_new'])
+                .rename(columns={'txn_cat_out':'txn_cat', 'txn_cat_radius_out':'txn_cat_radius'})
             )
 
-            out_txns.to_parquet(self.paths['processed_txns'])
+            self.write_table('processed_txns', out_txns, new_keys=[])
         
         else:
             print("No records to predict categories for")
             return
 
     def save_balances(self, balances: AccountBalance):
-        cols = ['account_id', 'account_name', 'bal_available', 'bal_limit', 'bal_currency_code', 'bal_current', 'bal_date', 'raw_data']
+        cols = ['account_id', 'account_name', 'bal_available', 'bal_limit', 'bal_currency_code', 'bal_current', 'bal_date']
         vals = [[getattr(b, col) for b in balances] for col in cols]
-        new_bals = pd.DataFrame(dict(zip(cols, vals)))
-        new_bals = new_bals.astype({k: v for k, v in self.bal_types.items() if k in new_bals.columns})
+        new_bals = conform(pd.DataFrame(dict(zip(cols, vals))), 'raw_balances')
+        new_payloads = [dump_raw_data(b.raw_data) for b in balances]
 
-        try:
-            existing_bals = pd.read_parquet(self.paths['raw_balances'])
-            existing_bals.to_parquet(self.paths['raw_balances_backup'])
-            out_bals = pd.concat([existing_bals, new_bals], ignore_index=True)
-            out_bals = out_bals.drop_duplicates(subset=['account_id', 'bal_date'])
-        except:
-            out_bals = new_bals
+        existing_bals = self.read_table('raw_balances')
+        if existing_bals is not None and 'raw_data' in existing_bals.columns:
+            # Tables written before payloads moved to the sidecar
+            self.payloads.append('balances', self.balance_keys(existing_bals), existing_bals['raw_data'].map(dump_raw_data).tolist())
+            existing_bals = existing_bals.drop(columns=['raw_data'])
 
-        out_bals.to_parquet(self.paths['raw_balances'])
+        new_keys = self.balance_keys(new_bals)
+        is_new = ~self.key_index('raw_balances').contains(new_keys) & ~pd.Series(new_keys).duplicated().values
+        if existing_bals is not None:
+            out_bals = pd.concat([existing_bals, new_bals[is_new]], ignore_index=True)
+        else:
+            out_bals = new_bals[is_new]
 
-    def process_balances(self, start_date):
-        # Read in account info
-        account_info = pd.read_parquet(self.paths['account_info'])
-
-        # Read in raw balances
-        raw_bals = pd.read_parquet(self.paths['raw_balances'])
-        raw_bals_latest = (
-            raw_bals
-            .merge(account_info[['account_id', 'account_name_parent']],
-                   on='account_id',
-                   how='inner')
-            [['account_name_parent', 'bal_current', 'bal_date']]
-            .groupby(['account_name_parent', 'bal_date'])
-            .agg({'bal_current':'sum'}).reset_index()
-            .assign(rank=lambda x: x.groupby('account_name_parent')['bal_date'].rank(method='first', ascending=True))
-            .query('rank==1')
-            .drop(columns=['rank'])
-        )
+        new_keys = [k for k, n in zip(new_keys, is_new) if n]
+        self.payloads.append('balances', new_keys, [p for p, n in zip(new_payloads, is_new) if n])
+        self.write_table('raw_balances', out_bals, new_keys=new_keys)
 
-        # Read in all transactions, summarize by day and parent account
-        processed_txns = pd.read_parquet(self.paths['processed_txns'])
-        dates = pd.DataFrame({'txn_date': pd.date_range(start_date, datetime.datetime.today())})
-        account_dates = (
-            dates.assign(keycol=1)
-            .merge(processed_txns.assign(keycol=1)[['account_name_parent', 'keycol']].drop_duplicates(),
-                   on='keycol',
-                   how='inner')
-            .drop(columns=['keycol'])
-        )
-        processed_txns_byday = (
-            processed_txns
-            .groupby(['account_name_parent', 'txn_date'])
-            .agg({'txn_amount': 'sum'})
-            .reset_index()
-            .merge(account_dates, on=['account_name_parent', 'txn_date'], how='right')
-            .fillna(value={'txn_amount': 0})
-            .rename(columns={'txn_date':'bal_date'})
-        )
+    def balance_keys(self, bals: pd.DataFrame) -> List[str]:
+        return table_keys('raw_balances', bals)
 
-        # Do cumulative math to get the historical view of balances by day by parent account, back to start_date
-        processed_bals_new = (
-            raw_bals_latest
-            .merge(processed_txns_byday, on=['bal_date', 'account_name_parent'], how='outer')
-            .fillna({'bal_current':0, 'txn_amount': 0})
-            .sort_values(by=['account_name_parent', 'bal_date'], ascending=False, axis=0)
-            .assign(new_bal=lambda x: x['bal_current'] + x['txn_amount'])
-            .assign(out_bal=lambda x: x.groupby('account_name_parent')['new_bal'].cumsum())
-            .drop(columns=['new_bal', 'txn_amount', 'bal_current'])
-            .rename(columns={'out_bal':'bal_processed'})
-            .reset_index(drop=True)
-        )
+    def get_raw_payloads(self, kind: str, keys: List[str]) -> Dict[str, dict]:
+        """
+        Loads the raw Plaid payloads for the given keys on demand. kind is
+        'transactions' (keyed by txn_id) or 'balances' (keyed by
+        balance_payload_key(account_id, bal_date)).
+        """
+        return self.payloads.get(kind, keys)
+
+    def process_balances(self, start_date):
+        account_info = self.read_table('account_info')
+        raw_bals = self.read_table('raw_balances')
+        processed_txns = self.read_table('processed_txns')
+        processed_bals_new = build_processed_balances(account_info, raw_bals, processed_txns, start_date)
 
         # Append to processed bals, create if doesn't exist
-        try:
-            processed_bals = pd.read_parquet(self.paths['processed_balances'])
-            processed_bals.to_parquet(self.paths['processed_balances_backup'])
+        processed_bals = self.read_table('processed_balances')
+        if processed_bals is not None:
             out_bals = pd.concat([processed_bals, processed_bals_new]).drop_duplicates(['account_name_parent', 'bal_date'])
-        except:
+        else:
             out_bals = processed_bals_new
 
-        out_bals.to_parquet(self.paths['processed_balances'])
+        self.write_table('processed_balances', out_bals)
 
     def process_bal_summaries(self):
-        processed_bals = pd.read_parquet(self.paths['processed_balances'])
-        pass
\ No newline at end of file
+        processed_bals = self.read_table('processed_balances')
+        pass